@@ -0,0 +1,131 @@
+import time
+import numpy as np
+import pandas as pd
+import wntr
+from wntr.network import WaterNetworkModel
+
+from utils.leaks_utils import generate_leaks
+from utils.network_utils import get_network, get_network_index
+from utils.main_simulation_functions import get_hydraulic_options
+
+# =================================== INITIAL PARAMS ===================================
+inp_file = "networks/Melocoton.inp"
+total_duration = 24 * 3600  # seconds
+minimum_pressure = 5  # m.c.a
+required_pressure = 15  # m.c.a
+leak_start_time = 5 * 3600  # seconds
+# Number of damaged pipes of each benchmarked damage state
+damage_counts = [10, 50, 100, 150, 200]
+repetitions = 1
+seed = 0
+# ======================================================================================
+
+
+def generate_leaks_with_split_pipe_copies(
+    wn: WaterNetworkModel, damage_states: pd.Series, leak_start_time: int
+) -> WaterNetworkModel:
+    """
+    The previous implementation: split_pipe copies the whole network per leak.
+    """
+    for pipe_name, damage_state in damage_states.items():
+        pipe_diameter = wn.get_link(pipe_name).diameter
+        if damage_state is not None:
+            if damage_state == "Mayor":
+                leak_diameter = min(0.1 * pipe_diameter, 0.0050)
+            else:
+                leak_diameter = min(0.05 * pipe_diameter, 0.0025)
+            leak_area = np.pi * (leak_diameter / 2) ** 2
+
+            wn = wntr.morph.split_pipe(
+                wn, pipe_name, f"{pipe_name}_A", f"Leak_{pipe_name}"
+            )
+            leak_node = wn.get_node(f"Leak_{pipe_name}")
+            leak_node.add_leak(wn, area=leak_area, start_time=leak_start_time)
+
+    return wn
+
+
+def describe_network(wn: WaterNetworkModel) -> tuple:
+    """
+    Everything the leaks change in a network, to check both versions agree.
+    """
+    nodes = [
+        (
+            name,
+            type(node).__name__,
+            getattr(node, "elevation", None),
+            node.coordinates,
+            getattr(node, "leak_area", None),
+        )
+        for name, node in wn.nodes()
+    ]
+    links = [
+        (
+            name,
+            link.start_node_name,
+            link.end_node_name,
+            getattr(link, "length", None),
+            getattr(link, "diameter", None),
+            getattr(link, "roughness", None),
+            list(getattr(link, "vertices", [])),
+        )
+        for name, link in wn.links()
+    ]
+    controls = [
+        (
+            name,
+            str(control._condition),
+            [
+                (action._target_obj.name, action._attribute, action._value)
+                for action in control._then_actions
+            ],
+        )
+        for name, control in wn.controls()
+    ]
+    return nodes, links, controls
+
+
+if __name__ == "__main__":
+    hydraulic_options = get_hydraulic_options(
+        total_duration, minimum_pressure, required_pressure
+    )
+    network_index = get_network_index(inp_file, hydraulic_options)
+    pipe_names = network_index["pipe_names"]
+    rng = np.random.default_rng(seed)
+
+    rows = []
+    for damage_count in damage_counts:
+        damaged_pipes = rng.choice(pipe_names, size=damage_count, replace=False)
+        # Undamaged pipes are None, as in FragilityCurve.sample_damage_state
+        damage_states = pd.Series([None] * len(pipe_names), index=pipe_names)
+        damage_states[damaged_pipes] = rng.choice(["Moderado", "Mayor"], damage_count)
+
+        copies_times, in_place_times = [], []
+        for _ in range(repetitions):
+            wn = get_network(inp_file, hydraulic_options)
+            start = time.time()
+            wn_copies = generate_leaks_with_split_pipe_copies(
+                wn, damage_states, leak_start_time
+            )
+            copies_times.append(time.time() - start)
+
+            wn = get_network(inp_file, hydraulic_options)
+            start = time.time()
+            wn_in_place, _ = generate_leaks(
+                wn, damage_states, leak_start_time, None, network_index
+            )
+            in_place_times.append(time.time() - start)
+
+        rows.append(
+            {
+                "damaged_pipes": damage_count,
+                "split_pipe copies [s]": np.median(copies_times),
+                "in place [s]": np.median(in_place_times),
+                "speedup": np.median(copies_times) / np.median(in_place_times),
+                "identical": describe_network(wn_copies)
+                == describe_network(wn_in_place),
+            }
+        )
+        print(rows[-1])
+
+    print(pd.DataFrame(rows).round(3).to_string(index=False))
@@ -0,0 +1,143 @@
+import tempfile
+import pandas as pd
+
+from utils.leaks_utils import get_damage_states
+from utils.network_utils import get_network
+from utils.main_simulation_functions import simulate_wrapper
+
+# =================================== INITIAL PARAMS ===================================
+inp_file = "networks/Melocoton.inp"
+total_duration = 8 * 3600  # seconds
+minimum_pressure = 5  # m.c.a
+required_pressure = 15  # m.c.a
+leak_start_time = 5 * 3600  # seconds
+# Heavily damaged earthquake realizations (100+ damaged pipes in Melocoton), with the
+# check valve pipes always damaged
+pga_values = [0.38, 0.38, 0.38]
+seed = 107
+# Each realization is checked with and without stopping at its first negative pressure
+stop_on_negative_pressure_options = [False, True]
+# ======================================================================================
+
+# Max |shared prefix - full solve| allowed, over every time (the Leak_* nodes and the
+# *_A pipes before the leak start included)
+PRESSURE_TOLERANCE = 1e-3  # m.c.a
+FLOWRATE_TOLERANCE = 1e-5  # m3/s
+WSA_TOLERANCE = 1e-4
+
+
+def simulate_with_prefix(
+    realization_id: int,
+    pga_value: float,
+    damage_states: pd.Series,
+    shared_prefix: bool,
+    stop_on_negative_pressure: bool,
+    output_folder: str,
+):
+    return simulate_wrapper(
+        inp_file,
+        "Earthquake",
+        None,
+        leak_start_time,
+        required_pressure,
+        realization_id,
+        total_duration,
+        minimum_pressure,
+        pga_value,
+        damage_states,
+        output_folder,
+        run_profile="metrics_only",
+        shared_prefix=shared_prefix,
+        stop_on_negative_pressure=stop_on_negative_pressure,
+        return_simulation_results=True,
+    )
+
+
+def compare_prefix(full_solve, shared_prefix) -> dict:
+    """
+    Differences (shared prefix - full solve) of a realization, asserting they are
+    within the tolerances.
+    """
+    full_metrics, full_results = full_solve
+    prefix_metrics, prefix_results = shared_prefix
+    assert "error" not in full_metrics and "error" not in prefix_metrics, (
+        full_metrics.get("error") or prefix_metrics.get("error")
+    )
+
+    pressure = full_results.node["pressure"]
+    pressure_diff = (
+        (prefix_results.node["pressure"][pressure.columns] - pressure).abs().max(axis=1)
+    )
+    flowrate = full_results.link["flowrate"]
+    flowrate_diff = (
+        (prefix_results.link["flowrate"][flowrate.columns] - flowrate).abs().max(axis=1)
+    )
+    status = full_results.link["status"]
+    after_leak = status.index >= leak_start_time
+    status_diff = prefix_results.link["status"][status.columns] != status
+    # Realizations stopped at a negative pressure have no mean_system_wsa
+    wsa_diff = (
+        prefix_metrics["mean_system_wsa"] - full_metrics["mean_system_wsa"]
+        if full_metrics.get("mean_system_wsa") is not None
+        else 0.0
+    )
+    min_pressure_diff = (
+        prefix_metrics["min_system_pressure"] - full_metrics["min_system_pressure"]
+    )
+
+    assert not status_diff.any().any(), (
+        f"Links with another status: "
+        f"{list(status_diff.columns[status_diff.any()])}"
+    )
+    assert prefix_metrics.get("invalid_at") == full_metrics.get("invalid_at"), (
+        prefix_metrics.get("invalid_at"),
+        full_metrics.get("invalid_at"),
+    )
+    assert pressure_diff.max() <= PRESSURE_TOLERANCE, pressure_diff
+    assert flowrate_diff.max() <= FLOWRATE_TOLERANCE, flowrate_diff
+    assert abs(wsa_diff) <= WSA_TOLERANCE, wsa_diff
+
+    return {
+        "invalid_at": full_metrics.get("invalid_at"),
+        "max_abs_diff_pressure_before_leak": pressure_diff[~after_leak].max(),
+        "max_abs_diff_pressure_after_leak": pressure_diff[after_leak].max(),
+        "max_abs_diff_flowrate": flowrate_diff.max(),
+        "diff_min_system_pressure": min_pressure_diff,
+        "diff_mean_system_wsa": wsa_diff,
+        "full_hydraulics [s]": full_metrics["stage_times"]["hydraulics"],
+        "prefix_hydraulics [s]": prefix_metrics["stage_times"]["hydraulics"],
+    }
+
+
+if __name__ == "__main__":
+    wn = get_network(inp_file)
+    check_valve_pipes = [name for name, pipe in wn.pipes() if pipe.check_valve]
+    pga_and_damage_states_list = get_damage_states(pga_values, inp_file, seed=seed)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as output_folder:
+        for i, (pga_value, damage_states) in enumerate(pga_and_damage_states_list):
+            damage_states = damage_states.copy()
+            damage_states[check_valve_pipes] = "Mayor"
+            for stop_on_negative_pressure in stop_on_negative_pressure_options:
+                full_solve, shared_prefix = [
+                    simulate_with_prefix(
+                        i + 1,
+                        pga_value,
+                        damage_states,
+                        shared_prefix,
+                        stop_on_negative_pressure,
+                        output_folder,
+                    )
+                    for shared_prefix in [False, True]
+                ]
+                row = {
+                    "realization_id": i + 1,
+                    "num_damages": int(damage_states.notna().sum()),
+                    "stop_on_negative_pressure": stop_on_negative_pressure,
+                }
+                row.update(compare_prefix(full_solve, shared_prefix))
+                rows.append(row)
+                print(rows[-1])
+
+    print(pd.DataFrame(rows).round(4).to_string(index=False))
@@ -2,10 +2,23 @@ import time
 from datetime import datetime
 import os
 import pandas as pd
-from utils.leaks_utils import get_damage_states, get_network_priority_nodes
-from utils.general_utils import format_time, generate_excels, generate_pga_value
-from utils.main_simulation_functions import simulate_network_parallel
+from utils.leaks_utils import get_network_priority_nodes
+from utils.general_utils import (
+    format_time,
+    generate_excels,
+    count_reused_scenarios,
+)
+from utils.main_simulation_functions import (
+    simulate_network_parallel,
+    simulate_network_variants_parallel,
+)
+from utils.sampling_utils import sample_earthquake_scenarios
+from utils.damage_utils import DamageMatrix
 from utils.types import MitigationLeaksStrategyOptions
+from utils.checkpoint_utils import get_checkpoint_folder, write_file_atomically
+from utils.store_utils import load_store_frame
+from utils.archive_utils import get_archive_path
+from utils.catalog_utils import summarize_run
 import pickle
 import winsound
 
@@ -17,10 +30,63 @@ total_duration = 24 * 3600  # seconds
 minimum_pressure = 5  # m.c.a
 required_pressure = 15  # m.c.a
 leak_start_time = 5 * 3600  # seconds
+# Folder with pre-parsed networks shared by all workers (None to always parse the INP)
+network_cache_folder = "networks/cache"
+# "full" also saves raw data, charts and topology metrics per realization;
+# "metrics_only" skips them (the no earthquake experiment always runs "full")
+run_profile = "full"
+# Realizations whose charts are rendered after each simulation (None for all of them)
+chart_realization_ids = list(range(1, 11))
+# "archive" saves each realization's network and results as a compact zip, "pickle" as before
+raw_data_format = "archive"
+# Start the solver of each earthquake realization from the unmitigated run of the same
+# damage state (or the clean run) at t=0 and at the leak start, using their raw data
+warm_start = True
+# Simulate the clean network once up to the leak start and continue each earthquake
+# realization from there, instead of simulating the hours before the leaks every time.
+# Run check_prefix_parity.py against the full solve before enabling it
+shared_prefix = False
+# Stop earthquake realizations at their first negative pressure, since they are discarded
+# anyway, keeping only an invalid_at marker and their minimum pressures. Their minimum
+# pressures are then only up to that time, unlike in experiments without it
+stop_on_negative_pressure = False
+# Run realizations in batches and stop each earthquake experiment once the confidence
+# intervals of its estimators are this narrow, with num_realizations_per_iteration as
+# the budget (None to always run all of them). Mitigation experiments run at least as
+# many realizations as the unmitigated one, so they stay paired with it
+adaptive_sampling = None
+# adaptive_sampling = {
+#     "batch_size": 50,
+#     "min_realizations": 100,
+#     "confidence": 0.95,
+#     "target_half_widths": {
+#         "mean_system_wsa": 0.005,
+#         "mean_todini": 0.01,
+#         "negative_pressure_fraction": 0.05,
+#     },
+# }
+# How PGA and damage states are drawn: "pga" "independent" or "lhs" (a latin hypercube
+# of PGAs), "antithetic" pairs of mirrored draws, and an "importance_shift" > 0 to draw
+# more of the larger PGAs, weighting each realization by its likelihood ratio in the
+# analysis. The damage matrix is saved to damage_sample/ in the experiment folder
+sampling_design = {"pga": "independent", "antithetic": False, "importance_shift": 0}
+# Seed of the PGA and damage draws (None for a new one, kept in damage_sample/)
+sampling_seed = None
+# Simulate each realization under the unmitigated and every mitigation experiment in
+# the same task, building its damaged network once and starting the mitigated solves
+# from the unmitigated one (not available with adaptive_sampling)
+realization_major = False
+# Folder of an interrupted run to resume, e.g. "results/experimento_full_2024-11-09_02-00-07"
+# Completed realizations are skipped and the same PGA and damage states are reused
+resume_experiment_folder = None
 # Optional (Only for mitigation)
 # mitigation_strategy can be any of "betweenness"|"closeness"|"pressure"|"node_degree"
 mitigation_strategies = ["betweenness", "closeness", "pressure", "node_degree"]
 reinforcement_percentages = [3,6,10,50,100]
+# SQLite catalog with the scalars of every realization of every experiment (pga,
+# damages, pressures, WSA, Todini, runtime, errors), see utils/catalog_utils.py
+# (None to not keep one)
+catalog_file = "results/catalog.sqlite"
 
 # ======================================================================================
 
@@ -31,17 +97,56 @@ if __name__ == "__main__":
     start_datetime_str_for_file_paths = start_datetime.strftime("%Y-%m-%d_%H-%M-%S")
 
     print(f"Starting at {start_datetime_str}")
+    if realization_major and adaptive_sampling is not None:
+        raise ValueError("adaptive_sampling runs experiment by experiment")
 
     # Create the results folder with the start datetime
-    experiment_folder = f"results/experimento_full_{start_datetime_str_for_file_paths}"
+    if resume_experiment_folder is not None:
+        experiment_folder = resume_experiment_folder
+        print(f"Resuming {experiment_folder}")
+    else:
+        experiment_folder = f"results/experimento_full_{start_datetime_str_for_file_paths}"
     os.makedirs(experiment_folder, exist_ok=True)
+    # Centralities shared by every experiment that splits the same damaged pipes
+    topology_cache_folder = f"{experiment_folder}/topology_cache"
+    # Realizations with the same effective leaks (e.g. the reinforced pipes weren't
+    # damaged) reuse the results of the first experiment that simulated them
+    scenario_cache_folder = f"{experiment_folder}/scenario_cache"
 
     all_experiments_results = []
 
-    # Generar los valores de PGA para todas las simulaciones
-    pga_values = [generate_pga_value() for _ in range(num_realizations_per_iteration)]
-    
-    pga_and_damage_states_list = get_damage_states(pga_values,inp_file)
+    # Generar los valores de PGA para todas las simulaciones (o recuperarlos al reanudar)
+    damage_sample_folder = os.path.join(experiment_folder, "damage_sample")
+    sampling_weights_filename = os.path.join(experiment_folder, "sampling_weights.pickle")
+    # Runs from before the damage matrix kept a list of (pga, damage_states)
+    pga_and_damage_states_filename = os.path.join(
+        experiment_folder, "pga_and_damage_states.pickle"
+    )
+    sampling_weights = None
+    if os.path.exists(pga_and_damage_states_filename):
+        with open(pga_and_damage_states_filename, "rb") as f:
+            pga_and_damage_states_list = pickle.load(f)
+    elif os.path.isdir(damage_sample_folder):
+        pga_and_damage_states_list = DamageMatrix.load(damage_sample_folder)
+        if os.path.exists(sampling_weights_filename):
+            with open(sampling_weights_filename, "rb") as f:
+                sampling_weights = pickle.load(f)
+    else:
+        pga_and_damage_states_list, sampling_weights = sample_earthquake_scenarios(
+            num_realizations_per_iteration,
+            inp_file,
+            sampling_design,
+            network_cache_folder,
+            sampling_seed,
+        )
+        if sampling_design["importance_shift"] == 0:
+            sampling_weights = None  # All of them 1
+        else:
+            write_file_atomically(
+                sampling_weights_filename, pickle.dumps(sampling_weights)
+            )
+        # Memory-mapped from here on, the workers map the same file
+        pga_and_damage_states_list.save(damage_sample_folder)
     print("\n===============================")
     print("Starting no earthquake experiment")
     # Run no earthquake experiment
@@ -58,6 +163,13 @@ if __name__ == "__main__":
         total_duration=total_duration,
         minimum_pressure=minimum_pressure,
         output_folder=no_earthquake_output_folder,
+        network_cache_folder=network_cache_folder,
+        topology_cache_folder=topology_cache_folder,
+        checkpoint_folder=get_checkpoint_folder(no_earthquake_output_folder),
+        result_store_folder=os.path.join(no_earthquake_output_folder, "store"),
+        raw_data_format=raw_data_format,
+        run_profile="full",
+        catalog_file=catalog_file,
     )
 
     # Pickle the results
@@ -68,28 +180,18 @@ if __name__ == "__main__":
     with open(base_earthquake_results_filename, "wb") as f:
         pickle.dump(no_earthquake_results, f)
 
-    # Analyze no_earthquake_results
-    num_iterations_with_negative_pressure = 0
-    min_pressure_all_iterations = float("inf")
-
-    for _, row in no_earthquake_results.iterrows():
-        if "error" in row and pd.notna(row["error"]):
-            continue  # Skip erroneous iterations
-
-        # Find the minimum pressure across all nodes in this iteration
-        min_pressure = row["min_system_junctions_pressure"]
-        min_pressure_all_iterations = min(min_pressure_all_iterations, min_pressure)
-
-        # Check if there's any negative pressure in this iteration
-        if min_pressure < 0:
-            num_iterations_with_negative_pressure += 1
+    # Analyze no_earthquake_results (minimum pressure and negative pressure count)
+    run_summary = summarize_run(
+        catalog_file, no_earthquake_output_folder, no_earthquake_results
+    )
 
     no_earthquake_experiment_result = {
         "mitigation_strategy": "No_earthquake",
         "reinforcement_percent": 0,
         "num_iterations": num_realizations_per_iteration,
-        "min_pressure": min_pressure_all_iterations,
-        "negative_pressure_count": num_iterations_with_negative_pressure,
+        "min_pressure": run_summary["min_pressure"],
+        "negative_pressure_count": run_summary["negative_pressure_count"],
+        "reused_scenarios": count_reused_scenarios(no_earthquake_results),
     }
     all_experiments_results.append(no_earthquake_experiment_result)
 
@@ -99,12 +201,22 @@ if __name__ == "__main__":
 
     # Calculate priority nodes
     print("Generating priority_nodes dict")
-    no_earthquake_network_filepath = os.path.join(
-        no_earthquake_output_folder, "simulation_data", "wn_realization_1.pickle"
+    no_earthquake_simulation_data_folder = os.path.join(
+        no_earthquake_output_folder, "simulation_data"
     )
+    if raw_data_format == "archive":
+        no_earthquake_network_filepath = get_archive_path(
+            no_earthquake_simulation_data_folder, 1
+        )
+    else:
+        no_earthquake_network_filepath = os.path.join(
+            no_earthquake_simulation_data_folder, "wn_realization_1.pickle"
+        )
 
     # Calculate average pressures for each node in the no earthquake experiment
-    mean_node_pressure = no_earthquake_results["mean_node_pressure"][0]
+    mean_node_pressure = load_store_frame(
+        os.path.join(no_earthquake_output_folder, "store"), "mean_node_pressure"
+    )[1]
 
     # Generate the priority nodes dictionary
     priority_nodes = get_network_priority_nodes(
@@ -117,23 +229,107 @@ if __name__ == "__main__":
     with open(priority_nodes_filename, "wb") as f:
         pickle.dump(priority_nodes, f)
 
+    base_earthquake_output_folder = f"{experiment_folder}/base_earthquake"
+    mitigation_experiments = []
+    for mitigation_strategy in mitigation_strategies:
+        for reinforcement_percent in reinforcement_percentages:
+            experiment_name = (
+                f"{mitigation_strategy}_at_{reinforcement_percent}"
+                if mitigation_strategy != ""
+                else ""
+            )
+            mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions = {
+                "mitigation_strategy": mitigation_strategy,
+                "reinforcement_percent": reinforcement_percent,
+                "priority_nodes": priority_nodes,
+            }
+            mitigation_experiments.append(
+                (
+                    mitigation_strategy,
+                    reinforcement_percent,
+                    experiment_name,
+                    mitigation_leaks_strategy_options,
+                )
+            )
+
+    # Results of every earthquake experiment by output folder, when they all run
+    # realization by realization
+    variant_results = {}
+    if realization_major:
+        print("\n===============================")
+        print("Starting earthquake experiments realization by realization")
+        variants = [
+            {
+                "output_folder": base_earthquake_output_folder,
+                "mitigation_leaks_strategy_options": None,
+            }
+        ] + [
+            {
+                "output_folder": f"{experiment_folder}/{experiment_name}",
+                "mitigation_leaks_strategy_options": options,
+            }
+            for _, _, experiment_name, options in mitigation_experiments
+        ]
+        results_by_variant = simulate_network_variants_parallel(
+            inp_file=inp_file,
+            variants=variants,
+            leak_start_time=leak_start_time,
+            required_pressure=required_pressure,
+            num_realizations=num_realizations_per_iteration,
+            pga_values_and_damage_states=pga_and_damage_states_list,
+            max_workers=max_workers,
+            total_duration=total_duration,
+            minimum_pressure=minimum_pressure,
+            network_cache_folder=network_cache_folder,
+            topology_cache_folder=topology_cache_folder,
+            raw_data_format=raw_data_format,
+            run_profile=run_profile,
+            chart_realization_ids=chart_realization_ids,
+            warm_start=warm_start,
+            clean_warm_start_folder=no_earthquake_output_folder if warm_start else None,
+            shared_prefix=shared_prefix,
+            stop_on_negative_pressure=stop_on_negative_pressure,
+            sampling_weights=sampling_weights,
+            catalog_file=catalog_file,
+        )
+        variant_results = {
+            variant["output_folder"]: results
+            for variant, results in zip(variants, results_by_variant)
+        }
+
     print("\n===============================")
     print("Starting earthquake with no mitigation experiment")
     # Run base earthquake experiment
-    base_earthquake_output_folder = f"{experiment_folder}/base_earthquake"
-    base_earthquake_results = simulate_network_parallel(
-        simulation_type="Earthquake",
-        inp_file=inp_file,
-        mitigation_leaks_strategy_options=None,
-        leak_start_time=leak_start_time,
-        required_pressure=required_pressure,
-        num_realizations=num_realizations_per_iteration,
-        pga_values_and_damage_states=pga_and_damage_states_list,
-        max_workers=max_workers,
-        total_duration=total_duration,
-        minimum_pressure=minimum_pressure,
-        output_folder=base_earthquake_output_folder,
-    )
+    if realization_major:
+        base_earthquake_results = variant_results[base_earthquake_output_folder]
+    else:
+        base_earthquake_results = simulate_network_parallel(
+            simulation_type="Earthquake",
+            inp_file=inp_file,
+            mitigation_leaks_strategy_options=None,
+            leak_start_time=leak_start_time,
+            required_pressure=required_pressure,
+            num_realizations=num_realizations_per_iteration,
+            pga_values_and_damage_states=pga_and_damage_states_list,
+            max_workers=max_workers,
+            total_duration=total_duration,
+            minimum_pressure=minimum_pressure,
+            output_folder=base_earthquake_output_folder,
+            network_cache_folder=network_cache_folder,
+            topology_cache_folder=topology_cache_folder,
+            checkpoint_folder=get_checkpoint_folder(base_earthquake_output_folder),
+            result_store_folder=os.path.join(base_earthquake_output_folder, "store"),
+            raw_data_format=raw_data_format,
+            run_profile=run_profile,
+            chart_realization_ids=chart_realization_ids,
+            scenario_cache_folder=scenario_cache_folder,
+            clean_warm_start_folder=no_earthquake_output_folder if warm_start else None,
+            shared_prefix=shared_prefix,
+            stop_on_negative_pressure=stop_on_negative_pressure,
+            adaptive_sampling=adaptive_sampling,
+            sampling_weights=sampling_weights,
+            catalog_file=catalog_file,
+        )
 
     # Pickle the results
     base_earthquake_results_filename = os.path.join(
@@ -143,27 +339,17 @@ if __name__ == "__main__":
         pickle.dump(base_earthquake_results, f)
 
     # Analyze base_earthquake_results
-    num_iterations_with_negative_pressure = 0
-    min_pressure_all_iterations = float("inf")
-
-    for _, row in base_earthquake_results.iterrows():
-        if "error" in row and pd.notna(row["error"]):
-            continue  # Skip erroneous iterations
-
-        # Find the minimum pressure across all nodes in this iteration
-        min_pressure = row["min_system_junctions_pressure"]
-        min_pressure_all_iterations = min(min_pressure_all_iterations, min_pressure)
-
-        # Check if there's any negative pressure in this iteration
-        if min_pressure < 0:
-            num_iterations_with_negative_pressure += 1
+    run_summary = summarize_run(
+        catalog_file, base_earthquake_output_folder, base_earthquake_results
+    )
 
     base_earthquake_experiment_result = {
         "mitigation_strategy": "Earthquake_no_mitigation",
         "reinforcement_percent": 0,
-        "num_iterations": num_realizations_per_iteration,
-        "min_pressure": min_pressure_all_iterations,
-        "negative_pressure_count": num_iterations_with_negative_pressure,
+        "num_iterations": len(base_earthquake_results),
+        "min_pressure": run_summary["min_pressure"],
+        "negative_pressure_count": run_summary["negative_pressure_count"],
+        "reused_scenarios": count_reused_scenarios(base_earthquake_results),
     }
     all_experiments_results.append(base_earthquake_experiment_result)
 
@@ -173,28 +359,32 @@ if __name__ == "__main__":
 
     print("\n===============================")
     print("Starting earthquake with mitigation experiments")
+    mitigation_adaptive_sampling = adaptive_sampling
+    if adaptive_sampling is not None:
+        mitigation_adaptive_sampling = {
+            **adaptive_sampling,
+            "min_realizations": max(
+                adaptive_sampling["min_realizations"], len(base_earthquake_results)
+            ),
+        }
     # Loop over each strategy and reinforcement percent
-    for mitigation_strategy in mitigation_strategies:
-        for reinforcement_percent in reinforcement_percentages:
-            experiment_name = (
-                f"{mitigation_strategy}_at_{reinforcement_percent}"
-                if mitigation_strategy != ""
-                else ""
-            )
-            output_folder = f"{experiment_folder}/{experiment_name}"
-            os.makedirs(output_folder, exist_ok=True)
-            print(
-                f"\nRunning experiment for mitigation strategy '{mitigation_strategy}' "
-                f"and {reinforcement_percent} % reinforcement."
-            )
-
-            mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions = {
-                "mitigation_strategy": mitigation_strategy,
-                "reinforcement_percent": reinforcement_percent,
-                "priority_nodes": priority_nodes,
-            }
-
-            # Run the specified number of iterations for each PGA value
+    for (
+        mitigation_strategy,
+        reinforcement_percent,
+        experiment_name,
+        mitigation_leaks_strategy_options,
+    ) in mitigation_experiments:
+        output_folder = f"{experiment_folder}/{experiment_name}"
+        os.makedirs(output_folder, exist_ok=True)
+        print(
+            f"\nRunning experiment for mitigation strategy '{mitigation_strategy}' "
+            f"and {reinforcement_percent} % reinforcement."
+        )
+
+        # Run the specified number of iterations for each PGA value
+        if realization_major:
+            results = variant_results[output_folder]
+        else:
             results = simulate_network_parallel(
                 simulation_type="Earthquake",
                 inp_file=inp_file,
@@ -207,46 +397,51 @@ if __name__ == "__main__":
                 total_duration=total_duration,
                 minimum_pressure=minimum_pressure,
                 output_folder=output_folder,
+                network_cache_folder=network_cache_folder,
+                topology_cache_folder=topology_cache_folder,
+                checkpoint_folder=get_checkpoint_folder(output_folder),
+                result_store_folder=os.path.join(output_folder, "store"),
+                raw_data_format=raw_data_format,
+                run_profile=run_profile,
+                chart_realization_ids=chart_realization_ids,
+                scenario_cache_folder=scenario_cache_folder,
+                warm_start_folder=(
+                    base_earthquake_output_folder if warm_start else None
+                ),
+                clean_warm_start_folder=(
+                    no_earthquake_output_folder if warm_start else None
+                ),
+                shared_prefix=shared_prefix,
+                stop_on_negative_pressure=stop_on_negative_pressure,
+                adaptive_sampling=mitigation_adaptive_sampling,
+                sampling_weights=sampling_weights,
+                catalog_file=catalog_file,
             )
 
-            # Pickle the results
-            results_filename = os.path.join(
-                output_folder, f"results.pickle"
-            )
-            with open(results_filename, "wb") as f:
-                pickle.dump(results, f)
-
-            # Analyze results for this PGA
-            num_iterations_with_negative_pressure = 0
-            min_pressure_all_iterations = float("inf")
-
-            for _, row in results.iterrows():
-                if "error" in row and pd.notna(row["error"]):
-                    continue  # Skip erroneous iterations
-
-                # Find the minimum pressure across all nodes in this iteration
-                min_pressure = row["min_system_junctions_pressure"]
-                min_pressure_all_iterations = min(
-                    min_pressure_all_iterations, min_pressure
-                )
-
-                # Check if there's any negative pressure in this iteration
-                if min_pressure < 0:
-                    num_iterations_with_negative_pressure += 1
-
-            # Save experiment results for this PGA
-            experiment_result = {
-                "mitigation_strategy": mitigation_strategy,
-                "reinforcement_percent": reinforcement_percent,
-                "num_iterations": num_realizations_per_iteration,
-                "min_pressure": min_pressure_all_iterations,
-                "negative_pressure_count": num_iterations_with_negative_pressure,
-            }
-            all_experiments_results.append(experiment_result)
-
-            # Generate Excels
-            print("Generating Excel files")
-            generate_excels(output_folder, results, f"_{experiment_name}")
+        # Pickle the results
+        results_filename = os.path.join(
+            output_folder, f"results.pickle"
+        )
+        with open(results_filename, "wb") as f:
+            pickle.dump(results, f)
+
+        # Analyze results for this PGA
+        run_summary = summarize_run(catalog_file, output_folder, results)
+
+        # Save experiment results for this PGA
+        experiment_result = {
+            "mitigation_strategy": mitigation_strategy,
+            "reinforcement_percent": reinforcement_percent,
+            "num_iterations": len(results),
+            "min_pressure": run_summary["min_pressure"],
+            "negative_pressure_count": run_summary["negative_pressure_count"],
+            "reused_scenarios": count_reused_scenarios(results),
+        }
+        all_experiments_results.append(experiment_result)
+
+        # Generate Excels
+        print("Generating Excel files")
+        generate_excels(output_folder, results, f"_{experiment_name}")
 
     # Save all results to a CSV file for further analysis
     output_filename = os.path.join(experiment_folder, "experiment_results.csv")
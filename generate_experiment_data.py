@@ -1,7 +1,21 @@
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+import numpy as np
 import pandas as pd
 
+from utils.archive_utils import get_archive_path
+from utils.aggregation_utils import WeightedMeanAccumulator, QuantileSketch
+from utils.metrics_utils import SATISFIED_PRESSURE_THRESHOLDS
+from utils.store_utils import (
+    load_store_index,
+    load_store_metric,
+    iter_store_realizations,
+    get_store_realization_ids,
+    load_pressure_histogram,
+)
+
 
 def filter_leak_keys(d):
     return {k: v for k, v in d.items() if not k.startswith("Leak_")}
@@ -10,103 +24,174 @@ def get_df_gte_threshold(data:pd.DataFrame, threshold:float):
     new_df = (data.T >= threshold).sum()
     return new_df / len(data.T)
 
-def load_and_process_simulation_results(pickle_route: str, usefull_iterations:set):
-    # Cargar los resultados de la simulación desde el archivo pickle
+# Metrics averaged over the valid realizations of an experiment
+NODE_METRICS = ["betweenness_centrality", "closeness_centrality", "mean_node_pressure"]
+TIME_METRICS = [
+    "mean_t_pressure",
+    "todini",
+    "mean_t_wsa",
+    "mean_t_flowrate",
+    "mean_t_demand",
+    "mean_t_leak_demand",
+    "mean_t_total_demand",
+    "mean_t_tank_levels",
+]
+
+def get_store_folder(pickle_route: str):
+    # Experiments run with a result store keep their arrays next to the pickle
+    store_folder = os.path.join(os.path.dirname(pickle_route), "store")
+    return store_folder if os.path.isdir(store_folder) else None
+
+def load_pickle_metrics(pickle_route: str) -> pd.DataFrame:
     with open(pickle_route, "rb") as f:
         sim_metrics = pickle.load(f)
-    
-    # Extraer las métricas necesarias desde sim_metrics
-    pressure = sim_metrics.get("pressure", None)
-    raw_betweenness_centrality = sim_metrics.get("betweenness_centrality", None)
-    raw_closeness_centrality = sim_metrics.get("closeness_centrality", None)
-    raw_mean_node_pressure = sim_metrics.get("mean_node_pressure", None)
-    mean_t_pressure = sim_metrics.get("mean_t_pressure", None)
-    todini = sim_metrics.get("todini", None)
-    mean_t_wsa = sim_metrics.get("mean_t_wsa", None)
-    mean_t_flowrate = sim_metrics.get("mean_t_flowrate", None)
-    mean_t_demand = sim_metrics.get("mean_t_demand", None)
-    mean_t_leak_demand = sim_metrics.get("mean_t_leak_demand", None)
-    mean_t_total_demand = sim_metrics.get("mean_t_total_demand", None)
-    mean_t_tank_levels = sim_metrics.get("mean_t_tank_levels", None)
-    num_damages = sim_metrics.get("num_damages", [0])
-    
-    # Inicializar diccionarios para recopilar datos válidos de cada métrica
-    valid_pressures = {}
-    valid_betweenness_centrality = {}
-    valid_closeness_centrality = {}
-    valid_mean_node_pressure = {}
-    valid_mean_t_pressure = {}
-    valid_todini = {}
-    valid_mean_t_wsa = {}
-    valid_mean_t_flowrate = {}
-    valid_mean_t_demand = {}
-    valid_mean_t_leak_demand = {}
-    valid_mean_t_total_demand = {}
-    valid_mean_t_tank_levels = {}
-    valid_num_damages={}
-    valid_t_required_satisfied_node_pressure = {}
-    valid_t_min_satisfied_node_pressure = {}
-
-    # Filtrar simulaciones
-    for i in usefull_iterations:
-        # Almacenar datos válidos en los diccionarios
-        valid_pressures[i] = pressure[i]
-        valid_betweenness_centrality[i] = raw_betweenness_centrality[i]
-        valid_closeness_centrality[i] = raw_closeness_centrality[i]
-        valid_mean_node_pressure[i] = raw_mean_node_pressure[i]
-        valid_mean_t_pressure[i] = mean_t_pressure[i]
-        valid_todini[i] = todini[i]
-        valid_mean_t_wsa[i] = mean_t_wsa[i]
-        valid_mean_t_flowrate[i] = mean_t_flowrate[i]
-        valid_mean_t_demand[i] = mean_t_demand[i]
-        valid_mean_t_leak_demand[i] = mean_t_leak_demand[i]
-        valid_mean_t_total_demand[i] = mean_t_total_demand[i]
-        valid_mean_t_tank_levels[i] = mean_t_tank_levels[i]
-        valid_num_damages[i] = num_damages[i]
-        valid_t_required_satisfied_node_pressure[i] = get_df_gte_threshold(pressure[i], 15)
-        valid_t_min_satisfied_node_pressure[i] = get_df_gte_threshold(pressure[i], 5)
-
-    # Convertir datos válidos a Series/DataFrames y aplicar las transformaciones necesarias
-    pressure = pd.Series(valid_pressures)
-    betweenness_centrality = pd.DataFrame(pd.Series(valid_betweenness_centrality).apply(filter_leak_keys).tolist()).T
-    closeness_centrality = pd.DataFrame(pd.Series(valid_closeness_centrality).apply(filter_leak_keys).tolist()).T
-    mean_node_pressure = pd.DataFrame(pd.Series(valid_mean_node_pressure).apply(filter_leak_keys).tolist()).T
-    mean_t_pressure = pd.DataFrame(valid_mean_t_pressure.values()).T
-    todini = pd.DataFrame(valid_todini.values()).T
-    mean_t_wsa = pd.DataFrame(valid_mean_t_wsa.values()).T
-    mean_t_flowrate = pd.DataFrame(valid_mean_t_flowrate.values()).T
-    mean_t_demand = pd.DataFrame(valid_mean_t_demand.values()).T
-    mean_t_leak_demand = pd.DataFrame(valid_mean_t_leak_demand.values()).T
-    mean_t_total_demand = pd.DataFrame(valid_mean_t_total_demand.values()).T
-    mean_t_tank_levels = pd.DataFrame(valid_mean_t_tank_levels.values()).T
-    num_damages=pd.Series(valid_num_damages)
-    t_required_satisfied_node_pressure = pd.DataFrame(valid_t_required_satisfied_node_pressure).T
-    t_min_satisfied_node_pressure = pd.DataFrame(valid_t_min_satisfied_node_pressure).T
-
-    # Calcular valores promedio en las simulaciones válidas
+    # Rows are in order of completion, iterations are paired by realization id
+    # as in the store
+    if "realization_id" in sim_metrics.columns:
+        sim_metrics = sim_metrics.set_index("realization_id", drop=False)
+    return sim_metrics
+
+def iter_pickle_realizations(sim_metrics: pd.DataFrame, usefull_iterations: set):
+    for i in sorted(usefull_iterations):
+        row = sim_metrics.loc[i]
+        realization = {
+            metric: pd.Series(filter_leak_keys(dict(row[metric])), dtype=float)
+            for metric in NODE_METRICS
+            if metric in row and isinstance(row[metric], (pd.Series, dict))
+        }
+        realization.update(
+            {
+                metric: pd.Series(row[metric], dtype=float)
+                for metric in TIME_METRICS
+                if metric in row and isinstance(row[metric], (pd.Series, dict))
+            }
+        )
+        for metric, threshold in SATISFIED_PRESSURE_THRESHOLDS.items():
+            realization[metric] = get_df_gte_threshold(row["pressure"], threshold)
+        realization["num_damages"] = row.get("num_damages", 0)
+        realization["sampling_weight"] = row.get("sampling_weight", np.nan)
+        yield i, realization
+
+def iter_store_experiment(store_folder: str, usefull_iterations: set):
+    index = load_store_index(store_folder)
+    times = index["times"]
+    node_names = index["node_names"]
+    satisfied_metrics = list(SATISFIED_PRESSURE_THRESHOLDS)
+    # Stores from before the satisfied pressure metrics only have the pressures of
+    # the base nodes, without the Leak_* ones the pickles count
+    stored_satisfied_metrics = [
+        metric for metric in satisfied_metrics
+        if os.path.exists(os.path.join(store_folder, f"{metric}.npy"))
+    ]
+    pressure = load_store_metric(store_folder, "pressure")
+    without_leak_nodes = 0
+    # In the store, iterations are realization ids (row = realization_id - 1)
+    for i, arrays in iter_store_realizations(
+        store_folder,
+        sorted(usefull_iterations),
+        NODE_METRICS + TIME_METRICS + stored_satisfied_metrics + ["num_damages", "sampling_weight"],
+    ):
+        # Metrics never stored are NaN
+        realization = {metric: pd.Series(arrays[metric], index=node_names) for metric in NODE_METRICS}
+        realization.update({metric: pd.Series(arrays[metric], index=times) for metric in TIME_METRICS})
+        for metric, threshold in SATISFIED_PRESSURE_THRESHOLDS.items():
+            values = arrays.get(metric)
+            if values is None or np.isnan(values).all():
+                without_leak_nodes += metric == satisfied_metrics[0]
+                values = (pressure[i - 1] >= threshold).mean(axis=1)
+            realization[metric] = pd.Series(values, index=times)
+        realization["num_damages"] = np.nan_to_num(float(arrays["num_damages"]))
+        realization["sampling_weight"] = float(arrays["sampling_weight"])
+        yield i, realization
+
+    if without_leak_nodes:
+        print(
+            f"\t{store_folder}: satisfied node pressure of {without_leak_nodes} "
+            "realizations from the base nodes only (stored before the Leak_* nodes were counted)"
+        )
+
+def accumulate_realizations(realizations) -> dict:
+    """
+    Running sums of the realizations of (part of) an experiment, weighted by
+    their sampling_weight (all 1 unless they come from importance sampling) and
+    read one at a time, so only the sums are kept in memory. Besides the means,
+    each time metric gets a QuantileSketch for its percentile bands. Aggregates
+    of different parts are combined with merge_aggregates.
+    """
+    aggregate = {"means": {}, "sketches": {}, "num_damages": {}, "weights": {}}
+    for i, realization in realizations:
+        weight = realization.pop("sampling_weight")
+        weight = 1.0 if pd.isna(weight) else float(weight)
+        aggregate["weights"][i] = weight
+        aggregate["num_damages"][i] = realization.pop("num_damages")
+        for metric, values in realization.items():
+            aggregate["means"].setdefault(metric, WeightedMeanAccumulator()).add(values, weight)
+            if metric in TIME_METRICS:
+                if metric not in aggregate["sketches"]:
+                    aggregate["sketches"][metric] = QuantileSketch(values.index)
+                aggregate["sketches"][metric].add(values, weight)
+    return aggregate
+
+def merge_aggregates(aggregate: dict, other: dict) -> dict:
+    for kind in ["means", "sketches"]:
+        for metric, accumulator in other[kind].items():
+            if metric in aggregate[kind]:
+                aggregate[kind][metric].merge(accumulator)
+            else:
+                aggregate[kind][metric] = accumulator
+    aggregate["num_damages"].update(other["num_damages"])
+    aggregate["weights"].update(other["weights"])
+    return aggregate
+
+def summarize_aggregate(aggregate: dict):
+    num_damages = pd.Series(aggregate["num_damages"], dtype=float).sort_index()
+    weights = pd.Series(aggregate["weights"], dtype=float).reindex(num_damages.index)
+    present = num_damages.notna()
     experiment_results = {
-        # Por nodo
-        "betweenness_centrality": betweenness_centrality.mean(axis=1),
-        "closeness_centrality": closeness_centrality.mean(axis=1),
-        "mean_node_pressure": mean_node_pressure.mean(axis=1),
-        # Por tiempo
-        "mean_t_pressure": mean_t_pressure.mean(axis=1),
-        "todini": todini.mean(axis=1),
-        "mean_t_wsa": mean_t_wsa.mean(axis=1),
-        "mean_t_flowrate": mean_t_flowrate.mean(axis=1),
-        "mean_t_demand": mean_t_demand.mean(axis=1),
-        "mean_t_leak_demand": mean_t_leak_demand.mean(axis=1),
-        "mean_t_total_demand": mean_t_total_demand.mean(axis=1),
-        "mean_t_tank_levels": mean_t_tank_levels.mean(axis=1),
-        "t_required_satisfied_node_pressure": t_required_satisfied_node_pressure.mean(),
-        "t_min_satisfied_node_pressure": t_min_satisfied_node_pressure.mean(),
-        # Otro
+        metric: aggregate["means"][metric].mean() if metric in aggregate["means"] else pd.Series(dtype=float)
+        for metric in NODE_METRICS + TIME_METRICS + ["t_required_satisfied_node_pressure", "t_min_satisfied_node_pressure"]
+    }
+    experiment_results.update({
         "num_damages":num_damages,
         "min_num_damages":num_damages.min(),
         "max_num_damages":num_damages.max(),
-        "mean_num_damages":num_damages.mean(),
-    }
-    
+        "mean_num_damages":float(np.average(num_damages[present], weights=weights[present])) if present.any() else np.nan,
+        # Percentiles of each time metric across realizations, see QuantileSketch.quantiles
+        "quantile_sketches":aggregate["sketches"],
+    })
+    return experiment_results
+
+def aggregate_store_realizations(store_folder: str, realization_ids: list[int]) -> dict:
+    return accumulate_realizations(iter_store_experiment(store_folder, realization_ids))
+
+def load_and_process_simulation_results(pickle_route: str, usefull_iterations:set, max_workers: int = 1):
+    """
+    With max_workers > 1, the realizations of a result store are split among a
+    process pool and the aggregates of each worker merged here.
+    """
+    store_folder = get_store_folder(pickle_route)
+    if store_folder is not None:
+        realization_ids = sorted(usefull_iterations)
+        if max_workers <= 1 or len(realization_ids) < 2:
+            experiment_results = summarize_aggregate(aggregate_store_realizations(store_folder, realization_ids))
+        else:
+            chunks = [
+                [int(i) for i in chunk]
+                for chunk in np.array_split(realization_ids, max_workers)
+                if len(chunk)
+            ]
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                aggregates = executor.map(aggregate_store_realizations, [store_folder] * len(chunks), chunks)
+                experiment_results = summarize_aggregate(reduce(merge_aggregates, aggregates))
+        # Filled during the simulation with every valid realization of the
+        # experiment (not only the usefull ones), see PressureHistogram
+        experiment_results["pressure_histogram"] = load_pressure_histogram(store_folder)
+        return experiment_results
+
+    # Cargar los resultados de la simulación desde el archivo pickle
+    sim_metrics = load_pickle_metrics(pickle_route)
+    experiment_results = summarize_aggregate(accumulate_realizations(iter_pickle_realizations(sim_metrics, usefull_iterations)))
+    experiment_results["pressure_histogram"] = None
     return experiment_results
 
 def get_all_iterations(exp_name: str):
@@ -123,56 +208,56 @@ def get_all_iterations(exp_name: str):
     return all_iterations_index
 
 def get_usefull_iterations(exp_name: str, mitigation_strategies:list[str], reinforcement_percents:list[int]):
-    negative_pressure_iterations = set()
     path = f"results/{exp_name}"
-    
-    # =========================================================================================================
-    # =========================================== Simple  Eartquake ===========================================
-    # =========================================================================================================
-    folder = "base_earthquake"
-
-    # Cargar los resultados de la simulación
-    pickle_route = f"{path}/{folder}/metrics.pickle"
-
-    update_negative_pressure_iterations(pickle_route,negative_pressure_iterations)
-    all_iterations_index = get_all_iterations_index(pickle_route)
+    pickle_routes = [f"{path}/base_earthquake/metrics.pickle"] + [
+        f"{path}/{mitigation_strategy_name}_at_{reinforcement_percent}/results.pickle"
+        for mitigation_strategy_name in mitigation_strategies
+        for reinforcement_percent in reinforcement_percents
+    ]
 
-    # =========================================================================================================
-    # ========================================= Mitigated  Eartquakes =========================================
-    # =========================================================================================================
-    for mitigation_strategy_name in mitigation_strategies:
-        for reinforcement_percent in reinforcement_percents:
-            folder = f"{mitigation_strategy_name}_at_{reinforcement_percent}"
+    all_iterations_index = None
+    negative_pressure_iterations = set()
+    for pickle_route in pickle_routes:
+        iterations, negative_iterations = get_experiment_iterations(pickle_route)
+        negative_pressure_iterations |= negative_iterations
+        # With adaptive sampling each experiment may stop at a different
+        # realization, only the damage draws simulated by all of them are paired
+        all_iterations_index = (
+            iterations if all_iterations_index is None else all_iterations_index & iterations
+        )
 
-            # Cargar los resultados de la simulación
-            pickle_route = f"{path}/{folder}/results.pickle"
-            update_negative_pressure_iterations(pickle_route,negative_pressure_iterations)
-    
     return all_iterations_index - negative_pressure_iterations
 
-def get_all_iterations_index(pickle_route: str):
-    all_iterations = set()
-    with open(pickle_route, "rb") as f:
-        sim_metrics = pickle.load(f)
-    pressure = sim_metrics.get("pressure", None)
-
-    for i in pressure.index:
-        all_iterations.add(i)
-    return all_iterations
-
-def update_negative_pressure_iterations(pickle_route: str, negative_pressure_iterations:set[int]):
-    # Cargar los resultados de la simulación desde el archivo pickle
-    with open(pickle_route, "rb") as f:
-        sim_metrics = pickle.load(f)
-    pressure = sim_metrics.get("pressure", None)
+def get_experiment_iterations(pickle_route: str) -> tuple[set, set]:
+    """
+    Iterations of an experiment and the ones with a negative pressure, from its
+    scalar metrics only (the pressures aren't read).
+    """
+    store_folder = get_store_folder(pickle_route)
+    if store_folder is not None:
+        # min_system_pressure also covers the Leak_* nodes left out of the store
+        min_system_pressure = load_store_metric(store_folder, "min_system_pressure")
+        realization_ids = get_store_realization_ids(store_folder)
+        negative = {i for i in realization_ids if min_system_pressure[i - 1] < 0}
+        return set(realization_ids), negative
+
+    sim_metrics = load_pickle_metrics(pickle_route)
+    negative = set()
+    for i, row in sim_metrics.iterrows():
+        # Realizations stopped at their first negative pressure have no pressure
+        if "invalid_at" in row and pd.notna(row["invalid_at"]):
+            negative.add(i)
+        elif "min_system_pressure" in row and pd.notna(row["min_system_pressure"]):
+            if row["min_system_pressure"] < 0:
+                negative.add(i)
+        elif (pd.DataFrame(row["pressure"]) < 0).any().any():
+            negative.add(i)
+    return set(sim_metrics.index), negative
 
-    for i in pressure.index:
-        pressure_df = pd.DataFrame(pressure[i])
-        if (pressure_df < 0).any().any():
-            negative_pressure_iterations.add(i)
-    
+def get_all_iterations_index(pickle_route: str):
+    return get_experiment_iterations(pickle_route)[0]
 
-def get_experiments_results(exp_name: str, mitigation_strategies:list[str], reinforcement_percents:list[int], usefull_iterations:set):
+def get_experiments_results(exp_name: str, mitigation_strategies:list[str], reinforcement_percents:list[int], usefull_iterations:set, max_workers: int = 1):
     results = {}
     path = f"results/{exp_name}"
 
@@ -184,10 +269,12 @@ def get_experiments_results(exp_name: str, mitigation_strategies:list[str], rein
     # Cargar los resultados de la simulación
     pickle_route = f"{path}/{folder}/metrics.pickle"
     
-    # wn pickle route
+    # wn pickle route (or the simulation archive holding it)
     wn_pickle_route = f"{path}/{folder}/simulation_data/wn_realization_1.pickle"
+    if not os.path.exists(wn_pickle_route):
+        wn_pickle_route = get_archive_path(f"{path}/{folder}/simulation_data", 1)
 
-    experiment_results = load_and_process_simulation_results(pickle_route, [0])
+    experiment_results = load_and_process_simulation_results(pickle_route, get_all_iterations_index(pickle_route), max_workers)
     experiment_results["wn_pickle_route"] = wn_pickle_route
 
     results[folder] = experiment_results
@@ -203,7 +290,7 @@ def get_experiments_results(exp_name: str, mitigation_strategies:list[str], rein
     # Cargar los resultados de la simulación
     pickle_route = f"{path}/{folder}/metrics.pickle"
 
-    experiment_results = load_and_process_simulation_results(pickle_route, usefull_iterations)
+    experiment_results = load_and_process_simulation_results(pickle_route, usefull_iterations, max_workers)
 
     results[folder] = experiment_results
     print(f"{folder} \n\tmin_num_damages: {experiment_results['min_num_damages']}")
@@ -220,7 +307,7 @@ def get_experiments_results(exp_name: str, mitigation_strategies:list[str], rein
             # Cargar los resultados de la simulación
             pickle_route = f"{path}/{folder}/results.pickle"
             
-            experiment_results = load_and_process_simulation_results(pickle_route, usefull_iterations)
+            experiment_results = load_and_process_simulation_results(pickle_route, usefull_iterations, max_workers)
 
             results[folder] = experiment_results
             print(f"{folder} \n\tmin_num_damages: {experiment_results['min_num_damages']}")
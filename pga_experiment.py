@@ -1,11 +1,15 @@
 import time
 from datetime import datetime
 import os
+import pickle
 import numpy as np
 import pandas as pd
 
 from utils.general_utils import format_time, generate_excels
+from utils.leaks_utils import get_damage_states
 from utils.main_simulation_functions import simulate_network_parallel
+from utils.catalog_utils import summarize_run
+from utils.types import MitigationLeaksStrategyOptions
 
 # =================================== INITIAL PARAMS ===================================
 max_workers = 8
@@ -19,6 +23,13 @@ leak_start_time = 5 * 3600  # seconds
 # mitigation_strategy can be any of "betweenness"|"closeness"|"pressure"|"node_degree"
 mitigation_strategy = ""
 reinforcement_percent = 3
+# Priority nodes pickle of a full experiment (required for mitigation)
+priority_nodes_filename = None
+# "metrics_only" skips charts, raw data dumps and topology analytics
+run_profile = "metrics_only"
+# SQLite catalog with the scalars of every realization, see utils/catalog_utils.py
+# (None to not keep one)
+catalog_file = "results/catalog.sqlite"
 
 # PGA range for the experiment
 pga_range = np.arange(0.15, 0.36, 0.01)  # PGA values from 0.15 to 0.35 in steps of 0.01
@@ -43,6 +54,16 @@ if __name__ == "__main__":
 
     all_experiments_results = []
 
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None = None
+    if mitigation_strategy != "":
+        with open(priority_nodes_filename, "rb") as f:
+            priority_nodes = pickle.load(f)
+        mitigation_leaks_strategy_options = {
+            "mitigation_strategy": mitigation_strategy,
+            "reinforcement_percent": reinforcement_percent,
+            "priority_nodes": priority_nodes,
+        }
+
     # Loop over each PGA value in the specified range
     for pga_value in pga_range:
         pga_value=round(pga_value,2)
@@ -50,43 +71,39 @@ if __name__ == "__main__":
         os.makedirs(output_folder, exist_ok=True)
         print(f"Running experiment for PGA: {pga_value:.2f}")
 
+        # Same PGA for all iterations
+        pga_and_damage_states_list = get_damage_states(
+            [pga_value] * iterations_per_pga, inp_file
+        )
+
         # Run the specified number of iterations for each PGA value
         results = simulate_network_parallel(
+            simulation_type="Earthquake",
             inp_file=inp_file,
+            mitigation_leaks_strategy_options=mitigation_leaks_strategy_options,
             leak_start_time=leak_start_time,
             required_pressure=required_pressure,
             num_realizations=iterations_per_pga,
-            pga_values=[pga_value] * iterations_per_pga,  # Same PGA for all iterations
+            pga_values_and_damage_states=pga_and_damage_states_list,
             max_workers=max_workers,
             total_duration=total_duration,
             minimum_pressure=minimum_pressure,
             output_folder=output_folder,
-            mitigation_strategy=mitigation_strategy,
-            reinforcement_percent=reinforcement_percent,
+            run_profile=run_profile,
+            catalog_file=catalog_file,
         )
 
         # Analyze results for this PGA
-        num_iterations_with_negative_pressure = 0
-        min_pressure_all_iterations = float("inf")
-
-        for _, row in results.iterrows():
-            if "error" in row and pd.notna(row["error"]):
-                continue  # Skip erroneous iterations
-
-            # Find the minimum pressure across all nodes in this iteration
-            min_pressure = row["min_system_pressure"]
-            min_pressure_all_iterations = min(min_pressure_all_iterations, min_pressure)
-
-            # Check if there's any negative pressure in this iteration
-            if min_pressure < 0:
-                num_iterations_with_negative_pressure += 1
+        run_summary = summarize_run(
+            catalog_file, output_folder, results, "min_system_pressure"
+        )
 
         # Save experiment results for this PGA
         experiment_result = {
             "pga": pga_value,
             "num_iterations": iterations_per_pga,
-            "min_pressure": min_pressure_all_iterations,
-            "negative_pressure_count": num_iterations_with_negative_pressure,
+            "min_pressure": run_summary["min_pressure"],
+            "negative_pressure_count": run_summary["negative_pressure_count"],
         }
         all_experiments_results.append(experiment_result)
 
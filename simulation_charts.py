@@ -1,8 +1,8 @@
 import wntr
-import pickle
 import matplotlib.pyplot as plt
 from wntr.network import WaterNetworkModel
 from generate_experiment_data import get_exp_verbose_name
+from utils.archive_utils import load_network_file
 import os
 from typing import Literal
 
@@ -13,8 +13,16 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
     plots_folder = os.path.join("results", exp_name, "plots")
     os.makedirs(plots_folder, exist_ok=True)
 
-    with open(wn_no_earthquake_route, "rb") as f:
-        wn_no_earthquake = pickle.load(f)
+    wn_no_earthquake = load_network_file(wn_no_earthquake_route)
+
+    # The exceedance maps of the reference experiments are the same for every
+    # strategy, so they are drawn once into the plots folder
+    plot_pressure_exceedance_maps(
+        plots_folder,
+        "",
+        wn_no_earthquake,
+        get_pressure_histograms(exp_results, REFERENCE_EXPERIMENTS),
+    )
 
     for experiment in mitigation_strategies:
         print(f"Generating plots for {experiment}")
@@ -64,7 +72,8 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
             mean_t_pressure_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_pressure"]
 
         plot_experiment_mean_t_pressure(
-            plots_folder, experiment, mean_t_pressure_data)
+            plots_folder, experiment, mean_t_pressure_data,
+            get_percentile_bands(exp_results, mean_t_pressure_data, "mean_t_pressure"))
 
         # todini
         todini_data = {
@@ -74,7 +83,9 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
         for i in reinforcement_percents:
             todini_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["todini"]
 
-        plot_experiment_todini(plots_folder, experiment, todini_data)
+        plot_experiment_todini(
+            plots_folder, experiment, todini_data,
+            get_percentile_bands(exp_results, todini_data, "todini"))
 
         # mean_t_wsa
         mean_t_wsa_data = {
@@ -84,7 +95,9 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
         for i in reinforcement_percents:
             mean_t_wsa_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_wsa"]
 
-        plot_experiment_mean_t_wsa(plots_folder, experiment, mean_t_wsa_data)
+        plot_experiment_mean_t_wsa(
+            plots_folder, experiment, mean_t_wsa_data,
+            get_percentile_bands(exp_results, mean_t_wsa_data, "mean_t_wsa"))
 
         # mean_t_flowrate
         mean_t_flowrate_data = {
@@ -95,7 +108,8 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
             mean_t_flowrate_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_flowrate"]
 
         plot_experiment_mean_t_flowrate(
-            plots_folder, experiment, mean_t_flowrate_data)
+            plots_folder, experiment, mean_t_flowrate_data,
+            get_percentile_bands(exp_results, mean_t_flowrate_data, "mean_t_flowrate"))
 
         # mean_t_demand
         mean_t_demand_data = {
@@ -106,7 +120,8 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
             mean_t_demand_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_demand"]
 
         plot_experiment_aggregated_t_demand(
-            plots_folder, experiment, mean_t_demand_data, "normal")
+            plots_folder, experiment, mean_t_demand_data, "normal",
+            get_percentile_bands(exp_results, mean_t_demand_data, "mean_t_demand"))
 
         # mean_t_tank_levels
         mean_t_tank_levels_data = {
@@ -117,7 +132,8 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
             mean_t_tank_levels_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_tank_levels"]
 
         plot_experiment_mean_t_tank_levels(
-            plots_folder, experiment, mean_t_tank_levels_data
+            plots_folder, experiment, mean_t_tank_levels_data,
+            get_percentile_bands(exp_results, mean_t_tank_levels_data, "mean_t_tank_levels"),
         )
 
         # t_min_satisfied_node_pressure
@@ -153,7 +169,8 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
             mean_t_leak_demand_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_leak_demand"]
 
         plot_experiment_aggregated_t_demand(
-            plots_folder, experiment, mean_t_leak_demand_data, "leak")
+            plots_folder, experiment, mean_t_leak_demand_data, "leak",
+            get_percentile_bands(exp_results, mean_t_leak_demand_data, "mean_t_leak_demand"))
 
         # mean_t_total_demand
         mean_t_total_demand_data = {
@@ -164,10 +181,56 @@ def generate_plots(exp_name: str, exp_results: dict, mitigation_strategies: list
             mean_t_total_demand_data[f"{experiment}_at_{i}"] = exp_results[f"{experiment}_at_{i}"]["mean_t_total_demand"]
 
         plot_experiment_aggregated_t_demand(
-            plots_folder, experiment, mean_t_total_demand_data, "total")
+            plots_folder, experiment, mean_t_total_demand_data, "total",
+            get_percentile_bands(exp_results, mean_t_total_demand_data, "mean_t_total_demand"))
+
+        # Pressure exceedance maps of the strategy's experiments
+        plot_pressure_exceedance_maps(
+            plots_folder,
+            experiment,
+            wn_no_earthquake,
+            get_pressure_histograms(
+                exp_results,
+                [f"{experiment}_at_{i}" for i in reinforcement_percents],
+            ),
+        )
 
 
 # =============================================================================
+# Percentiles of the band drawn around the mean curves of each experiment
+PERCENTILE_BAND = (0.05, 0.95)
+
+
+def get_percentile_bands(exp_results: dict, keys: list[str], metric: str) -> dict:
+    """
+    Lower and upper PERCENTILE_BAND percentiles of a time metric across the
+    realizations of each experiment, from its quantile sketch (experiments
+    processed before the sketches have no band).
+    """
+    bands = {}
+    for key in keys:
+        sketch = exp_results[key].get("quantile_sketches", {}).get(metric)
+        if sketch is not None:
+            bands[key] = sketch.quantiles(list(PERCENTILE_BAND))
+    return bands
+
+
+def plot_time_series(ax, data: dict, bands: dict | None = None):
+    for key, serie in data.items():
+        label = get_exp_verbose_name(key)
+        (line,) = ax.plot(serie.index / 3600, serie.values, label=label)
+        if bands is not None and key in bands:
+            band = bands[key]
+            ax.fill_between(
+                band.index / 3600,
+                band[PERCENTILE_BAND[0]],
+                band[PERCENTILE_BAND[1]],
+                color=line.get_color(),
+                alpha=0.15,
+                linewidth=0,
+            )
+
+
 def plot_experiment_betweenness_centrality(
     base_path: str,
     exp_name: str,
@@ -284,19 +347,99 @@ def plot_experiment_mean_node_pressure(
         plt.close(fig)
 
 
+# Pressures [m.c.a] of the exceedance maps: minimum and required pressure
+EXCEEDANCE_THRESHOLDS = [5, 15]
+# Experiments shared by every mitigation strategy
+REFERENCE_EXPERIMENTS = ["no_earthquake", "base_earthquake"]
+
+
+def get_pressure_histograms(exp_results: dict, keys: list[str]) -> dict:
+    # Only experiments processed with a pressure histogram have exceedance maps
+    return {
+        key: exp_results[key]["pressure_histogram"]
+        for key in keys
+        if exp_results[key].get("pressure_histogram") is not None
+    }
+
+
+def plot_pressure_exceedance_maps(
+    base_path: str, exp_name: str, wn: WaterNetworkModel, data: dict
+):
+    for threshold in EXCEEDANCE_THRESHOLDS:
+        for mode in ["probability", "time"]:
+            plot_experiment_pressure_exceedance(
+                base_path, exp_name, wn, data, threshold, mode
+            )
+
+
+def plot_experiment_pressure_exceedance(
+    base_path: str,
+    exp_name: str,
+    wn: WaterNetworkModel,
+    data: dict,
+    threshold: float,
+    mode: Literal["probability", "time"],
+):
+    """
+    Map of each experiment's PressureHistogram: the probability that every node
+    keeps at least threshold during the whole realization, or the mean fraction
+    of the time it does.
+    """
+    experiment_folder = os.path.join(base_path, exp_name)
+    os.makedirs(experiment_folder, exist_ok=True)
+
+    title_fontsize, text_fontsize, fig_size, node_size = 12, 10, (6, 8), 12
+    title = {
+        "probability": f"Probabilidad de presión sobre {threshold} m.c.a",
+        "time": f"Tiempo con presión sobre {threshold} m.c.a",
+    }[mode]
+
+    for key, histogram in data.items():
+        if mode == "probability":
+            serie = histogram.exceedance_probability(threshold)
+        else:
+            serie = histogram.time_above(threshold)
+
+        label = get_exp_verbose_name(key)
+        fig, ax = plt.subplots(figsize=fig_size)
+        fig.suptitle(title, fontsize=title_fontsize)
+        plt.figtext(
+            0.5,
+            0.94,
+            f"Experimento: {label}",
+            ha="center",
+            fontsize=text_fontsize,
+            style="italic",
+        )
+        wntr.graphics.plot_network(
+            wn,
+            ax=ax,
+            node_size=node_size,
+            node_attribute=serie.dropna(),
+            node_colorbar_label="[-]",
+            node_range=[0, 1],
+        )
+
+        fig.savefig(
+            f"{experiment_folder}/{key}_pressure_{mode}_above_{threshold}.png",
+            format="png",
+            dpi=150,
+        )
+        plt.close(fig)
+
+
 def plot_experiment_mean_t_pressure(
     base_path: str,
     exp_name: str,
     data: dict,
+    bands: dict | None = None,
 ):
     experiment_folder = os.path.join(base_path, exp_name)
     os.makedirs(experiment_folder, exist_ok=True)
 
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data, bands)
     fig.suptitle(
         "Presión de la red promedio", fontsize=suptitle_fontsize
     )  # fontweight='bold'
@@ -327,15 +470,14 @@ def plot_experiment_todini(
     base_path: str,
     exp_name: str,
     data: dict,
+    bands: dict | None = None,
 ):
     experiment_folder = os.path.join(base_path, exp_name)
     os.makedirs(experiment_folder, exist_ok=True)
 
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data, bands)
     fig.suptitle(
         "Índice de Todini promedio", fontsize=suptitle_fontsize
     )  # fontweight='bold'
@@ -365,15 +507,14 @@ def plot_experiment_mean_t_wsa(
     base_path: str,
     exp_name: str,
     data: dict,
+    bands: dict | None = None,
 ):
     experiment_folder = os.path.join(base_path, exp_name)
     os.makedirs(experiment_folder, exist_ok=True)
 
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data, bands)
     # fontweight='bold'
     fig.suptitle("WSA red promedio", fontsize=suptitle_fontsize)
     plt.figtext(
@@ -402,15 +543,14 @@ def plot_experiment_mean_t_flowrate(
     base_path: str,
     exp_name: str,
     data: dict,
+    bands: dict | None = None,
 ):
     experiment_folder = os.path.join(base_path, exp_name)
     os.makedirs(experiment_folder, exist_ok=True)
 
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data, bands)
     # fontweight='bold'
     fig.suptitle("Caudal promedio", fontsize=suptitle_fontsize)
     plt.figtext(
@@ -440,7 +580,8 @@ def plot_experiment_aggregated_t_demand(
     base_path: str,
     exp_name: str,
     data: dict,
-    mode: Literal["leak", "normal", "total"]
+    mode: Literal["leak", "normal", "total"],
+    bands: dict | None = None,
 ):
     experiment_folder = os.path.join(base_path, exp_name)
     os.makedirs(experiment_folder, exist_ok=True)
@@ -453,9 +594,7 @@ def plot_experiment_aggregated_t_demand(
     
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data, bands)
     # fontweight='bold'
     fig.suptitle(f"Demanda{esp_mode[mode]} agregada", fontsize=suptitle_fontsize)
     plt.figtext(
@@ -485,15 +624,14 @@ def plot_experiment_mean_t_tank_levels(
     base_path: str,
     exp_name: str,
     data: dict,
+    bands: dict | None = None,
 ):
     experiment_folder = os.path.join(base_path, exp_name)
     os.makedirs(experiment_folder, exist_ok=True)
 
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data, bands)
     # fontweight='bold'
     fig.suptitle("Nivel del estanque", fontsize=suptitle_fontsize)
     plt.figtext(
@@ -535,9 +673,7 @@ def plot_experiment_t_satisfied_node_pressure(
 
     suptitle_fontsize, title_fontsize, fig_size = 12, 10, (7, 4)
     fig, ax = plt.subplots(figsize=fig_size)
-    for key, serie in data.items():
-        label = get_exp_verbose_name(key)
-        ax.plot(serie.index / 3600, serie.values, label=label)
+    plot_time_series(ax, data)
     # fontweight='bold'
     fig.suptitle(f"Presión de nodos satisfecha con respecto a la {esp_mode[mode]}", fontsize=suptitle_fontsize)
     plt.figtext(
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.aggregation_utils import QuantileSketch, WeightedMeanAccumulator
+
+
+def test_weighted_mean_skips_nan():
+    accumulator = WeightedMeanAccumulator()
+    accumulator.add(pd.Series([1.0, np.nan], index=["a", "b"]), weight=1)
+    accumulator.add(pd.Series([4.0, 2.0], index=["a", "b"]), weight=2)
+
+    mean = accumulator.mean()
+    assert mean["a"] == pytest.approx((1 + 2 * 4) / 3)
+    assert mean["b"] == pytest.approx(2.0)
+
+
+def test_weighted_mean_extends_to_new_labels():
+    accumulator = WeightedMeanAccumulator()
+    accumulator.add(pd.Series([1.0], index=["a"]))
+    accumulator.add(pd.Series([3.0, 5.0], index=["a", "c"]))
+
+    mean = accumulator.mean()
+    assert mean["a"] == pytest.approx(2.0)
+    assert mean["c"] == pytest.approx(5.0)
+
+
+def test_merged_accumulators_match_a_single_one():
+    rng = np.random.default_rng(0)
+    samples = [
+        (pd.Series(rng.normal(size=5), index=list("abcde")), rng.uniform(0.5, 2))
+        for _ in range(10)
+    ]
+    single, first, second = (WeightedMeanAccumulator() for _ in range(3))
+    for i, (values, weight) in enumerate(samples):
+        single.add(values, weight)
+        (first if i % 2 else second).add(values, weight)
+    first.merge(second)
+
+    pd.testing.assert_series_equal(first.mean(), single.mean())
+
+
+def test_empty_weighted_mean():
+    accumulator = WeightedMeanAccumulator()
+    accumulator.merge(WeightedMeanAccumulator())
+    assert accumulator.mean().empty
+
+
+def fill_sketch(sketch: QuantileSketch, samples: np.ndarray):
+    for values in samples:
+        sketch.add(pd.Series(values, index=sketch.labels))
+
+
+def test_quantiles_within_relative_accuracy():
+    rng = np.random.default_rng(0)
+    # Positive, negative and mixed sign labels, over several orders of magnitude
+    samples = np.column_stack(
+        [
+            rng.lognormal(0, 2, size=500),
+            -rng.lognormal(3, 1, size=500),
+            rng.normal(0, 10, size=500),
+        ]
+    )
+    sketch = QuantileSketch(["a", "b", "c"], relative_accuracy=0.01)
+    fill_sketch(sketch, samples)
+
+    probabilities = [0.05, 0.25, 0.5, 0.75, 0.95]
+    quantiles = sketch.quantiles(probabilities)
+    for probability in probabilities:
+        expected = np.quantile(samples, probability, axis=0, method="inverted_cdf")
+        np.testing.assert_allclose(quantiles[probability], expected, rtol=0.01)
+
+
+def test_quantiles_stay_within_the_values_seen():
+    sketch = QuantileSketch(["a", "b"])
+    fill_sketch(sketch, np.array([[0.0, 5.0], [0.0, 5.0]]))
+    sketch.add(pd.Series([np.nan, 5.0], index=["a", "b"]))
+
+    quantiles = sketch.quantiles([0.0, 1.0])
+    assert (quantiles.loc["a"] == 0.0).all()
+    assert (quantiles.loc["b"] == 5.0).all()
+
+
+def test_quantiles_of_labels_without_values_are_nan():
+    sketch = QuantileSketch(["a", "b"])
+    sketch.add(pd.Series([1.0], index=["a"]))
+
+    assert sketch.quantiles([0.5])[0.5].isna().tolist() == [False, True]
+
+
+def test_merged_sketches_match_a_single_one():
+    samples = np.random.default_rng(1).normal(0, 5, size=(200, 4))
+    single, first, second = (QuantileSketch(list("abcd")) for _ in range(3))
+    fill_sketch(single, samples)
+    fill_sketch(first, samples[:80])
+    fill_sketch(second, samples[80:])
+    first.merge(second)
+
+    probabilities = [0.1, 0.5, 0.9]
+    pd.testing.assert_frame_equal(
+        first.quantiles(probabilities), single.quantiles(probabilities)
+    )
+
+
+def test_sketches_with_other_labels_do_not_merge():
+    with pytest.raises(ValueError):
+        QuantileSketch(["a"]).merge(QuantileSketch(["b"]))
+    with pytest.raises(ValueError):
+        QuantileSketch(["a"]).merge(QuantileSketch(["a"], relative_accuracy=0.01))
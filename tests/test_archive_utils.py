@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import wntr
+
+from utils.archive_utils import (
+    get_archive_path,
+    load_archive_index,
+    load_archive_results,
+    load_archive_variable,
+    load_network_file,
+    save_simulation_archive,
+)
+
+
+@pytest.fixture(scope="module")
+def simulation():
+    wn = wntr.network.WaterNetworkModel()
+    wn.add_reservoir("R1", base_head=50)
+    wn.add_junction("J1", base_demand=0.01, elevation=10)
+    wn.add_junction("J2", base_demand=0.005, elevation=5)
+    wn.add_pipe("P1", "R1", "J1", length=100, diameter=0.3, roughness=100)
+    wn.add_pipe("P2", "J1", "J2", length=200, diameter=0.2, roughness=100)
+    wn.options.time.duration = 2 * 3600
+    return wn, wntr.sim.WNTRSimulator(wn).run_sim()
+
+
+def test_archive_path_is_sharded(tmp_path):
+    assert get_archive_path(str(tmp_path), 1).endswith("000/realization_1.zip")
+    assert get_archive_path(str(tmp_path), 101).endswith("001/realization_101.zip")
+
+
+def test_archive_round_trip(tmp_path, simulation):
+    wn, simulation_results = simulation
+    archive_path = get_archive_path(str(tmp_path), 1)
+    save_simulation_archive(archive_path, wn, simulation_results)
+
+    loaded = load_archive_results(archive_path)
+    for element in ["node", "link"]:
+        original = getattr(simulation_results, element)
+        assert set(getattr(loaded, element)) == set(original)
+        for variable, values in original.items():
+            pd.testing.assert_frame_equal(
+                getattr(loaded, element)[variable],
+                values,
+                check_dtype=False,
+                check_names=False,
+                check_index_type=False,
+                check_column_type=False,
+                rtol=1e-6,  # Floats are stored as float32
+                atol=1e-6,
+            )
+
+    # No leaks: leak_demand is all zero and stored sparse
+    index = load_archive_index(archive_path)
+    assert index["variables"]["node"]["leak_demand"] == "sparse"
+    assert (load_archive_variable(archive_path, "node", "leak_demand") == 0).all().all()
+
+    loaded_wn = load_network_file(archive_path)
+    assert loaded_wn.node_name_list == wn.node_name_list
+    assert loaded_wn.link_name_list == wn.link_name_list
+    assert np.isclose(loaded_wn.get_link("P2").length, 200)
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from utils.checkpoint_utils import (
+    load_checkpoints,
+    save_checkpoint,
+    write_file_atomically,
+)
+
+
+def test_write_file_atomically_replaces_content(tmp_path):
+    filename = tmp_path / "data.bin"
+    write_file_atomically(str(filename), b"old")
+    write_file_atomically(str(filename), b"new content")
+
+    assert filename.read_bytes() == b"new content"
+    # No temporary file is left behind
+    assert os.listdir(tmp_path) == ["data.bin"]
+
+
+def test_write_file_atomically_keeps_previous_content_on_failure(tmp_path, monkeypatch):
+    filename = tmp_path / "data.bin"
+    write_file_atomically(str(filename), b"old")
+
+    def failing_replace(*args):
+        raise OSError("interrupted")
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        write_file_atomically(str(filename), b"new")
+
+    assert filename.read_bytes() == b"old"
+
+
+def test_checkpoints_round_trip_without_failed_realizations(tmp_path):
+    checkpoint_folder = str(tmp_path / "checkpoints")
+    for realization_id in [2, 1]:
+        save_checkpoint(
+            checkpoint_folder, {"realization_id": realization_id, "pga": 0.1}
+        )
+    save_checkpoint(checkpoint_folder, {"realization_id": 3, "error": "failed"})
+    # Leftover of an interrupted write
+    (tmp_path / "checkpoints" / "realization_4.pickle.123.tmp").write_bytes(b"")
+
+    checkpoints = list(load_checkpoints(checkpoint_folder))
+
+    assert sorted(c["realization_id"] for c in checkpoints) == [1, 2]
+    assert all(c["pga"] == 0.1 for c in checkpoints)
+
+
+def test_load_checkpoints_without_folder(tmp_path):
+    assert list(load_checkpoints(str(tmp_path / "missing"))) == []
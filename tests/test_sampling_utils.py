@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from utils.sampling_utils import RunningMean
+
+
+def test_running_mean_matches_numpy():
+    values = np.random.default_rng(0).normal(10, 2, size=200)
+    running_mean = RunningMean()
+    for value in values:
+        running_mean.add(value)
+
+    assert running_mean.count == 200
+    assert running_mean.effective_count == pytest.approx(200)
+    assert running_mean.mean == pytest.approx(values.mean())
+    assert running_mean.variance == pytest.approx(values.var(ddof=1))
+
+
+def test_weighted_running_mean():
+    rng = np.random.default_rng(1)
+    values = rng.normal(size=100)
+    weights = rng.uniform(0.5, 2, size=100)
+    running_mean = RunningMean()
+    for value, weight in zip(values, weights):
+        running_mean.add(value, weight)
+
+    assert running_mean.mean == pytest.approx(np.average(values, weights=weights))
+    assert running_mean.effective_count == pytest.approx(
+        weights.sum() ** 2 / (weights**2).sum()
+    )
+
+
+def test_half_width():
+    running_mean = RunningMean()
+    assert running_mean.half_width(0.95) == np.inf
+    running_mean.add(1.0)
+    assert running_mean.half_width(0.95) == np.inf
+
+    for value in [2.0, 3.0, 4.0]:
+        running_mean.add(value)
+    expected = 1.959964 * np.sqrt(np.var([1, 2, 3, 4], ddof=1) / 4)
+    assert running_mean.half_width(0.95) == pytest.approx(expected, rel=1e-6)
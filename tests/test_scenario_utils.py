@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from utils.scenario_utils import get_scenario_fingerprint
+
+SCENARIO = {
+    "network_hash": "abc",
+    "simulation_type": "Earthquake",
+    "leak_start_time": 3600,
+    "pipe_names": ["P1", "P2"],
+    "leak_areas": np.array([1e-3, 2e-3]),
+    "stop_on_negative_pressure": False,
+    "shared_prefix": False,
+}
+
+
+def test_fingerprint_ignores_the_order_of_the_leaks():
+    reordered = {
+        **SCENARIO,
+        "pipe_names": ["P2", "P1"],
+        "leak_areas": np.array([2e-3, 1e-3]),
+    }
+    assert get_scenario_fingerprint(**SCENARIO) == get_scenario_fingerprint(
+        **reordered
+    )
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"network_hash": "abd"},
+        {"simulation_type": "Clean"},
+        {"leak_start_time": 7200},
+        {"pipe_names": ["P1", "P3"]},
+        {"leak_areas": np.array([1e-3, np.nextafter(2e-3, 1)])},
+        {"stop_on_negative_pressure": True},
+        {"shared_prefix": True},
+    ],
+)
+def test_fingerprint_changes_with_what_the_solve_depends_on(changes):
+    assert get_scenario_fingerprint(**SCENARIO) != get_scenario_fingerprint(
+        **{**SCENARIO, **changes}
+    )
@@ -0,0 +1,257 @@
+import numpy as np
+import pandas as pd
+
+
+class WeightedMeanAccumulator:
+    """
+    Weighted mean across realizations of a labelled metric (per node or per
+    time), skipping NaN like nanmean. Realizations are added one at a time, so
+    only their running sums are kept, and accumulators filled separately (e.g.
+    by different processes) can be merged.
+    """
+
+    def __init__(self):
+        self.weighted_sums = None
+        self.weight_sums = None
+
+    def _add_sums(self, weighted_sums: pd.Series, weight_sums: pd.Series):
+        if self.weighted_sums is None:
+            self.weighted_sums, self.weight_sums = weighted_sums, weight_sums
+            return
+        # Realizations with other labels (e.g. older pickles) extend the union
+        self.weighted_sums = self.weighted_sums.add(weighted_sums, fill_value=0)
+        self.weight_sums = self.weight_sums.add(weight_sums, fill_value=0)
+
+    def add(self, values: pd.Series, weight: float = 1.0):
+        values = values.astype(float)
+        present = values.notna()
+        self._add_sums(
+            values.where(present, 0.0) * weight, present.astype(float) * weight
+        )
+
+    def merge(self, other: "WeightedMeanAccumulator"):
+        if other.weighted_sums is not None:
+            self._add_sums(other.weighted_sums, other.weight_sums)
+
+    def mean(self) -> pd.Series:
+        if self.weighted_sums is None:
+            return pd.Series(dtype=float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.weighted_sums / self.weight_sums
+
+
+class _LogBuckets:
+    """
+    Weights of a QuantileSketch falling in each logarithmic bucket, one row per
+    label, for the magnitudes of the values of one sign. Columns are bucket
+    keys from offset on, grown as new keys appear.
+    """
+
+    def __init__(self, num_labels: int):
+        self.offset = 0
+        self.counts = np.zeros((num_labels, 0))
+
+    def _extend(self, min_key: int, max_key: int):
+        if self.counts.shape[1] == 0:
+            self.offset = min_key
+            self.counts = np.zeros((len(self.counts), max_key - min_key + 1))
+            return
+        pad_before = max(self.offset - min_key, 0)
+        pad_after = max(max_key - (self.offset + self.counts.shape[1] - 1), 0)
+        if pad_before or pad_after:
+            self.counts = np.pad(self.counts, ((0, 0), (pad_before, pad_after)))
+            self.offset -= pad_before
+
+    def add(self, rows: np.ndarray, keys: np.ndarray, weight: float):
+        if len(keys) == 0:
+            return
+        self._extend(int(keys.min()), int(keys.max()))
+        np.add.at(self.counts, (rows, keys - self.offset), weight)
+
+    def merge(self, other: "_LogBuckets"):
+        if other.counts.shape[1] == 0:
+            return
+        self._extend(other.offset, other.offset + other.counts.shape[1] - 1)
+        start = other.offset - self.offset
+        self.counts[:, start : start + other.counts.shape[1]] += other.counts
+
+
+class QuantileSketch:
+    """
+    Streaming weighted quantiles across realizations of a curve (one per label,
+    e.g. per time), in the manner of DDSketch: every value falls in a
+    logarithmic bucket of its magnitude, so any quantile is known within
+    relative_accuracy whatever the scale of the metric, and the memory only
+    grows with the log of the range of the values, not with the number of
+    realizations. Sketches with the same labels and accuracy are merged by
+    adding their buckets. The exact minimum and maximum of each label are kept
+    too, so quantiles never fall outside the values seen.
+    """
+
+    # Magnitudes below it count as zero
+    MIN_VALUE = 1e-12
+
+    def __init__(self, labels: list, relative_accuracy: float = 0.005):
+        self.labels = pd.Index(labels)
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.positive = _LogBuckets(len(self.labels))
+        self.negative = _LogBuckets(len(self.labels))
+        self.zero = np.zeros(len(self.labels))
+        self.min = np.full(len(self.labels), np.inf)
+        self.max = np.full(len(self.labels), -np.inf)
+
+    def add(self, values: pd.Series, weight: float = 1.0):
+        values = values.reindex(self.labels).to_numpy(dtype=float)
+        rows = np.arange(len(values))
+        present = ~np.isnan(values)
+        rows, values = rows[present], values[present]
+        self.min[rows] = np.minimum(self.min[rows], values)
+        self.max[rows] = np.maximum(self.max[rows], values)
+
+        magnitudes = np.abs(values)
+        is_zero = magnitudes < self.MIN_VALUE
+        np.add.at(self.zero, rows[is_zero], weight)
+        keys = np.ceil(
+            np.log(np.maximum(magnitudes, self.MIN_VALUE)) / np.log(self.gamma)
+        ).astype(np.int64)
+        positive = (values > 0) & ~is_zero
+        negative = (values < 0) & ~is_zero
+        self.positive.add(rows[positive], keys[positive], weight)
+        self.negative.add(rows[negative], keys[negative], weight)
+
+    def merge(self, other: "QuantileSketch"):
+        if not self.labels.equals(other.labels) or self.gamma != other.gamma:
+            raise ValueError("Only sketches with the same labels and accuracy merge")
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zero += other.zero
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+    def quantiles(self, probabilities: list[float]) -> pd.DataFrame:
+        """
+        Weighted quantiles of each label, one column per probability (NaN for
+        labels without values).
+        """
+
+        def bucket_values(buckets: _LogBuckets) -> np.ndarray:
+            # Value of each bucket with the same relative error at both ends
+            keys = buckets.offset + np.arange(buckets.counts.shape[1])
+            return 2 * self.gamma**keys / (self.gamma + 1)
+
+        # Every bucket in increasing order of value: negative ones from the
+        # largest magnitude, then zero, then the positive ones
+        counts = np.hstack(
+            [
+                self.negative.counts[:, ::-1],
+                self.zero[:, None],
+                self.positive.counts,
+            ]
+        )
+        values = np.concatenate(
+            [
+                -bucket_values(self.negative)[::-1],
+                [0.0],
+                bucket_values(self.positive),
+            ]
+        )
+        cumulative = np.cumsum(counts, axis=1)
+        totals = cumulative[:, -1]
+
+        result = {}
+        for probability in probabilities:
+            quantiles = np.full(len(self.labels), np.nan)
+            for row in np.flatnonzero(totals > 0):
+                position = np.searchsorted(
+                    cumulative[row], probability * totals[row], side="left"
+                )
+                quantiles[row] = np.clip(
+                    values[min(position, len(values) - 1)],
+                    self.min[row],
+                    self.max[row],
+                )
+            result[probability] = quantiles
+
+        return pd.DataFrame(result, index=self.labels)
+
+
+# Bins of PressureHistogram [m.c.a], pressures outside them count in the first
+# or last one
+PRESSURE_HISTOGRAM_EDGES = np.arange(0, 151, 1.0)
+
+
+class PressureHistogram:
+    """
+    Weighted histograms of the pressure of each node across realizations: one
+    of all its (time, realization) samples, for the fraction of time at or above
+    a threshold, and one of its minimum in each realization, for the
+    probability that the pressure stays at or above it. Any threshold is read
+    in O(nodes) (linear within its bin) without the pressures themselves.
+    Realizations are added one at a time and histograms merge by adding counts.
+    """
+
+    def __init__(
+        self, node_names: list[str], edges: np.ndarray = PRESSURE_HISTOGRAM_EDGES
+    ):
+        self.node_names = list(node_names)
+        self.edges = np.asarray(edges, dtype=float)
+        num_bins = len(self.edges) - 1
+        self.time_counts = np.zeros((len(self.node_names), num_bins))
+        self.min_counts = np.zeros((len(self.node_names), num_bins))
+
+    def _bins(self, values: np.ndarray) -> np.ndarray:
+        bins = np.searchsorted(self.edges, values, side="right") - 1
+        return np.clip(bins, 0, len(self.edges) - 2)
+
+    def add(self, pressure: np.ndarray, weight: float = 1.0):
+        """
+        Adds a realization from its pressure matrix (time, node), in the order
+        of node_names. Each realization weighs the same whatever its number of
+        times, and nodes without values (NaN) are skipped.
+        """
+        pressure = np.asarray(pressure, dtype=float)
+        present = ~np.isnan(pressure)
+        num_times = present.sum(axis=0)
+        times, nodes = np.nonzero(present)
+        np.add.at(
+            self.time_counts,
+            (nodes, self._bins(pressure[times, nodes])),
+            weight / num_times[nodes],
+        )
+
+        nodes = np.flatnonzero(num_times > 0)
+        min_pressure = np.nanmin(pressure[:, nodes], axis=0)
+        np.add.at(self.min_counts, (nodes, self._bins(min_pressure)), weight)
+
+    def merge(self, other: "PressureHistogram"):
+        if self.node_names != other.node_names or not np.array_equal(
+            self.edges, other.edges
+        ):
+            raise ValueError("Only histograms with the same nodes and bins merge")
+        self.time_counts += other.time_counts
+        self.min_counts += other.min_counts
+
+    def _fraction_at_or_above(self, counts: np.ndarray, threshold: float) -> pd.Series:
+        totals = counts.sum(axis=1)
+        bin_index = int(self._bins(np.array([threshold]))[0])
+        lower, upper = self.edges[bin_index], self.edges[bin_index + 1]
+        bin_share = np.clip((upper - threshold) / (upper - lower), 0, 1)
+        at_or_above = (
+            counts[:, bin_index + 1 :].sum(axis=1) + counts[:, bin_index] * bin_share
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.Series(at_or_above / totals, index=self.node_names)
+
+    def time_above(self, threshold: float) -> pd.Series:
+        """
+        Mean fraction of the time each node has a pressure at or above threshold.
+        """
+        return self._fraction_at_or_above(self.time_counts, threshold)
+
+    def exceedance_probability(self, threshold: float) -> pd.Series:
+        """
+        Probability that the pressure of each node stays at or above threshold
+        during the whole realization.
+        """
+        return self._fraction_at_or_above(self.min_counts, threshold)
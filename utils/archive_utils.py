@@ -0,0 +1,147 @@
+import io
+import json
+import os
+import pickle
+import zipfile
+
+import numpy as np
+import pandas as pd
+from wntr.network import WaterNetworkModel
+from wntr.sim.results import SimulationResults, ResultsStatus
+
+# Realizations per sub folder of simulation_data, to avoid huge flat directories
+REALIZATIONS_PER_SHARD = 100
+
+# A variable is stored sparse when at most this fraction of its columns is non-zero
+# (e.g. leak_demand, which is only non-zero at the Leak_* nodes)
+SPARSE_COLUMNS_FRACTION = 0.25
+
+
+def get_archive_path(simulation_data_folder: str, realization_id: int) -> str:
+    shard = (realization_id - 1) // REALIZATIONS_PER_SHARD
+    return os.path.join(
+        simulation_data_folder, f"{shard:03d}", f"realization_{realization_id}.zip"
+    )
+
+
+def _save_array(archive: zipfile.ZipFile, name: str, array: np.ndarray):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    archive.writestr(name, buffer.getvalue())
+
+
+def _load_array(archive: zipfile.ZipFile, name: str) -> np.ndarray:
+    with archive.open(name) as f:
+        return np.load(io.BytesIO(f.read()), allow_pickle=False)
+
+
+def _compact_dtype(values: pd.DataFrame):
+    if all(pd.api.types.is_integer_dtype(dtype) for dtype in values.dtypes):
+        return np.int8  # Link status
+    return np.float32
+
+
+def save_simulation_archive(
+    archive_path: str, wn: WaterNetworkModel, simulation_results: SimulationResults
+):
+    """
+    Saves the network and the simulation results of a realization in a zip file
+    with one compressed entry per variable, so each one can be read on its own.
+    Floats are stored as float32 and mostly zero variables only keep their
+    non-zero columns.
+    """
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    index = {
+        "network_name": simulation_results.network_name,
+        "error_code": simulation_results.error_code,
+        "times": [int(t) for t in simulation_results.node["pressure"].index],
+        "node_names": list(simulation_results.node["pressure"].columns),
+        "link_names": list(simulation_results.link["flowrate"].columns),
+        "junction_names": wn.junction_name_list,
+        "variables": {"node": {}, "link": {}},
+    }
+
+    tmp_path = f"{archive_path}.tmp"
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for element in ["node", "link"]:
+            for variable, values in getattr(simulation_results, element).items():
+                array = values.to_numpy(dtype=_compact_dtype(values))
+                non_zero_columns = np.flatnonzero((array != 0).any(axis=0))
+                if len(non_zero_columns) <= SPARSE_COLUMNS_FRACTION * array.shape[1]:
+                    index["variables"][element][variable] = "sparse"
+                    _save_array(
+                        archive, f"{element}/{variable}.columns.npy", non_zero_columns
+                    )
+                    _save_array(
+                        archive,
+                        f"{element}/{variable}.values.npy",
+                        array[:, non_zero_columns],
+                    )
+                else:
+                    index["variables"][element][variable] = "dense"
+                    _save_array(archive, f"{element}/{variable}.npy", array)
+
+        archive.writestr("wn.pickle", pickle.dumps(wn, protocol=pickle.HIGHEST_PROTOCOL))
+        archive.writestr("index.json", json.dumps(index))
+    os.replace(tmp_path, archive_path)
+
+
+def load_archive_index(archive_path: str) -> dict:
+    with zipfile.ZipFile(archive_path) as archive:
+        return json.loads(archive.read("index.json"))
+
+
+def load_archive_variable(
+    archive_path: str, element: str, variable: str
+) -> pd.DataFrame:
+    """
+    Returns one variable (e.g. "node", "leak_demand") as the DataFrame found in
+    SimulationResults, without reading the rest of the archive.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        index = json.loads(archive.read("index.json"))
+        names = index[f"{element}_names"]
+        if index["variables"][element][variable] == "sparse":
+            columns = _load_array(archive, f"{element}/{variable}.columns.npy")
+            values = _load_array(archive, f"{element}/{variable}.values.npy")
+            array = np.zeros((len(index["times"]), len(names)), dtype=values.dtype)
+            array[:, columns] = values
+        else:
+            array = _load_array(archive, f"{element}/{variable}.npy")
+
+    return pd.DataFrame(array, index=index["times"], columns=names)
+
+
+def load_archive_network(archive_path: str) -> WaterNetworkModel:
+    with zipfile.ZipFile(archive_path) as archive:
+        return pickle.loads(archive.read("wn.pickle"))
+
+
+def load_archive_results(archive_path: str) -> SimulationResults:
+    index = load_archive_index(archive_path)
+    simulation_results = SimulationResults()
+    simulation_results.network_name = index["network_name"]
+    if index["error_code"] is not None:
+        simulation_results.error_code = ResultsStatus(index["error_code"])
+    simulation_results.time = index["times"]
+    for element in ["node", "link"]:
+        setattr(
+            simulation_results,
+            element,
+            {
+                variable: load_archive_variable(archive_path, element, variable)
+                for variable in index["variables"][element]
+            },
+        )
+
+    return simulation_results
+
+
+def load_network_file(filename: str) -> WaterNetworkModel:
+    """
+    Loads a network saved either as a pickle or inside a simulation archive.
+    """
+    if filename.endswith(".zip"):
+        return load_archive_network(filename)
+    with open(filename, "rb") as f:
+        return pickle.load(f)
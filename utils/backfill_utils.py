@@ -0,0 +1,237 @@
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from .types import BackfillMetric, ResultsVariable
+from .archive_utils import get_archive_path, load_archive_index, load_archive_variable
+from .checkpoint_utils import write_file_atomically
+from .store_utils import STORE_METRICS, load_store_metric, write_store_metric
+
+# Names of the results pickle of each run of an experiment folder
+RESULTS_FILENAMES = ["metrics.pickle", "results.pickle"]
+
+
+def get_results_filename(output_folder: str) -> str | None:
+    for filename in RESULTS_FILENAMES:
+        results_filename = os.path.join(output_folder, filename)
+        if os.path.exists(results_filename):
+            return results_filename
+    return None
+
+
+def load_realization_variables(
+    simulation_data_folder: str,
+    realization_id: int,
+    variables: list[ResultsVariable],
+) -> tuple[dict[ResultsVariable, pd.DataFrame], list[str]] | None:
+    """
+    Reads some variables of the raw data of a realization and the names of its
+    junctions (Leak_* included), or None without raw data. Archives only read
+    those variables, pickled results have to be read whole.
+    """
+    archive_path = get_archive_path(simulation_data_folder, realization_id)
+    if os.path.exists(archive_path):
+        junction_names = load_archive_index(archive_path)["junction_names"]
+        return {
+            (element, variable): load_archive_variable(archive_path, element, variable)
+            for element, variable in variables
+        }, junction_names
+
+    results_filename = os.path.join(
+        simulation_data_folder, f"simulation_results_{realization_id}.pickle"
+    )
+    wn_filename = os.path.join(
+        simulation_data_folder, f"wn_realization_{realization_id}.pickle"
+    )
+    if not (os.path.exists(results_filename) and os.path.exists(wn_filename)):
+        return None
+    with open(results_filename, "rb") as f:
+        simulation_results = pickle.load(f)
+    with open(wn_filename, "rb") as f:
+        wn = pickle.load(f)
+    return {
+        (element, variable): getattr(simulation_results, element)[variable]
+        for element, variable in variables
+    }, wn.junction_name_list
+
+
+def compute_realization_backfill(
+    simulation_data_folder: str, realization_id: int, metric: BackfillMetric
+) -> tuple[int, dict | None]:
+    loaded = load_realization_variables(
+        simulation_data_folder, realization_id, metric["variables"]
+    )
+    if loaded is None:
+        return realization_id, None
+    variables, junction_names = loaded
+    return realization_id, metric["compute"](variables, junction_names)
+
+
+def _is_filled(value) -> bool:
+    if isinstance(value, (pd.Series, pd.DataFrame, dict)):
+        return True
+    return value is not None and pd.notna(value)
+
+
+def get_backfill_realizations(
+    results: pd.DataFrame, store_folder: str | None, columns: list[str]
+) -> list[int]:
+    """
+    Realizations without errors that lack any of the columns, in the results
+    DataFrame or, for the metrics of a result store, in the store.
+    """
+    if "error" in results.columns:
+        results = results[results["error"].isna()]
+    realization_ids = results["realization_id"].astype(int).to_numpy()
+
+    missing = np.zeros(len(realization_ids), dtype=bool)
+    for column in columns:
+        if store_folder is not None and column in STORE_METRICS:
+            values = load_store_metric(store_folder, column)[realization_ids - 1]
+            missing |= np.isnan(values.reshape(len(realization_ids), -1)).all(axis=1)
+        elif column in results.columns:
+            missing |= ~results[column].map(_is_filled).to_numpy(dtype=bool)
+        else:
+            missing[:] = True
+
+    return [int(i) for i in realization_ids[missing]]
+
+
+def _save_backfill(
+    results_filename: str,
+    results: pd.DataFrame,
+    store_folder: str | None,
+    computed: dict[int, dict],
+    columns: list[str],
+):
+    # As in write_realization, store runs keep their arrays in the store and
+    # only the scalars in the results pickle
+    row_by_realization = pd.Series(
+        np.arange(len(results)), index=results["realization_id"].astype(int)
+    )
+    for column in columns:
+        values = {
+            realization_id: metrics[column]
+            for realization_id, metrics in computed.items()
+            if column in metrics
+        }
+        if store_folder is not None and column in STORE_METRICS:
+            write_store_metric(store_folder, column, values)
+            if STORE_METRICS[column] != ():
+                continue
+
+        cells = (
+            results[column].tolist()
+            if column in results.columns
+            else [None] * len(results)
+        )
+        for realization_id, value in values.items():
+            cells[row_by_realization[realization_id]] = value
+        results[column] = pd.Series(cells, index=results.index, dtype=object)
+        results[column] = results[column].infer_objects()
+
+    # The results pickle either keeps its previous columns or gets all the new ones
+    write_file_atomically(results_filename, pickle.dumps(results))
+
+
+def backfill_experiment(
+    output_folder: str,
+    metric: BackfillMetric,
+    max_workers: int = 1,
+    save_every: int = 1000,
+) -> int:
+    """
+    Adds the columns of metric to the realizations of a run (e.g.
+    results/experimento_full_X/base_earthquake) from its simulation_data,
+    computing them in a process pool. Realizations already backfilled are
+    skipped and progress is saved every save_every realizations, so an
+    interrupted backfill resumes where it stopped. Returns the number of
+    realizations backfilled.
+    """
+    results_filename = get_results_filename(output_folder)
+    if results_filename is None:
+        raise ValueError(f"No results pickle in '{output_folder}'")
+    with open(results_filename, "rb") as f:
+        results: pd.DataFrame = pickle.load(f)
+
+    store_folder = os.path.join(output_folder, "store")
+    if not os.path.isdir(store_folder):
+        store_folder = None
+    realization_ids = get_backfill_realizations(
+        results, store_folder, metric["columns"]
+    )
+    print(
+        f"{output_folder}: {len(realization_ids)} of {len(results)} realizations "
+        "to backfill"
+    )
+    if not realization_ids:
+        return 0
+
+    simulation_data_folder = os.path.join(output_folder, "simulation_data")
+    computed = {}
+    num_backfilled = 0
+    without_raw_data = []
+
+    def add(realization_id: int, metrics: dict | None):
+        nonlocal num_backfilled
+        if metrics is None:
+            without_raw_data.append(realization_id)
+            return
+        computed[realization_id] = metrics
+        if len(computed) >= save_every:
+            _save_backfill(
+                results_filename, results, store_folder, computed, metric["columns"]
+            )
+            num_backfilled += len(computed)
+            computed.clear()
+
+    if max_workers <= 1:
+        for realization_id in realization_ids:
+            add(
+                *compute_realization_backfill(
+                    simulation_data_folder, realization_id, metric
+                )
+            )
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for realization_id, metrics in executor.map(
+                compute_realization_backfill,
+                repeat(simulation_data_folder),
+                realization_ids,
+                repeat(metric),
+                chunksize=max(1, min(32, len(realization_ids) // (4 * max_workers))),
+            ):
+                add(realization_id, metrics)
+
+    if computed:
+        _save_backfill(
+            results_filename, results, store_folder, computed, metric["columns"]
+        )
+        num_backfilled += len(computed)
+    if without_raw_data:
+        print(f"\t{len(without_raw_data)} realizations without raw data were skipped")
+    return num_backfilled
+
+
+def backfill_experiment_folder(
+    experiment_folder: str,
+    metric: BackfillMetric,
+    max_workers: int = 1,
+    save_every: int = 1000,
+) -> int:
+    """
+    backfill_experiment for every run of an experiment folder (every sub folder
+    with a results pickle).
+    """
+    num_backfilled = 0
+    for name in sorted(os.listdir(experiment_folder)):
+        output_folder = os.path.join(experiment_folder, name)
+        if os.path.isdir(output_folder) and get_results_filename(output_folder):
+            num_backfilled += backfill_experiment(
+                output_folder, metric, max_workers, save_every
+            )
+    return num_backfilled
@@ -0,0 +1,190 @@
+import os
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from .types import MitigationLeaksStrategyOptions
+
+# Scalars of each realization kept in the catalog, with their SQLite types. The
+# time series stay in the result store / pickles.
+CATALOG_COLUMNS = {
+    # Which realization: experiment folder, run (its subfolder) and realization_id
+    "experiment": "TEXT NOT NULL",
+    "run": "TEXT NOT NULL",
+    "realization_id": "INTEGER NOT NULL",
+    "simulation_type": "TEXT",
+    # NULL without mitigation
+    "mitigation_strategy": "TEXT",
+    "reinforcement_percent": "INTEGER",
+    "pga": "REAL",
+    "num_damages": "INTEGER",
+    "num_major_damages": "INTEGER",
+    "num_moderate_damages": "INTEGER",
+    "min_system_pressure": "REAL",
+    "min_system_junctions_pressure": "REAL",
+    "mean_system_pressure": "REAL",
+    "mean_system_wsa": "REAL",
+    "mean_todini": "REAL",
+    # Time of the first negative pressure, see stop_on_negative_pressure
+    "invalid_at": "REAL",
+    "sampling_weight": "REAL",
+    "reused_scenario": "INTEGER",
+    # Sum of the stage times [s] (0 for reused scenarios)
+    "runtime": "REAL",
+    "error": "TEXT",
+}
+
+# Columns of the usual filters
+CATALOG_INDEXES = {
+    "realizations_run": ["experiment", "run"],
+    "realizations_mitigation": ["mitigation_strategy", "reinforcement_percent"],
+    "realizations_pga": ["pga"],
+    "realizations_num_damages": ["num_damages"],
+    "realizations_min_system_pressure": ["min_system_pressure"],
+}
+
+# Pressures the negative pressure realizations are counted with
+SUMMARY_PRESSURES = ["min_system_pressure", "min_system_junctions_pressure"]
+
+
+def open_catalog(catalog_file: str) -> sqlite3.Connection:
+    """
+    Opens (creating it if needed) the SQLite catalog with one row per realization
+    of every run, shared by all the experiments.
+    """
+    os.makedirs(os.path.dirname(catalog_file) or ".", exist_ok=True)
+    # Several experiments may record to the same catalog at once
+    connection = sqlite3.connect(catalog_file, timeout=60)
+    columns = ", ".join(f"{name} {kind}" for name, kind in CATALOG_COLUMNS.items())
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS realizations ({columns}, "
+        "PRIMARY KEY (experiment, run, realization_id))"
+    )
+    for index_name, index_columns in CATALOG_INDEXES.items():
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {index_name} "
+            f"ON realizations ({', '.join(index_columns)})"
+        )
+    connection.commit()
+    return connection
+
+
+def get_catalog_run(output_folder: str) -> tuple[str, str]:
+    """
+    (experiment, run) of the realizations saved in output_folder, e.g.
+    results/experimento_full_X/base_earthquake -> (experimento_full_X,
+    base_earthquake).
+    """
+    output_folder = os.path.abspath(output_folder)
+    return os.path.basename(os.path.dirname(output_folder)), os.path.basename(
+        output_folder
+    )
+
+
+def _to_sql(value):
+    if value is None or (np.isscalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    return value
+
+
+def get_catalog_row(
+    output_folder: str,
+    simulation_type: str,
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None,
+    result: dict,
+) -> tuple:
+    """
+    Row of a realization, in the order of CATALOG_COLUMNS.
+    """
+    experiment, run = get_catalog_run(output_folder)
+    mitigation = mitigation_leaks_strategy_options or {}
+    values = {
+        "experiment": experiment,
+        "run": run,
+        "simulation_type": simulation_type,
+        "mitigation_strategy": mitigation.get("mitigation_strategy") or None,
+        "reinforcement_percent": mitigation.get("reinforcement_percent"),
+        "runtime": sum(result.get("stage_times", {}).values()),
+    }
+    values.update(
+        {
+            column: result.get(column)
+            for column in CATALOG_COLUMNS
+            if column not in values
+        }
+    )
+    todini = result.get("todini")
+    if "mean_todini" not in result and todini is not None and len(todini):
+        # Checkpoints from before mean_todini was a metric
+        values["mean_todini"] = float(np.nanmean(np.asarray(todini, dtype=float)))
+    return tuple(_to_sql(values[column]) for column in CATALOG_COLUMNS)
+
+
+def record_realizations(connection: sqlite3.Connection, rows: list[tuple]):
+    """
+    Inserts the rows of get_catalog_row, replacing the earlier ones of the same
+    realizations (e.g. failed before resuming).
+    """
+    placeholders = ", ".join("?" for _ in CATALOG_COLUMNS)
+    with connection:
+        connection.executemany(
+            f"INSERT OR REPLACE INTO realizations VALUES ({placeholders})", rows
+        )
+
+
+def query_catalog(
+    catalog_file: str, where: str = "1", parameters: tuple = ()
+) -> pd.DataFrame:
+    """
+    Realizations matching an SQL condition, e.g.
+    query_catalog(catalog_file, "run = ? AND pga > ? AND num_damages > ?",
+    ("node_degree_at_10", 0.3, 100)).
+    """
+    with closing(open_catalog(catalog_file)) as connection:
+        return pd.read_sql_query(
+            f"SELECT * FROM realizations WHERE {where}", connection, params=parameters
+        )
+
+
+def summarize_run(
+    catalog_file: str | None,
+    output_folder: str,
+    results: pd.DataFrame,
+    pressure_metric: str = "min_system_junctions_pressure",
+) -> dict:
+    """
+    Minimum pressure and number of realizations with a negative one among the
+    realizations without errors of the run saved in output_folder. They are
+    queried from the catalog, or computed from the run's results without one.
+    """
+    if pressure_metric not in SUMMARY_PRESSURES:
+        raise ValueError(f"Invalid pressure_metric '{pressure_metric}'")
+
+    if catalog_file is None:
+        if "error" in results.columns:
+            results = results[results["error"].isna()]
+        pressures = results.get(pressure_metric, pd.Series(dtype=float))
+        pressures = pressures.astype(float).dropna()
+        min_pressure = pressures.min() if len(pressures) else None
+        negative_pressure_count = int((pressures < 0).sum())
+    else:
+        with closing(open_catalog(catalog_file)) as connection:
+            min_pressure, negative_pressure_count = connection.execute(
+                f"SELECT MIN({pressure_metric}), "
+                f"COALESCE(SUM({pressure_metric} < 0), 0) FROM realizations "
+                "WHERE experiment = ? AND run = ? AND error IS NULL",
+                get_catalog_run(output_folder),
+            ).fetchone()
+
+    return {
+        "min_pressure": min_pressure if min_pressure is not None else float("inf"),
+        "negative_pressure_count": negative_pressure_count,
+    }
@@ -1,25 +1,139 @@
-from wntr.network import WaterNetworkModel
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import numpy as np
 import pandas as pd
+from matplotlib.collections import LineCollection
 from matplotlib.colors import ListedColormap
 import matplotlib.pyplot as plt
-import wntr
 from wntr.scenario import FragilityCurve
 from .types import SimulationType
+from .network_utils import get_network, get_network_hash
+from .store_utils import load_store_index, load_store_metric
+from .general_utils import generate_fragility_curve, format_time
+
+# Geometry of the base networks drawn by this process, keyed by network hash
+_network_layouts: dict[str, dict] = {}
+
+# Network figures already drawn by this process, keyed by (chart, network hash).
+# Each realization only changes their colors and title before saving them.
+_network_figures: dict[tuple[str, str], dict] = {}
+
+# Experiment context of this render worker, set by init_chart_worker
+_chart_context: dict = {}
+
+
+def get_network_layout(inp_file: str, network_cache_folder: str | None = None) -> dict:
+    """
+    Returns the node coordinates and link segments of the base network, computed
+    once per process.
+    """
+    network_hash = get_network_hash(inp_file)
+    if network_hash in _network_layouts:
+        return _network_layouts[network_hash]
+
+    wn = get_network(inp_file, cache_folder=network_cache_folder)
+    node_names = wn.node_name_list
+    node_position = {name: i for i, name in enumerate(node_names)}
+    node_xy = np.array([wn.get_node(name).coordinates for name in node_names])
+    link_names = wn.link_name_list
+    # Straight segments between the end nodes, like wntr.graphics.plot_network
+    segments = np.stack(
+        [
+            node_xy[[node_position[wn.get_link(name).start_node_name] for name in link_names]],
+            node_xy[[node_position[wn.get_link(name).end_node_name] for name in link_names]],
+        ],
+        axis=1,
+    )
+
+    layout = {
+        "network_hash": network_hash,
+        "node_names": node_names,
+        "junction_names": wn.junction_name_list,
+        "node_xy": node_xy,
+        "link_names": link_names,
+        "segments": segments,
+    }
+    _network_layouts[network_hash] = layout
+    return layout
+
+
+def _draw_network_background(ax, layout: dict):
+    ax.add_collection(
+        LineCollection(layout["segments"], colors="grey", linewidths=0.5, zorder=1)
+    )
+    ax.autoscale_view()
+    ax.axis("off")
+
+
+def _get_damage_figure(layout: dict) -> dict:
+    key = ("damage", layout["network_hash"])
+    if key in _network_figures:
+        return _network_figures[key]
+
+    cmap = ListedColormap(["grey", "royalblue", "darkorange"])
+    cmap.set_bad(alpha=0)  # Pipes without damage only show the background
+
+    fig, ax = plt.subplots(figsize=(5, 8))
+    _draw_network_background(ax, layout)
+    links = LineCollection(layout["segments"], cmap=cmap, linewidths=2, zorder=1)
+    links.set_clim(0, 2)
+    links.set_array(np.full(len(layout["link_names"]), np.nan))
+    ax.add_collection(links)
+    colorbar = fig.colorbar(links, shrink=0.5, pad=0.05, ax=ax)
+    colorbar.ax.set_title(
+        "Estado daño:\n\n0=Ninguno\n1=Moderado\n2=Mayor\n", fontsize=10
+    )
+
+    _network_figures[key] = {"fig": fig, "ax": ax, "links": links}
+    return _network_figures[key]
+
+
+def _get_pressure_figure(layout: dict) -> dict:
+    key = ("pressure", layout["network_hash"])
+    if key in _network_figures:
+        return _network_figures[key]
+
+    fig, ax = plt.subplots(figsize=(10, 15))
+    _draw_network_background(ax, layout)
+    ax.add_collection(
+        LineCollection(layout["segments"], colors="k", linewidths=1, zorder=1)
+    )
+    nodes = ax.scatter(
+        layout["node_xy"][:, 0],
+        layout["node_xy"][:, 1],
+        c=np.zeros(len(layout["node_names"])),
+        s=20,
+        cmap=plt.get_cmap("Spectral_r"),
+        vmin=-10,
+        vmax=80,
+        linewidths=0,
+        zorder=2,
+    )
+    colorbar = fig.colorbar(nodes, shrink=0.5, pad=0, ax=ax)
+    colorbar.ax.set_title("[m.c.a]", fontsize=10)
+
+    _network_figures[key] = {"fig": fig, "ax": ax, "nodes": nodes}
+    return _network_figures[key]
 
 
 def generate_charts(
     simulation_type: SimulationType,
     inp_file: str,
+    network_cache_folder: str | None,
     base_path: str,
     realization_id: int,
-    wn: WaterNetworkModel,
     FC: FragilityCurve | None,
     damage_states: pd.Series | None,
     pga_value: float,
     mean_t_wsa: pd.Series,
     todini: pd.Series,
-    pressure: pd.DataFrame,
+    final_pressure: pd.Series,
 ):
+    layout = get_network_layout(inp_file, network_cache_folder)
+
     if simulation_type == "Earthquake":
         if FC is None:
             raise ValueError("FC is None.")
@@ -27,7 +141,7 @@ def generate_charts(
             raise ValueError("damage_states is None.")
 
         generate_damage_chart(
-            inp_file,
+            layout,
             base_path,
             realization_id,
             damage_states,
@@ -48,47 +162,33 @@ def generate_charts(
     )
 
     generate_pressure_chart(
+        layout,
         base_path,
         realization_id,
-        wn,
-        pressure,
+        final_pressure,
     )
 
 
 def generate_damage_chart(
-    inp_file: str,
+    layout: dict,
     base_path: str,
     realization_id: int,
     damage_states: pd.Series,
     pga_value: float,
     FC: FragilityCurve,
 ):
-    wn = WaterNetworkModel(inp_file)
     priority_map = FC.get_priority_map()
-    damage_value = damage_states.map(priority_map)
+    damage_value = damage_states.map(priority_map).reindex(layout["link_names"])
 
-    colors = ["grey", "royalblue", "darkorange"]
-    cmap = ListedColormap(colors)
-
-    fig, ax = plt.subplots(figsize=(5, 8))
-    wntr.graphics.plot_network(
-        wn,
-        ax=ax,
-        link_attribute=damage_value,
-        node_size=0,
-        link_cmap=cmap,  # Colormap que definiste
-        link_range=[0, 2],
-        link_width=2,
-        link_colorbar_label="Estado daño:\n\n0=Ninguno\n1=Moderado\n2=Mayor\n",
-        title=f"Estado de daño de la red \npga = {round(pga_value,2)} [g]",
-    )
+    figure = _get_damage_figure(layout)
+    figure["links"].set_array(damage_value.to_numpy(dtype=float))
+    figure["ax"].set_title(f"Estado de daño de la red \npga = {round(pga_value,2)} [g]")
 
-    fig.savefig(
+    figure["fig"].savefig(
         f"{base_path}/earthquake_damage_{realization_id}.png",
         format="png",
         dpi=300,
     )
-    plt.close(fig)
 
 
 def generate_wsa_chart(
@@ -127,26 +227,177 @@ def generate_todini_chart(
 
 
 def generate_pressure_chart(
+    layout: dict,
     base_path: str,
     realization_id: int,
-    wn: WaterNetworkModel,
-    pressure: pd.DataFrame,
+    final_pressure: pd.Series,
 ):
-    junctions = wn.junction_name_list
-    pressure = pressure[junctions]
+    """
+    Pressure of every node of the base network at the last reported time (the
+    Leak_* nodes of a realization are not drawn).
+    """
+    junctions_pressure = final_pressure.reindex(layout["junction_names"])
+    min_pressure = float(junctions_pressure.min())
+    max_pressure = float(junctions_pressure.max())
 
-    min_pressure = pressure.iloc[-1].min()
-    max_pressure = pressure.iloc[-1].max()
+    figure = _get_pressure_figure(layout)
+    figure["nodes"].set_array(
+        final_pressure.reindex(layout["node_names"]).to_numpy(dtype=float)
+    )
+    figure["ax"].set_title(
+        f"Presión de la red \nPmin = {round(min_pressure,2)} [m.c.a] \nPmax = {round(max_pressure,2)} [m.c.a]"
+    )
 
-    fig, ax = plt.subplots(figsize=(10, 15))
-    wntr.graphics.plot_network(
-        wn,
-        ax=ax,
-        title=f"Presión de la red \nPmin = {round(min_pressure,2)} [m.c.a] \nPmax = {round(max_pressure,2)} [m.c.a]",
-        node_attribute="pressure",
-        node_colorbar_label="[m.c.a]",
-        node_range=[-10, 80],
+    figure["fig"].savefig(
+        f"{base_path}/pressure_{realization_id}.png", format="png", dpi=300
     )
 
-    fig.savefig(f"{base_path}/pressure_{realization_id}.png", format="png", dpi=300)
-    plt.close(fig)
+
+def _last_reported_row(values: np.ndarray) -> np.ndarray:
+    # Last time with results (a realization whose solver failed stops early)
+    reported = np.flatnonzero(~np.isnan(values).all(axis=1))
+    return values[reported[-1]] if len(reported) else values[-1]
+
+
+def get_chart_data(
+    results: list[dict],
+    realization_ids: list[int],
+    result_store_folder: str | None = None,
+    pga_values_and_damage_states: list[tuple[float, pd.Series]] | None = None,
+) -> list[dict]:
+    """
+    Collects what the charts of each realization need, from the metrics records
+    and, when they were streamed there, the time series of the result store. The
+    damage states come from pga_values_and_damage_states, at the damage_row of
+    each record.
+    """
+    results_by_id = {
+        result["realization_id"]: result
+        for result in results
+        if "error" not in result and result.get("invalid_at") is None
+    }
+    realization_ids = [i for i in realization_ids if i in results_by_id]
+
+    store = None
+    if result_store_folder is not None:
+        index = load_store_index(result_store_folder)
+        store = {
+            "times": index["times"],
+            "node_names": index["node_names"],
+            "mean_t_wsa": load_store_metric(result_store_folder, "mean_t_wsa"),
+            "todini": load_store_metric(result_store_folder, "todini"),
+            "pressure": load_store_metric(result_store_folder, "pressure"),
+        }
+
+    chart_data = []
+    for realization_id in realization_ids:
+        result = results_by_id[realization_id]
+        if store is not None:
+            row = realization_id - 1
+            mean_t_wsa = pd.Series(store["mean_t_wsa"][row], index=store["times"])
+            todini = pd.Series(store["todini"][row], index=store["times"])
+            final_pressure = pd.Series(
+                _last_reported_row(np.asarray(store["pressure"][row])),
+                index=store["node_names"],
+            )
+        else:
+            mean_t_wsa = result["mean_t_wsa"]
+            todini = result["todini"]
+            final_pressure = result["pressure"].iloc[-1]
+
+        chart_data.append(
+            {
+                "realization_id": realization_id,
+                "pga": result.get("pga", 0),
+                "damage_states": (
+                    pga_values_and_damage_states[result["damage_row"]][1]
+                    if pga_values_and_damage_states is not None
+                    and "damage_row" in result
+                    else None
+                ),
+                "mean_t_wsa": mean_t_wsa.dropna(),
+                "todini": todini.dropna(),
+                "final_pressure": final_pressure,
+            }
+        )
+
+    return chart_data
+
+
+def init_chart_worker(context: dict):
+    """
+    Process pool initializer. Selects the non interactive backend and builds the
+    network layout once per render worker.
+    """
+    global _chart_context
+    matplotlib.use("Agg")
+    get_network_layout(context["inp_file"], context["network_cache_folder"])
+    _chart_context = context
+
+
+def render_realization_charts(chart_data: dict) -> float:
+    context = _chart_context
+    start_time = time.time()
+    is_earthquake = context["simulation_type"] == "Earthquake"
+
+    generate_charts(
+        context["simulation_type"],
+        context["inp_file"],
+        context["network_cache_folder"],
+        context["charts_folder"],
+        chart_data["realization_id"],
+        generate_fragility_curve() if is_earthquake else None,
+        chart_data["damage_states"] if is_earthquake else None,
+        chart_data["pga"],
+        chart_data["mean_t_wsa"],
+        chart_data["todini"],
+        chart_data["final_pressure"],
+    )
+
+    return time.time() - start_time
+
+
+def render_charts(
+    simulation_type: SimulationType,
+    inp_file: str,
+    output_folder: str,
+    results: list[dict],
+    realization_ids: list[int],
+    max_workers: int,
+    network_cache_folder: str | None = None,
+    result_store_folder: str | None = None,
+    pga_values_and_damage_states: list[tuple[float, pd.Series]] | None = None,
+):
+    """
+    Renders the charts of the selected realizations of a finished simulation into
+    {output_folder}/charts. Can also be called later on, on the metrics of a
+    previous run, to chart other realizations.
+    """
+    start_time = time.time()
+    chart_data = get_chart_data(
+        results, realization_ids, result_store_folder, pga_values_and_damage_states
+    )
+    if not chart_data:
+        return
+
+    charts_folder = os.path.join(output_folder, "charts")
+    os.makedirs(charts_folder, exist_ok=True)
+    context = {
+        "simulation_type": simulation_type,
+        "inp_file": inp_file,
+        "network_cache_folder": network_cache_folder,
+        "charts_folder": charts_folder,
+    }
+
+    print(f"Rendering charts of {len(chart_data)} realizations")
+    with ProcessPoolExecutor(
+        max_workers=min(max_workers, len(chart_data)),
+        initializer=init_chart_worker,
+        initargs=(context,),
+    ) as executor:
+        render_times = list(executor.map(render_realization_charts, chart_data))
+
+    print(
+        f"Charts rendered in {format_time(start_time, time.time())} "
+        f"(mean {np.mean(render_times):.2f} s per realization)"
+    )
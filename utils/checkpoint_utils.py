@@ -0,0 +1,62 @@
+import os
+import pickle
+from collections.abc import Iterator
+
+
+def get_checkpoint_folder(output_folder: str) -> str:
+    return os.path.join(output_folder, "checkpoints")
+
+
+def get_checkpoint_filename(checkpoint_folder: str, realization_id: int) -> str:
+    return os.path.join(checkpoint_folder, f"realization_{realization_id}.pickle")
+
+
+def write_file_atomically(filename: str, data: bytes):
+    """
+    Writes data so that, even after a crash or a power cut, filename either
+    holds the previous content or the complete new one.
+    """
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    # Persist the rename too (directories can't be opened on Windows)
+    if os.name != "nt":
+        folder_fd = os.open(os.path.dirname(filename) or ".", os.O_RDONLY)
+        try:
+            os.fsync(folder_fd)
+        finally:
+            os.close(folder_fd)
+
+
+def save_checkpoint(checkpoint_folder: str, metrics: dict):
+    """
+    Commits the metrics of a finished realization, as kept in memory (without
+    the arrays already written to the result store, see write_realization).
+    Realizations that failed are not saved, so they are simulated again when the
+    experiment is resumed.
+    """
+    if "error" in metrics:
+        return
+
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    filename = get_checkpoint_filename(checkpoint_folder, metrics["realization_id"])
+    write_file_atomically(filename, pickle.dumps(metrics))
+
+
+def load_checkpoints(checkpoint_folder: str) -> Iterator[dict]:
+    """
+    Yields the metrics of every realization already completed, reading one
+    checkpoint at a time.
+    """
+    if not os.path.isdir(checkpoint_folder):
+        return
+
+    for filename in sorted(os.listdir(checkpoint_folder)):
+        if not (filename.startswith("realization_") and filename.endswith(".pickle")):
+            continue  # Leftovers of an interrupted write
+        with open(os.path.join(checkpoint_folder, filename), "rb") as f:
+            yield pickle.load(f)
@@ -0,0 +1,255 @@
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from .general_utils import generate_fragility_curve
+
+# Rows of the damage matrix sampled at once, so the uniforms of a chunk (float64)
+# stay small next to the int8 matrix
+SAMPLING_CHUNK_SIZE = 256
+
+
+def get_damage_state_names() -> dict[int, str]:
+    """
+    Damage state of each code of a damage matrix: 0 for undamaged pipes and the
+    priority of each fragility curve state (1 "Moderado", 2 "Mayor").
+    """
+    return {
+        state.priority: state_name
+        for state_name, state in generate_fragility_curve().states()
+    }
+
+
+def get_exceedance_probabilities(pga_values: np.ndarray) -> np.ndarray:
+    """
+    Probability of exceeding each fragility curve state for every PGA, shape
+    (realization, state) in the order of FragilityCurve.states().
+    """
+    pga_values = np.asarray(pga_values, dtype=float)
+    return np.column_stack(
+        [
+            state.distribution["Default"].cdf(pga_values)
+            for _, state in generate_fragility_curve().states()
+        ]
+    )
+
+
+def get_damage_codes(probabilities: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+    """
+    Damage codes from the exceedance probabilities (realization, state) and the
+    uniform draw of each pipe (realization, pipe). As in
+    FragilityCurve.sample_damage_state, a pipe takes the last state whose
+    probability is above its draw.
+    """
+    priorities = [state.priority for _, state in generate_fragility_curve().states()]
+    codes = np.zeros(uniforms.shape, dtype=np.int8)
+    for state_index, priority in enumerate(priorities):
+        codes[uniforms < probabilities[:, state_index, None]] = priority
+    return codes
+
+
+def get_realization_streams(
+    num_realizations: int, seed: int | np.random.SeedSequence | None
+) -> list[np.random.Generator]:
+    """
+    An independent random stream per realization, so the draws of a realization
+    don't depend on how many others are sampled nor in what order.
+    """
+    seed_sequence = (
+        seed
+        if isinstance(seed, np.random.SeedSequence)
+        else np.random.SeedSequence(seed)
+    )
+    return [
+        np.random.default_rng(child) for child in seed_sequence.spawn(num_realizations)
+    ]
+
+
+def get_sampling_seeds(
+    entropy: int,
+) -> tuple[np.random.SeedSequence, np.random.SeedSequence]:
+    """
+    Seeds of the PGA values and of the pipe draws of a sample, derived from its
+    entropy only: the same seed draws the same pipes whether the PGA values are
+    given (sample_damage_states) or sampled (sample_earthquake_scenarios).
+    """
+    pga_seed, pipes_seed = np.random.SeedSequence(entropy).spawn(2)
+    return pga_seed, pipes_seed
+
+
+def sample_damage_matrix(
+    pga_values: np.ndarray,
+    num_pipes: int,
+    seed: int | np.random.SeedSequence | None = None,
+    antithetic: bool = False,
+) -> np.ndarray:
+    """
+    Samples the damage state of every pipe of every realization as an int8
+    matrix (realization, pipe) of damage codes (see get_damage_state_names).
+    Realization i draws its pipes from the i-th stream of seed.
+
+    With antithetic, realizations 2k and 2k + 1 share the k-th stream, the
+    second one with the mirrored uniforms (1 - u).
+    """
+    probabilities = get_exceedance_probabilities(pga_values)
+    num_realizations = len(probabilities)
+    rows_per_stream = 2 if antithetic else 1
+    streams = get_realization_streams(
+        math.ceil(num_realizations / rows_per_stream), seed
+    )
+
+    damage = np.empty((num_realizations, num_pipes), dtype=np.int8)
+    # SAMPLING_CHUNK_SIZE is even, so an antithetic pair never spans two chunks
+    for start in range(0, num_realizations, SAMPLING_CHUNK_SIZE):
+        end = min(start + SAMPLING_CHUNK_SIZE, num_realizations)
+        chunk_streams = streams[
+            start // rows_per_stream : math.ceil(end / rows_per_stream)
+        ]
+        uniforms = np.stack([stream.random(num_pipes) for stream in chunk_streams])
+        if antithetic:
+            uniforms = np.stack([uniforms, 1 - uniforms], axis=1).reshape(
+                -1, num_pipes
+            )[: end - start]
+        damage[start:end] = get_damage_codes(probabilities[start:end], uniforms)
+
+    return damage
+
+
+class DamageMatrix:
+    """
+    PGA and damage states of every realization of an experiment, as a float
+    array and an int8 matrix (realization, pipe) instead of a pandas Series per
+    realization. Indexing it gives the (pga, damage_states) pair the simulation
+    expects, with damage_states built on demand.
+
+    Loaded from a folder it is memory-mapped and pickles as the folder, so the
+    workers map the same file instead of receiving a copy.
+    """
+
+    def __init__(
+        self,
+        pga_values: np.ndarray,
+        damage: np.ndarray,
+        pipe_names: list[str],
+        seed_entropy: int | None = None,
+    ):
+        self.pga_values = pga_values
+        self.damage = damage
+        self.pipe_names = pipe_names
+        self.seed_entropy = seed_entropy
+        self.folder = None
+        self._state_names = None
+
+    def __len__(self) -> int:
+        return len(self.pga_values)
+
+    def __getitem__(self, realization_index: int) -> tuple[float, pd.Series]:
+        if not -len(self) <= realization_index < len(self):
+            raise IndexError(realization_index)
+        return (
+            float(self.pga_values[realization_index]),
+            self.get_damage_states(realization_index),
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def get_damage_states(self, realization_index: int) -> pd.Series:
+        """
+        Same Series as FragilityCurve.sample_damage_state: the state name of
+        each damaged pipe and None for the others.
+        """
+        if self._state_names is None:
+            state_names = get_damage_state_names()
+            self._state_names = np.array(
+                [state_names.get(code) for code in range(max(state_names) + 1)],
+                dtype=object,
+            )
+        codes = np.asarray(self.damage[realization_index])
+        return pd.Series(self._state_names[codes], index=self.pipe_names)
+
+    def get_num_damages(self, realization_index: int) -> int:
+        return int(np.count_nonzero(self.damage[realization_index]))
+
+    def save(self, folder: str):
+        """
+        Writes the matrix to folder (replacing it whole, so an interrupted save
+        leaves no partial folder behind) and memory-maps it from there.
+        """
+        tmp_folder = f"{folder}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        damage = open_memmap(
+            os.path.join(tmp_folder, "damage.npy"),
+            mode="w+",
+            dtype=np.int8,
+            shape=self.damage.shape,
+        )
+        damage[:] = self.damage
+        damage.flush()
+        del damage
+        np.save(os.path.join(tmp_folder, "pga.npy"), np.asarray(self.pga_values))
+        with open(os.path.join(tmp_folder, "index.json"), "w") as f:
+            json.dump(
+                {"pipe_names": list(self.pipe_names), "seed_entropy": self.seed_entropy},
+                f,
+            )
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.replace(tmp_folder, folder)
+
+        loaded = DamageMatrix.load(folder)
+        self.pga_values, self.damage, self.folder = (
+            loaded.pga_values,
+            loaded.damage,
+            loaded.folder,
+        )
+
+    @classmethod
+    def load(cls, folder: str) -> "DamageMatrix":
+        with open(os.path.join(folder, "index.json")) as f:
+            index = json.load(f)
+        damage_matrix = cls(
+            np.load(os.path.join(folder, "pga.npy")),
+            np.load(os.path.join(folder, "damage.npy"), mmap_mode="r"),
+            index["pipe_names"],
+            index["seed_entropy"],
+        )
+        damage_matrix.folder = folder
+        return damage_matrix
+
+    def __getstate__(self):
+        if self.folder is not None:
+            return {"folder": self.folder}
+        state = self.__dict__.copy()
+        state["_state_names"] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        if "folder" in state and len(state) == 1:
+            self.__dict__.update(DamageMatrix.load(state["folder"]).__dict__)
+        else:
+            self.__dict__.update(state)
+
+
+def sample_damage_states(
+    pga_values: list[float],
+    pipe_names: list[str],
+    seed: int | None = None,
+    antithetic: bool = False,
+) -> DamageMatrix:
+    """
+    Samples the damage states of a realization per PGA value (see
+    sample_damage_matrix). The seed (fresh entropy if None) is kept in the
+    matrix so the sample can be reproduced.
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    _, pipes_seed = get_sampling_seeds(seed_sequence.entropy)
+    pga_values = np.asarray(pga_values, dtype=float)
+    damage = sample_damage_matrix(pga_values, len(pipe_names), pipes_seed, antithetic)
+    return DamageMatrix(pga_values, damage, list(pipe_names), seed_sequence.entropy)
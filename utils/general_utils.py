@@ -8,21 +8,35 @@ from wntr.network import WaterNetworkModel
 import wntr
 import os
 
+from .store_utils import load_store_frame
 
-def generate_pga_value() -> float:
+
+PGA_MEAN = 0.28
+PGA_STD = 0.06
+PGA_LOWER, PGA_UPPER = 0.2, 0.4  # limits
+
+
+def get_pga_distribution(mean_shift: float = 0):
     """
-    Generates a PGA value between 0.2 and 0.4 using a truncated normal distribution
-    and returns it as a float.
+    Truncated normal distribution of the PGA between 0.2 and 0.4. mean_shift (in
+    standard deviations) moves its mean keeping the limits, e.g. towards the
+    larger PGAs for importance sampling.
     """
-    mu = 0.28  # mean
-    sigma = 0.06  # standard deviation
-    lower, upper = 0.2, 0.4  # limits
+    mu = PGA_MEAN + mean_shift * PGA_STD
 
     # Calculate 'a' and 'b' parameters for truncnorm
-    a, b = (lower - mu) / sigma, (upper - mu) / sigma
+    a, b = (PGA_LOWER - mu) / PGA_STD, (PGA_UPPER - mu) / PGA_STD
+
+    return truncnorm(a, b, loc=mu, scale=PGA_STD)
 
+
+def generate_pga_value() -> float:
+    """
+    Generates a PGA value between 0.2 and 0.4 using a truncated normal distribution
+    and returns it as a float.
+    """
     # Generate value
-    pga_value = truncnorm.rvs(a, b, loc=mu, scale=sigma)
+    pga_value = get_pga_distribution().rvs()
     rounded_pga_value = np.round(pga_value, 7)
 
     return rounded_pga_value
@@ -61,7 +75,67 @@ def format_time(start_seconds, end_seconds):
     return formatted_time
 
 
+def print_stage_times_summary(results_list: list[dict], run_profile: str):
+    """
+    Prints the total and mean time per realization spent in each stage, to compare
+    what every run profile costs.
+    """
+    stage_times = pd.DataFrame(
+        [result["stage_times"] for result in results_list if "stage_times" in result]
+    )
+    if stage_times.empty:
+        return
+
+    summary = pd.DataFrame(
+        {
+            "total [s]": stage_times.sum(),
+            "mean [s]": stage_times.mean(),
+            "share [%]": 100 * stage_times.sum() / stage_times.sum().sum(),
+        }
+    )
+    print(f"Stage times ({run_profile}, {len(stage_times)} realizations):")
+    print(summary.round(2).to_string())
+
+
+def is_invalid_realization(row: pd.Series) -> bool:
+    # Stopped at its first negative pressure, see stop_on_negative_pressure
+    return "invalid_at" in row and pd.notna(row["invalid_at"])
+
+
+def count_reused_scenarios(results: pd.DataFrame) -> int:
+    """
+    Realizations of an experiment whose hydraulic solve was skipped because the
+    same scenario had already been simulated.
+    """
+    if "reused_scenario" not in results.columns:
+        return 0
+    return int(results["reused_scenario"].fillna(False).astype(bool).sum())
+
+
 def generate_excels(output_folder: str, results: pd.DataFrame, sufix: str):
+    store_folder = os.path.join(output_folder, "store")
+    if "mean_t_pressure" not in results.columns and os.path.isdir(store_folder):
+        # The time series were streamed to the result store
+        realization_ids = [
+            row["realization_id"]
+            for _, row in results.iterrows()
+            if not ("error" in row and pd.notna(row["error"]))
+            and not is_invalid_realization(row)
+        ]
+        metrics_dict = {
+            metric: load_store_frame(store_folder, metric, realization_ids)
+            for metric in [
+                "mean_t_pressure",
+                "mean_t_wsa",
+                "todini",
+                "mean_t_flowrate",
+                "mean_t_demand",
+                "mean_t_tank_levels",
+            ]
+        }
+        write_excels(output_folder, metrics_dict, sufix)
+        return
+
     metrics_dict = {
         "mean_t_pressure": {},
         "mean_t_wsa": {},
@@ -76,6 +150,8 @@ def generate_excels(output_folder: str, results: pd.DataFrame, sufix: str):
         if "error" in row and pd.notna(row["error"]):
             print(f"Skipping realization {realization_id} due to error.")
             continue
+        if is_invalid_realization(row):
+            continue  # Discarded, its time series weren't computed
 
         mean_t_pressure = row["mean_t_pressure"]
         mean_t_wsa = row["mean_t_wsa"]
@@ -91,6 +167,10 @@ def generate_excels(output_folder: str, results: pd.DataFrame, sufix: str):
         metrics_dict["mean_t_demand"][realization_id] = mean_t_demand
         metrics_dict["mean_t_tank_levels"][realization_id] = mean_t_tank_levels
 
+    write_excels(output_folder, metrics_dict, sufix)
+
+
+def write_excels(output_folder: str, metrics_dict: dict, sufix: str):
     # Crear DataFrames para cada métrica
     df_average_pressure = pd.DataFrame(metrics_dict["mean_t_pressure"])
     df_wsa = pd.DataFrame(metrics_dict["mean_t_wsa"])
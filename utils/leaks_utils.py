@@ -4,135 +4,124 @@ import wntr
 from wntr.network import WaterNetworkModel
 from decimal import Decimal, ROUND_HALF_UP
 import networkx as nx
-import pickle
-from scipy.stats import lognorm
-
-from utils.types import NetworkPriorityNodes, MitigationLeaksStrategyOptions
-
-def get_damage_states(pga_values:list[float], inp_file:str):
-    wn = WaterNetworkModel(inp_file)
-    FC = wntr.scenario.FragilityCurve()
-    FC.add_state("Moderado", 1, {"Default": lognorm(0.163, scale=1.2 * 0.379)})
-    FC.add_state("Mayor", 2, {"Default": lognorm(0.225, scale=1.2 * 0.385)})
-
-    pga_and_damage_states_list=[]
-    for pga_value in pga_values:
-        pga = pd.Series(pga_value, index=wn.pipe_name_list)
-        failure_probability = FC.cdf_probability(pga)
-        damage_states = FC.sample_damage_state(failure_probability)
-        pga_and_damage_states_list.append((pga_value,damage_states))
-    
-    return pga_and_damage_states_list
+
+from utils.types import (
+    NetworkPriorityNodes,
+    MitigationLeaksStrategyOptions,
+    NetworkIndex,
+)
+from utils.network_utils import get_network, build_network_index
+from utils.archive_utils import load_network_file
+from utils.damage_utils import DamageMatrix, sample_damage_states
+
+def get_damage_states(
+    pga_values: list[float],
+    inp_file: str,
+    network_cache_folder: str | None = None,
+    seed: int | None = None,
+) -> DamageMatrix:
+    """
+    Samples the damage states of every pipe for each PGA value with the
+    fragility curve of generate_fragility_curve, as a DamageMatrix whose items
+    are the (pga, damage_states) pairs of each realization.
+    """
+    wn = get_network(inp_file, cache_folder=network_cache_folder)
+    return sample_damage_states(pga_values, wn.pipe_name_list, seed)
 
 def get_network_priority_nodes(
     wn_filepath: str, mean_node_pressure: pd.Series
 ) -> NetworkPriorityNodes:
-    with open(wn_filepath, "rb") as f:
-        wn = pickle.load(f)
+    wn = load_network_file(wn_filepath)
+    network_index = build_network_index(wn)
 
     return {
-        "betweenness": order_pipes_by_betweenness(wn),
-        "closeness": order_pipes_by_closeness(wn),
-        "pressure": order_pipes_by_pressure(wn, mean_node_pressure),
-        "node_degree": order_pipes_by_node_degree(wn),
+        "betweenness": order_pipes_by_betweenness(wn, network_index),
+        "closeness": order_pipes_by_closeness(wn, network_index),
+        "pressure": order_pipes_by_pressure(wn, mean_node_pressure, network_index),
+        "node_degree": order_pipes_by_node_degree(wn, network_index),
     }
 
 
-def order_pipes_by_betweenness(wn: WaterNetworkModel) -> list[str]:
-    import networkx as nx
-    
+def order_pipes_by_node_values(
+    network_index: NetworkIndex, node_values: np.ndarray
+) -> list[str]:
+    """
+    Orders the pipes by the mean value of their start and end nodes (from highest
+    to lowest, ties keep the network order). node_values follows
+    network_index["node_names"].
+    """
+    # Promedio de los valores de los nodos de inicio y fin
+    pipe_values = (
+        node_values[network_index["pipe_start_nodes"]]
+        + node_values[network_index["pipe_end_nodes"]]
+    ) / 2
+
+    # Ordenar las tuberías (de mayor a menor)
+    order = np.argsort(-pipe_values, kind="stable")
+    pipe_names = network_index["pipe_names"]
+    return [pipe_names[i] for i in order]
+
+
+def order_pipes_by_betweenness(
+    wn: WaterNetworkModel, network_index: NetworkIndex | None = None
+) -> list[str]:
+    if network_index is None:
+        network_index = build_network_index(wn)
+
     # Obtener el grafo de la red
     G = wn.to_graph()
-    
+
     # Calcular la betweenness centrality de los nodos
     bc = nx.betweenness_centrality(G, normalized=True, weight="length")
-    
-    # Calcular la betweenness centrality promedio para cada tubería
-    pipe_centrality = {}
-    for pipe_name, pipe in wn.links():
-        if pipe.link_type == "Pipe":  # Asegurarse de considerar solo tuberías
-            start_node = pipe.start_node.name
-            end_node = pipe.end_node.name
-            # Promedio de la centralidad de los nodos de inicio y fin
-            pipe_centrality[pipe_name] = (bc[start_node] + bc[end_node]) / 2
-
-    # Ordenar las tuberías por su centralidad promedio (de mayor a menor)
-    sorted_pipes = sorted(pipe_centrality.items(), key=lambda x: x[1], reverse=True)
-    
-    # Retornar solo los nombres de las tuberías ordenadas
-    sorted_pipe_names = [pipe_name for pipe_name, _ in sorted_pipes]
-    return sorted_pipe_names
-
-
-def order_pipes_by_closeness(wn: WaterNetworkModel) -> list[str]:
-    import networkx as nx
-    
+
+    node_values = np.array([bc[node] for node in network_index["node_names"]])
+    return order_pipes_by_node_values(network_index, node_values)
+
+
+def order_pipes_by_closeness(
+    wn: WaterNetworkModel, network_index: NetworkIndex | None = None
+) -> list[str]:
+    if network_index is None:
+        network_index = build_network_index(wn)
+
     # Obtener el grafo de la red
     G = wn.to_graph()
-    
+
     # Calcular la closeness centrality de los nodos
     cc = nx.closeness_centrality(G, distance="length")
-    
-    # Calcular la closeness centrality promedio para cada tubería
-    pipe_centrality = {}
-    for pipe_name, pipe in wn.links():
-        if pipe.link_type == "Pipe":  # Asegurarse de considerar solo tuberías
-            start_node = pipe.start_node.name
-            end_node = pipe.end_node.name
-            # Promedio de la centralidad de los nodos de inicio y fin
-            pipe_centrality[pipe_name] = (cc[start_node] + cc[end_node]) / 2
-
-    # Ordenar las tuberías por su centralidad promedio (de mayor a menor)
-    sorted_pipes = sorted(pipe_centrality.items(), key=lambda x: x[1], reverse=True)
-    
-    # Retornar solo los nombres de las tuberías ordenadas
-    sorted_pipe_names = [pipe_name for pipe_name, _ in sorted_pipes]
-    return sorted_pipe_names
-
-
-def order_pipes_by_node_degree(wn: WaterNetworkModel) -> list[str]:
-    # Crear un diccionario para almacenar el grado de cada nodo
-    node_degree = {}
-    nodes = wn.node_name_list
-    for node_name in nodes:
-        links = wn.get_links_for_node(node_name)  # Obtener las tuberías conectadas al nodo
-        degree = len(links)  # El grado del nodo es el número de conexiones
-        node_degree[node_name] = degree
-
-    # Calcular el promedio del grado de los nodos conectados a cada tubería
-    pipe_centrality = {}
-    for pipe_name, pipe in wn.links():
-        if pipe.link_type == "Pipe":  # Considerar solo tuberías
-            start_node = pipe.start_node.name
-            end_node = pipe.end_node.name
-            # Promedio del grado de los nodos de inicio y fin
-            pipe_centrality[pipe_name] = (node_degree[start_node] + node_degree[end_node]) / 2
-
-    # Ordenar las tuberías por el promedio de los grados de sus nodos (de mayor a menor)
-    sorted_pipes = sorted(pipe_centrality.items(), key=lambda x: x[1], reverse=True)
-
-    # Retornar solo los nombres de las tuberías ordenadas
-    sorted_pipe_names = [pipe_name for pipe_name, _ in sorted_pipes]
-    return sorted_pipe_names
+
+    node_values = np.array([cc[node] for node in network_index["node_names"]])
+    return order_pipes_by_node_values(network_index, node_values)
+
+
+def order_pipes_by_node_degree(
+    wn: WaterNetworkModel, network_index: NetworkIndex | None = None
+) -> list[str]:
+    if network_index is None:
+        network_index = build_network_index(wn)
+
+    # El grado del nodo es el número de conexiones (de cualquier tipo de enlace)
+    num_nodes = len(network_index["node_names"])
+    node_degree = np.bincount(
+        network_index["link_start_nodes"], minlength=num_nodes
+    ) + np.bincount(network_index["link_end_nodes"], minlength=num_nodes)
+
+    return order_pipes_by_node_values(network_index, node_degree.astype(float))
+
 
 def order_pipes_by_pressure(
-    wn: WaterNetworkModel, mean_node_pressure: pd.Series
+    wn: WaterNetworkModel,
+    mean_node_pressure: pd.Series,
+    network_index: NetworkIndex | None = None,
 ) -> list[str]:
-    avg_pressure = {}
-    pipes = wn.pipe_name_list
-    for pipe_name in pipes:
-        pipe = wn.get_link(pipe_name)
-        start_node = pipe.start_node.name
-        end_node = pipe.end_node.name
-        # Use the mean pressure directly from the Series for each node
-        avg_pressure[pipe_name] = (
-            mean_node_pressure[start_node] + mean_node_pressure[end_node]
-        ) / 2
+    if network_index is None:
+        network_index = build_network_index(wn)
 
-    # Sort pipes based on computed average pressure
-    sorted_pipes = sorted(avg_pressure.items(), key=lambda x: x[1], reverse=True)
-    sorted_pipe_names = [pipe_name for pipe_name, _ in sorted_pipes]
-    return sorted_pipe_names
+    # Use the mean pressure directly from the Series for each node
+    node_values = mean_node_pressure[network_index["node_names"]].to_numpy(
+        dtype=float
+    )
+    return order_pipes_by_node_values(network_index, node_values)
 
 
 def get_reinforced_pipes(
@@ -188,42 +177,150 @@ def should_calculate_reinforced_pipes(
     return False
 
 
+def get_mitigation_reinforced_pipes(
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None,
+) -> list[str]:
+    if should_calculate_reinforced_pipes(mitigation_leaks_strategy_options):
+        return get_reinforced_pipes(mitigation_leaks_strategy_options)
+    return []
+
+
+# Leak diameter by damage code: fraction of the pipe diameter and maximum [m]
+LEAK_DIAMETER_FRACTION = {1: 0.05, 2: 0.1}
+MAX_LEAK_DIAMETER = {1: 0.0025, 2: 0.0050}
+DAMAGE_CODES = {"Moderado": 1, "Mayor": 2}
+# Reinforced pipes leak through a diameter this much smaller
+REINFORCED_LEAK_DIAMETER_FACTOR = 0.1
+
+
+def get_leak_areas(
+    network_index: NetworkIndex,
+    damage_states: pd.Series,
+    reinforced_pipes: list[str],
+) -> tuple[list[str], np.ndarray]:
+    """
+    Returns the damaged pipes, in the order of damage_states, and the area of
+    their leaks [m2], computed for all of them at once.
+    """
+    damaged = damage_states[damage_states.notna()]
+    pipe_names = list(damaged.index)
+    codes = damaged.map(DAMAGE_CODES).fillna(0).to_numpy(dtype=np.int8)
+    diameters = network_index["pipe_diameters"][
+        [network_index["pipe_position"][pipe_name] for pipe_name in pipe_names]
+    ]
+
+    fraction = np.select(
+        [codes == 2, codes == 1], [LEAK_DIAMETER_FRACTION[2], LEAK_DIAMETER_FRACTION[1]]
+    )
+    max_diameter = np.select(
+        [codes == 2, codes == 1], [MAX_LEAK_DIAMETER[2], MAX_LEAK_DIAMETER[1]]
+    )
+    leak_diameters = np.minimum(fraction * diameters, max_diameter)
+
+    reinforced_pipes = set(reinforced_pipes)
+    is_reinforced = np.array(
+        [pipe_name in reinforced_pipes for pipe_name in pipe_names], dtype=bool
+    )
+    leak_diameters = np.where(
+        is_reinforced, leak_diameters * REINFORCED_LEAK_DIAMETER_FACTOR, leak_diameters
+    )
+
+    leak_areas = np.pi * (leak_diameters / 2) ** 2
+    # Any other damage state still splits the pipe, without a leak
+    leak_areas[codes == 0] = 0
+    return pipe_names, leak_areas
+
+
+def reopen_split_pipe(wn: WaterNetworkModel, pipe_name: str):
+    """
+    split_pipe gives the new half the current status of the pipe. In a network
+    restored from the shared prefix snapshot (see get_prefix_snapshot) that may
+    be a check valve closed by the simulator, which as the initial status of
+    the half would never open again. The half is added again with the initial
+    status of the pipe, and its check valve is left to the simulator.
+    """
+    pipe = wn.get_link(pipe_name)
+    new_pipe = wn.get_link(f"{pipe_name}_A")
+    wn.remove_link(new_pipe.name)
+    wn.add_pipe(
+        new_pipe.name,
+        new_pipe.start_node_name,
+        new_pipe.end_node_name,
+        length=new_pipe.length,
+        diameter=new_pipe.diameter,
+        roughness=new_pipe.roughness,
+        minor_loss=new_pipe.minor_loss,
+        initial_status=pipe.initial_status,
+        check_valve=new_pipe.check_valve,
+    )
+    wn.get_link(new_pipe.name).vertices = new_pipe.vertices
+
+
+def inject_leaks(
+    wn: WaterNetworkModel,
+    pipe_names: list[str],
+    leak_areas: np.ndarray,
+    leak_start_time: int,
+) -> WaterNetworkModel:
+    """
+    Splits every damaged pipe at its midpoint and adds the leak to the new
+    Leak_{pipe} junction, modifying wn in place (it must be a copy of the
+    template, see get_network).
+    """
+    for pipe_name, leak_area in zip(pipe_names, leak_areas):
+        # Same split as before, without split_pipe copying the network each time
+        wntr.morph.split_pipe(
+            wn, pipe_name, f"{pipe_name}_A", f"Leak_{pipe_name}", return_copy=False
+        )
+        # split_pipe copies the minor loss to both halves, so before the leak the
+        # split pipe would lose more head than the undamaged one
+        pipe = wn.get_link(pipe_name)
+        pipe.minor_loss /= 2
+        wn.get_link(f"{pipe_name}_A").minor_loss = pipe.minor_loss
+        if wn.sim_time > 0:
+            reopen_split_pipe(wn, pipe_name)
+        leak_node = wn.get_node(f"Leak_{pipe_name}")
+        leak_node.add_leak(wn, area=float(leak_area), start_time=leak_start_time)
+
+    return wn
+
+
+def set_leak_areas(
+    wn: WaterNetworkModel,
+    pipe_names: list[str],
+    leak_areas: np.ndarray,
+    leak_start_time: int,
+) -> WaterNetworkModel:
+    """
+    Replaces the leaks of a network built by inject_leaks with the same pipes,
+    e.g. to simulate another mitigation of the same damage without splitting
+    them again. The leak controls are added again, since Junction has no
+    setter for leak_area.
+    """
+    for pipe_name, leak_area in zip(pipe_names, leak_areas):
+        leak_node = wn.get_node(f"Leak_{pipe_name}")
+        leak_node.remove_leak(wn)
+        leak_node.add_leak(wn, area=float(leak_area), start_time=leak_start_time)
+
+    return wn
+
+
 def generate_leaks(
     wn: WaterNetworkModel,
     damage_states: pd.Series,
     leak_start_time: int,
     mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None,
+    network_index: NetworkIndex | None = None,
 ) -> tuple[WaterNetworkModel, list[str]]:
-    reinforced_pipes = []
-    should_reinforce = should_calculate_reinforced_pipes(
+    reinforced_pipes = get_mitigation_reinforced_pipes(
         mitigation_leaks_strategy_options
     )
-    if should_reinforce:
-        reinforced_pipes = get_reinforced_pipes(mitigation_leaks_strategy_options)
-
-    for pipe_name, damage_state in damage_states.items():
-        pipe_diameter = wn.get_link(pipe_name).diameter
-        if damage_state is not None:
-            if damage_state == "Mayor":
-                leak_diameter = 0.1 * pipe_diameter
-                leak_diameter = min(leak_diameter, 0.0050)
-                if pipe_name in reinforced_pipes:
-                    leak_diameter = leak_diameter * 0.1
-                leak_area = np.pi * (leak_diameter / 2) ** 2
-            elif damage_state == "Moderado":
-                leak_diameter = 0.05 * pipe_diameter
-                leak_diameter = min(leak_diameter, 0.0025)
-                if pipe_name in reinforced_pipes:
-                    leak_diameter = leak_diameter * 0.1
-                leak_area = np.pi * (leak_diameter / 2) ** 2
-            else:
-                leak_area = 0
-
-            # Add leak to the network
-            wn = wntr.morph.split_pipe(
-                wn, pipe_name, f"{pipe_name}_A", f"Leak_{pipe_name}"
-            )
-            leak_node = wn.get_node(f"Leak_{pipe_name}")
-            leak_node.add_leak(wn, area=leak_area, start_time=leak_start_time)
+
+    if network_index is None:
+        network_index = build_network_index(wn)
+    pipe_names, leak_areas = get_leak_areas(
+        network_index, damage_states, reinforced_pipes
+    )
+    wn = inject_leaks(wn, pipe_names, leak_areas, leak_start_time)
 
     return wn, reinforced_pipes
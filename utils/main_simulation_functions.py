@@ -1,21 +1,189 @@
-import wntr
 from wntr.network import WaterNetworkModel
+from wntr.sim.results import SimulationResults
 import pandas as pd
-import networkx as nx
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import time
 import os
 import pickle
 
-from .types import MitigationLeaksStrategyOptions, SimulationType
-from .charts_utils import generate_charts
-from .leaks_utils import generate_leaks
+from .types import (
+    MitigationLeaksStrategyOptions,
+    SimulationType,
+    HydraulicOptions,
+    RawDataFormat,
+    RunProfile,
+    RunProfileOptions,
+    AdaptiveSamplingOptions,
+    ExperimentVariant,
+)
+from .leaks_utils import (
+    generate_leaks,
+    get_leak_areas,
+    get_mitigation_reinforced_pipes,
+    inject_leaks,
+    set_leak_areas,
+)
+from .network_utils import (
+    get_network,
+    get_network_hash,
+    get_network_index,
+    init_network_worker,
+)
+from .metrics_utils import (
+    get_invalid_at,
+    get_metrics_index,
+    get_satisfied_node_pressure,
+    compute_hydraulic_metrics,
+    label_hydraulic_metrics,
+)
+from .checkpoint_utils import (
+    get_checkpoint_folder,
+    load_checkpoints,
+    save_checkpoint,
+    get_checkpoint_filename,
+)
+from .archive_utils import save_simulation_archive
+from .scenario_utils import (
+    get_realization_fingerprint,
+    get_raw_data_files,
+    save_scenario,
+    load_scenario,
+    copy_scenario_raw_data,
+)
+from .prefix_utils import get_prefix_snapshot, stitch_prefix_results
+from .solver_utils import (
+    WarmStartSimulator,
+    find_warm_start_reference,
+    get_warm_start_reference,
+    print_newton_iterations_summary,
+)
+from .damage_utils import DamageMatrix
+from .sampling_utils import (
+    create_estimators,
+    update_estimators,
+    has_converged,
+    format_estimates,
+)
+from .store_utils import (
+    create_result_store,
+    open_result_store,
+    write_realization,
+    flush_result_store,
+)
+from .catalog_utils import open_catalog, get_catalog_row, record_realizations
 from .general_utils import (
-    generate_pga_series,
-    generate_fragility_curve,
     format_time,
+    print_stage_times_summary,
 )
 
+# Experiment context of this worker process, set by init_simulation_worker
+_worker_context: dict = {}
+
+RUN_PROFILES: dict[RunProfile, RunProfileOptions] = {
+    # Only hydraulics and the WSA/Todini/pressure/demand metrics, for large batches
+    "metrics_only": {
+        "charts": False,
+        "raw_data": False,
+        "topology": False,
+        "verbose": False,
+        "convergence_error": False,
+    },
+    "full": {
+        "charts": True,
+        "raw_data": True,
+        "topology": True,
+        "verbose": True,
+        "convergence_error": False,
+    },
+    # Like full, but a solver that doesn't converge raises instead of warning
+    "debug": {
+        "charts": True,
+        "raw_data": True,
+        "topology": True,
+        "verbose": True,
+        "convergence_error": True,
+    },
+}
+
+
+# Realizations recorded to the catalog at once (the rest when the run ends)
+CATALOG_BATCH_SIZE = 50
+
+
+def end_stage(stage_times: dict[str, float], stage: str, stage_start: float) -> float:
+    """
+    Records the time spent in a stage and returns the start time of the next one.
+    """
+    now = time.time()
+    stage_times[stage] = now - stage_start
+    return now
+
+
+def get_hydraulic_options(
+    total_duration: int, minimum_pressure: float, required_pressure: float
+) -> HydraulicOptions:
+    return {
+        "demand_model": "PDD",
+        "duration": total_duration,
+        "minimum_pressure": minimum_pressure,
+        "required_pressure": required_pressure,
+    }
+
+
+def get_damage_metrics(
+    pga_value: float, damage_states: pd.Series, damage_row: int
+) -> dict:
+    """
+    damage_row is the row of the realization's damage states in the experiment's
+    DamageMatrix (realization_id - 1), kept instead of a copy of them.
+    """
+    damages_count = damage_states.value_counts()
+    major_damages = damages_count.get("Mayor", 0)
+    moderated_damages = damages_count.get("Moderado", 0)
+
+    return {
+        "num_damages": major_damages + moderated_damages,
+        "num_major_damages": major_damages,
+        "num_moderate_damages": moderated_damages,
+        "pga": pga_value,
+        "damage_row": damage_row,
+    }
+
+
+def get_mitigation_metrics(
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions,
+    reinforced_pipes: list[str],
+) -> dict:
+    return {
+        "mitigation_strategy": mitigation_leaks_strategy_options["mitigation_strategy"],
+        "mitigation_reinforcement_percent": mitigation_leaks_strategy_options[
+            "reinforcement_percent"
+        ],
+        "mitigation_reinforced_pipes": reinforced_pipes,
+    }
+
+
+def save_raw_data(
+    output_folder: str,
+    realization_id: int,
+    wn: WaterNetworkModel,
+    simulation_results: SimulationResults,
+    raw_data_format: RawDataFormat,
+):
+    raw_data_files = get_raw_data_files(output_folder, realization_id, raw_data_format)
+    if raw_data_format == "archive":
+        save_simulation_archive(raw_data_files[0], wn, simulation_results)
+        return
+
+    wn_filename, sim_results_filename = raw_data_files
+    os.makedirs(os.path.dirname(wn_filename), exist_ok=True)
+
+    with open(wn_filename, "wb") as f:
+        pickle.dump(wn, f)
+
+    with open(sim_results_filename, "wb") as f:
+        pickle.dump(simulation_results, f)
+
 
 def simulate_wrapper(
     inp_file: str,
@@ -29,223 +197,533 @@ def simulate_wrapper(
     pga_value: float,
     damage_states: pd.Series,
     output_folder: str,
+    network_cache_folder: str | None = None,
+    topology_cache_folder: str | None = None,
+    raw_data_format: RawDataFormat = "pickle",
+    run_profile: RunProfile = "full",
+    warm_start_folder: str | None = None,
+    clean_warm_start_folder: str | None = None,
+    shared_prefix: bool = False,
+    stop_on_negative_pressure: bool = False,
+    network: tuple[WaterNetworkModel, SimulationResults | None] | None = None,
+    warm_start_reference: tuple[str | None, dict | None] | None = None,
+    return_simulation_results: bool = False,
 ):
+    """
+    warm_start_folder and clean_warm_start_folder are output folders of other
+    experiments with raw data, e.g. the unmitigated earthquake and the clean run.
+    When one has results for this realization, the solver starts from them at
+    t=0 and at leak_start_time instead of from scratch.
+
+    With shared_prefix, an earthquake realization is only simulated from
+    leak_start_time, continuing the clean run paused there (simulated once per
+    worker), and its results are completed with the clean run before that time.
+
+    With stop_on_negative_pressure, a realization that reaches a negative
+    pressure (the criterion that later discards it) stops there and is recorded
+    with invalid_at (the first time with negative pressure), its damage and its
+    minimum pressures only, skipping raw data, topology and the other metrics.
+
+    network is the realization's network already with the leaks of this
+    mitigation, and the prefix results it continues (or None), when the caller
+    builds it (see simulate_realization_variants). warm_start_reference, a
+    (kind, reference) pair, replaces the lookup in the warm start folders. With
+    return_simulation_results it returns (metrics, simulation_results), the
+    latter None if the realization fails.
+    """
     try:
         start_time = time.time()
-        # Reconstruct the network within each worker process
-        wn = WaterNetworkModel(inp_file)
-        wn.options.hydraulic.demand_model = "PDD"
-        wn.options.time.duration = total_duration
-        wn.options.hydraulic.minimum_pressure = minimum_pressure
-        wn.options.hydraulic.required_pressure = required_pressure
+        profile = RUN_PROFILES[run_profile]
+        # Seconds spent in each stage of the realization
+        stage_times = {}
+        stage_start = start_time
 
-        if simulation_type == "Earthquake":
-            # pga = generate_pga_series(pga_value, wn)
-            FC = generate_fragility_curve()
-            # failure_probability = FC.cdf_probability(pga)
-            # damage_states = FC.sample_damage_state(failure_probability)
+        # Clone the network from the template parsed once per worker process
+        hydraulic_options = get_hydraulic_options(
+            total_duration, minimum_pressure, required_pressure
+        )
+        prefix_snapshot = None
+        if network is not None:
+            prefix_snapshot = network
+        elif shared_prefix and simulation_type == "Earthquake":
+            prefix_snapshot = get_prefix_snapshot(
+                inp_file, hydraulic_options, leak_start_time, network_cache_folder
+            )
+        if prefix_snapshot is not None:
+            wn, prefix_results = prefix_snapshot
+        else:
+            wn, prefix_results = (
+                get_network(inp_file, hydraulic_options, network_cache_folder),
+                None,
+            )
+        network_index = get_network_index(
+            inp_file, hydraulic_options, network_cache_folder
+        )
+        stage_start = end_stage(stage_times, "network", stage_start)
+
+        if simulation_type == "Earthquake" and network is not None:
+            reinforced_pipes = get_mitigation_reinforced_pipes(
+                mitigation_leaks_strategy_options
+            )
+        elif simulation_type == "Earthquake":
             actual_time = time.time()
             formated_time = format_time(start_time, actual_time)
-            print(
-                f"Iteration {realization_id}: adding leaks for pga: {pga_value} ({formated_time})"
-            )
+            if profile["verbose"]:
+                print(
+                    f"Iteration {realization_id}: adding leaks for pga: {pga_value} ({formated_time})"
+                )
 
             wn, reinforced_pipes = generate_leaks(
                 wn=wn,
                 damage_states=damage_states,
                 leak_start_time=leak_start_time,
                 mitigation_leaks_strategy_options=mitigation_leaks_strategy_options,
+                network_index=network_index,
             )
+            stage_start = end_stage(stage_times, "leaks", stage_start)
 
         # Simulate the network
         actual_time = time.time()
-        print(
-            f"Iteration {realization_id}: simulating ({format_time(start_time, actual_time)})"
-        )
-        sim = wntr.sim.WNTRSimulator(wn)
-        simulation_results = sim.run_sim()
-
-        # Guardar wn y simulation_results
-        simulation_data_folder = os.path.join(output_folder, "simulation_data")
-        os.makedirs(simulation_data_folder, exist_ok=True)
-        wn_filename = os.path.join(
-            simulation_data_folder, f"wn_realization_{realization_id}.pickle"
-        )
-        sim_results_filename = os.path.join(
-            simulation_data_folder, f"simulation_results_{realization_id}.pickle"
+        if profile["verbose"]:
+            print(
+                f"Iteration {realization_id}: simulating ({format_time(start_time, actual_time)})"
+            )
+        if warm_start_reference is not None:
+            warm_start, reference = warm_start_reference
+        else:
+            warm_start, reference = find_warm_start_reference(
+                realization_id, warm_start_folder, clean_warm_start_folder
+            )
+        # Only the first step and the one where the leaks open are seeded, the
+        # other steps already start from the previous one
+        sim = WarmStartSimulator(
+            wn,
+            reference,
+            seed_times={0, leak_start_time},
+            stop_on_negative_pressure=stop_on_negative_pressure,
         )
+        simulation_results = sim.run_sim(convergence_error=profile["convergence_error"])
+        if prefix_results is not None:
+            simulation_results = stitch_prefix_results(
+                prefix_results, simulation_results, wn
+            )
+        stage_start = end_stage(stage_times, "hydraulics", stage_start)
 
-        with open(wn_filename, "wb") as f:
-            pickle.dump(wn, f)
+        invalid_at = None
+        if stop_on_negative_pressure:
+            invalid_at = get_invalid_at(simulation_results.node["pressure"])
+            if invalid_at is not None and profile["verbose"]:
+                print(
+                    f"Iteration {realization_id}: negative pressure at "
+                    f"{invalid_at / 3600:g} h, discarded"
+                )
 
-        with open(sim_results_filename, "wb") as f:
-            pickle.dump(simulation_results, f)
+        # Guardar wn y simulation_results
+        if profile["raw_data"] and invalid_at is None:
+            save_raw_data(
+                output_folder, realization_id, wn, simulation_results, raw_data_format
+            )
+            stage_start = end_stage(stage_times, "raw_data", stage_start)
 
         # Calculate metrics
         actual_time = time.time()
-        print(
-            f"Iteration {realization_id}: calculating metrics ({format_time(start_time, actual_time)})"
-        )
-        metrics = {}
+        if profile["verbose"]:
+            print(
+                f"Iteration {realization_id}: calculating metrics ({format_time(start_time, actual_time)})"
+            )
+        metrics = {
+            "reused_scenario": False,
+            "warm_start": warm_start if sim.reference is not None else None,
+            "newton_iterations": sim.newton_iterations,
+            "invalid_at": invalid_at,
+        }
         if simulation_type == "Earthquake":
-            damages_count = damage_states.value_counts()
-            major_damages = damages_count.get("Mayor", 0)
-            moderated_damages = damages_count.get("Moderado", 0)
-
-            metrics["num_damages"] = major_damages + moderated_damages
-            metrics["num_major_damages"] = major_damages
-            metrics["num_moderate_damages"] = moderated_damages
-            metrics["pga"] = pga_value
-            metrics["damage_states"] = damage_states
-
-        G = wn.get_graph()
+            metrics.update(
+                get_damage_metrics(pga_value, damage_states, realization_id - 1)
+            )
 
         # ===== Topologic =====
-        # Betweenness centrality
-        bc = nx.betweenness_centrality(G, normalized=True, weight="length")
-        metrics["betweenness_centrality"] = bc
-
-        # Closeness centrality
-        cc = nx.closeness_centrality(G, distance="length")
-        metrics["closeness_centrality"] = cc
+        # Betweenness/closeness centrality, node degree and bridges
+        if profile["topology"] and invalid_at is None:
+            from .topology_utils import get_topology_metrics
 
-        # Node degree
-        node_degree = G.degree()
-        metrics["node_degree"] = node_degree
-
-        # Bridges
-        bridges = list(wntr.metrics.bridges(G))
-        metrics["bridges"] = bridges
+            split_pipes = (
+                list(damage_states.dropna().index)
+                if simulation_type == "Earthquake"
+                else []
+            )
+            topology_metrics = get_topology_metrics(
+                wn, get_network_hash(inp_file), split_pipes, topology_cache_folder
+            )
+            metrics.update(topology_metrics)
+            stage_start = end_stage(stage_times, "topology", stage_start)
 
         # ===== Hydraulic =====
-        # Avg pressure
         pressure = simulation_results.node["pressure"]
-        mean_node_pressure = pressure.mean()
-        mean_t_pressure = pressure.mean(axis=1)
-        mean_system_pressure = pressure.mean().mean()
-        metrics["pressure"] = pressure
-        metrics["mean_node_pressure"] = mean_node_pressure
-        metrics["min_system_pressure"] = pressure.min().min()
-        metrics["mean_t_pressure"] = mean_t_pressure
-        metrics["mean_system_pressure"] = mean_system_pressure
-        junctions = wn.junction_name_list
-        junctions_pressure = pressure[junctions]
-        metrics["min_system_junctions_pressure"] = junctions_pressure.min().min()
-
-        # Todini
-        head = simulation_results.node["head"]
-        pressure = simulation_results.node["pressure"]
-        demand = simulation_results.node["demand"]
-        flowrate = simulation_results.link["flowrate"]
-        pump_flowrate = simulation_results.link["flowrate"].loc[:, wn.pump_name_list]
-
-        Pout = demand.loc[:,wn.junction_name_list]*head.loc[:,wn.junction_name_list]
-        elevation = head.loc[:,wn.junction_name_list]-pressure.loc[:,wn.junction_name_list]
-        Pexp = demand.loc[:,wn.junction_name_list]*(required_pressure+elevation)
-
-        Pin_res = -demand.loc[:,wn.reservoir_name_list]*head.loc[:,wn.reservoir_name_list]
-
-        headloss = pd.DataFrame()
-        for name, link in wn.pumps():
-            if name != '1':
-                start_node = link.start_node_name
-                end_node = link.end_node_name
-                start_head = head.loc[:,start_node] # (m)
-                end_head = head.loc[:,end_node] # (m)
-                headloss[name] = end_head - start_head # (m)
-            
-        Pin_pump = flowrate.loc[:,wn.pump_name_list]*headloss.abs()
-
-        todini: pd.Series = (Pout.sum(axis=1) - Pexp.sum(axis=1))/  \
-            (Pin_res.sum(axis=1) + Pin_pump.sum(axis=1) - Pexp.sum(axis=1))
-        
-        #todini: pd.Series = wntr.metrics.todini_index(
-        #   head, pressure, demand, pump_flowrate, wn, required_pressure
-        #)
-
-        metrics["todini"] = todini
-
-        # WSA
-        demand_nodes = wn.junction_name_list
-        demand_nodes_index = [
-            node
-            for node in demand_nodes
-            if wn.get_node(node).demand_timeseries_list[0].base_value > 0
-        ]
-        demand = simulation_results.node["demand"]
-
-        filtered_demand = demand[demand_nodes_index]
-        filtered_expected_demand = wntr.metrics.expected_demand(wn)[demand_nodes_index]
+        if invalid_at is not None:
+            # Only what the filtering of discarded realizations reads
+            metrics["min_system_pressure"] = float(pressure.min().min())
+            metrics["min_system_junctions_pressure"] = float(
+                pressure[wn.junction_name_list].min().min()
+            )
+        else:
+            # Pressure, Todini, WSA, demand and tank levels in one pass over the
+            # raw arrays of the results
+            flowrate = simulation_results.link["flowrate"]
+            times = list(pressure.index)
+            demand_nodes_index = network_index["demand_node_names"]
+            time_rows = pd.Index(network_index["times"]).get_indexer(times)
+            if (time_rows < 0).any():
+                # get_indexer gives -1 for them, which would select the last row
+                raise ValueError(
+                    "Reported times without an expected demand in the network "
+                    f"index: {[t for t, row in zip(times, time_rows) if row < 0]}"
+                )
+            expected_demand = network_index["expected_demand"][time_rows]
 
-        wsa: pd.DataFrame = wntr.metrics.water_service_availability(
-            filtered_expected_demand, filtered_demand
-        )
-        mean_t_wsa = wsa.mean(axis=1)
-        mean_system_wsa = mean_t_wsa.mean()
-        metrics["wsa"] = wsa
-        metrics["mean_t_wsa"] = mean_t_wsa
-        metrics["mean_system_wsa"] = mean_system_wsa
-
-        # Others
-        flowrate = simulation_results.link["flowrate"]
-        mean_t_flowrate = flowrate.mean(axis=1)
-        metrics["mean_t_flowrate"] = mean_t_flowrate
-
-        demand = simulation_results.node["demand"]
-        filtered_demand = demand[wn.junction_name_list]
-        mean_t_demand = filtered_demand.sum(axis=1)
-        metrics["mean_t_demand"] = mean_t_demand
-
-        head = simulation_results.node["head"]
-        tank_names = wn.tank_name_list
-        tank_levels = head[tank_names]
-        mean_t_tank_levels = tank_levels.mean(axis=1)
-        metrics["mean_t_tank_levels"] = mean_t_tank_levels
+            hydraulic_metrics = compute_hydraulic_metrics(
+                pressure.to_numpy(),
+                simulation_results.node["head"].to_numpy(),
+                simulation_results.node["demand"].to_numpy(),
+                flowrate.to_numpy(),
+                get_metrics_index(
+                    wn,
+                    list(pressure.columns),
+                    list(flowrate.columns),
+                    demand_node_names=demand_nodes_index,
+                ),
+                expected_demand,
+                required_pressure,
+            )
+            metrics["pressure"] = pressure
+            metrics.update(
+                label_hydraulic_metrics(
+                    hydraulic_metrics, times, list(pressure.columns), demand_nodes_index
+                )
+            )
+            # Computed here since the store only keeps the pressures of base nodes
+            metrics.update(get_satisfied_node_pressure(pressure))
 
         metrics["realization_id"] = realization_id
         # Add mitigation data
         if simulation_type == "Earthquake" and mitigation_leaks_strategy_options is not None:
-            mitigation_strategy = mitigation_leaks_strategy_options[
-                "mitigation_strategy"
-            ]
-            reinforcement_percent = mitigation_leaks_strategy_options[
-                "reinforcement_percent"
-            ]
+            metrics.update(
+                get_mitigation_metrics(
+                    mitigation_leaks_strategy_options, reinforced_pipes
+                )
+            )
+        stage_start = end_stage(stage_times, "metrics", stage_start)
 
-            metrics["mitigation_strategy"] = mitigation_strategy
-            metrics["mitigation_reinforcement_percent"] = reinforcement_percent
-            metrics["mitigation_reinforced_pipes"] = reinforced_pipes
+        actual_time = time.time()
+        if profile["verbose"]:
+            print(
+                f"Iteration {realization_id}: Done ({format_time(start_time, actual_time)})"
+            )
+        metrics["realization_time"] = format_time(start_time, actual_time)
+        metrics["stage_times"] = stage_times
+        if return_simulation_results:
+            return metrics, simulation_results
+        return metrics
+    except Exception as e:
+        print(f"Error in realization {realization_id}: {e}")
+        metrics = {"realization_id": realization_id, "error": str(e)}
+        if return_simulation_results:
+            return metrics, None
+        return metrics
 
-        # Generate Charts
-        charts_data_folder = os.path.join(output_folder, "charts")
-        os.makedirs(charts_data_folder, exist_ok=True)
 
-        print(
-            f"Iteration {realization_id}: generating Charts ({format_time(start_time, actual_time)})"
+def get_reused_scenario_metrics(
+    scenario_metrics: dict,
+    simulation_type: SimulationType,
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None,
+    realization_id: int,
+    pga_value: float,
+    damage_states: pd.Series,
+) -> dict:
+    """
+    Metrics of a realization whose scenario was already simulated: the results
+    of the source realization with this realization's own identity (pga,
+    damage counts and mitigation fields).
+    """
+    metrics = {
+        key: value
+        for key, value in scenario_metrics.items()
+        if not key.startswith("mitigation_")
+        and key not in ["stage_times", "warm_start", "newton_iterations"]
+    }
+    metrics["realization_id"] = realization_id
+    metrics["reused_scenario"] = True
+    metrics["realization_time"] = format_time(0, 0)
+    if simulation_type == "Earthquake":
+        metrics.update(
+            get_damage_metrics(pga_value, damage_states, realization_id - 1)
         )
-        generate_charts(
-            simulation_type,
-            inp_file,
-            charts_data_folder,
+        if mitigation_leaks_strategy_options is not None:
+            metrics.update(
+                get_mitigation_metrics(
+                    mitigation_leaks_strategy_options,
+                    get_mitigation_reinforced_pipes(mitigation_leaks_strategy_options),
+                )
+            )
+
+    return metrics
+
+
+def estimate_realization_cost(
+    simulation_type: SimulationType,
+    pga_values_and_damage_states: list[(float, pd.Series)],
+    realization_index: int,
+) -> int:
+    """
+    Rough cost of a realization: every damaged pipe adds a leak node to the
+    network, so the number of damaged pipes drives the solve time.
+    """
+    if simulation_type != "Earthquake":
+        return 0
+    if isinstance(pga_values_and_damage_states, DamageMatrix):
+        # Counted on the int8 matrix, without building the damage states
+        return pga_values_and_damage_states.get_num_damages(realization_index)
+    damage_states = pga_values_and_damage_states[realization_index][1]
+    return int(damage_states.notna().sum())
+
+
+def init_simulation_worker(hydraulic_options: HydraulicOptions, context: dict):
+    """
+    Process pool initializer. Parses the network and keeps the experiment context
+    so each task only needs to send its realization index.
+    """
+    global _worker_context
+    init_network_worker(
+        context["inp_file"], hydraulic_options, context["network_cache_folder"]
+    )
+    _worker_context = context
+
+
+def simulate_realization(realization_index: int):
+    context = _worker_context
+    is_earthquake = context["simulation_type"] == "Earthquake"
+    pga_values_and_damage_states = context["pga_values_and_damage_states"]
+
+    return simulate_wrapper(
+        context["inp_file"],
+        context["simulation_type"],
+        context["mitigation_leaks_strategy_options"],
+        context["leak_start_time"],
+        context["required_pressure"],
+        realization_index + 1,
+        context["total_duration"],
+        context["minimum_pressure"],
+        pga_values_and_damage_states[realization_index][0] if is_earthquake else 0,
+        pga_values_and_damage_states[realization_index][1] if is_earthquake else 0,
+        context["output_folder"],
+        context["network_cache_folder"],
+        context["topology_cache_folder"],
+        context["raw_data_format"],
+        context["run_profile"],
+        context["warm_start_folder"],
+        context["clean_warm_start_folder"],
+        context["shared_prefix"],
+        context["stop_on_negative_pressure"],
+    )
+
+
+def prepare_variant_network(
+    context: dict,
+    wn: WaterNetworkModel | None,
+    pipe_names: list[str],
+    leak_areas,
+    stage_times: dict[str, float],
+) -> tuple[WaterNetworkModel, SimulationResults | None]:
+    """
+    Network of the next variant of a realization with its leaks. The network of
+    the previous variant (wn) is reset to t=0 and only its leaks are changed.
+    Continuing the shared prefix it is rebuilt from the snapshot instead, since
+    the prefix state can't be reset and the snapshot is cheaper than a copy of
+    the split network.
+    """
+    stage_start = time.time()
+    hydraulic_options = get_hydraulic_options(
+        context["total_duration"],
+        context["minimum_pressure"],
+        context["required_pressure"],
+    )
+    if wn is not None and not context["use_prefix"]:
+        wn.reset_initial_values()
+        stage_start = end_stage(stage_times, "network", stage_start)
+        wn = set_leak_areas(wn, pipe_names, leak_areas, context["leak_start_time"])
+        end_stage(stage_times, "leaks", stage_start)
+        return wn, None
+
+    prefix_snapshot = None
+    if context["use_prefix"]:
+        prefix_snapshot = get_prefix_snapshot(
+            context["inp_file"],
+            hydraulic_options,
+            context["leak_start_time"],
+            context["network_cache_folder"],
+        )
+    if prefix_snapshot is not None:
+        wn, prefix_results = prefix_snapshot
+    else:
+        wn, prefix_results = (
+            get_network(
+                context["inp_file"], hydraulic_options, context["network_cache_folder"]
+            ),
+            None,
+        )
+    stage_start = end_stage(stage_times, "network", stage_start)
+    wn = inject_leaks(wn, pipe_names, leak_areas, context["leak_start_time"])
+    end_stage(stage_times, "leaks", stage_start)
+    return wn, prefix_results
+
+
+def simulate_realization_variants(
+    realization_index: int, variant_indexes: list[int]
+) -> list[dict]:
+    """
+    Simulates one damage draw under each variant of variant_indexes (see
+    simulate_network_variants_parallel) and returns their metrics in that order.
+
+    The damaged pipes are split once for all of them, the variants only change
+    the leak areas. A variant with the same leaks as one already solved (e.g.
+    none of its reinforced pipes is damaged) reuses its results, and the others
+    start their solver from the unmitigated variant kept in memory.
+    """
+    context = _worker_context
+    variants = context["variants"]
+    profile = RUN_PROFILES[context["run_profile"]]
+    realization_id = realization_index + 1
+    pga_value, damage_states = context["pga_values_and_damage_states"][
+        realization_index
+    ]
+    network_index = get_network_index(
+        context["inp_file"],
+        get_hydraulic_options(
+            context["total_duration"],
+            context["minimum_pressure"],
+            context["required_pressure"],
+        ),
+        context["network_cache_folder"],
+    )
+    # The unmitigated variant first, so the others can start from it
+    solve_order = sorted(
+        variant_indexes,
+        key=lambda i: variants[i]["mitigation_leaks_strategy_options"] is not None,
+    )
+    unmitigated_folder = next(
+        (
+            variant["output_folder"]
+            for variant in variants
+            if variant["mitigation_leaks_strategy_options"] is None
+        ),
+        None,
+    )
+
+    wn, unmitigated_reference = None, None
+    # Leak areas of the variants solved in this task -> (metrics, output_folder)
+    solved_scenarios = {}
+    results = {}
+    for variant_index in solve_order:
+        variant = variants[variant_index]
+        options = variant["mitigation_leaks_strategy_options"]
+        try:
+            pipe_names, leak_areas = get_leak_areas(
+                network_index,
+                damage_states,
+                get_mitigation_reinforced_pipes(options),
+            )
+        except Exception as e:
+            print(f"Error in realization {realization_id}: {e}")
+            results[variant_index] = {"realization_id": realization_id, "error": str(e)}
+            continue
+
+        scenario = leak_areas.tobytes()
+        if scenario in solved_scenarios:
+            scenario_metrics, source_folder = solved_scenarios[scenario]
+            entry = {
+                "output_folder": source_folder,
+                "realization_id": realization_id,
+                "raw_data_format": context["raw_data_format"],
+            }
+            # Discarded realizations have no raw data to share
+            if (
+                not profile["raw_data"]
+                or pd.notna(scenario_metrics.get("invalid_at"))
+                or copy_scenario_raw_data(
+                    entry,
+                    variant["output_folder"],
+                    realization_id,
+                    context["raw_data_format"],
+                )
+            ):
+                results[variant_index] = get_reused_scenario_metrics(
+                    scenario_metrics,
+                    "Earthquake",
+                    options,
+                    realization_id,
+                    pga_value,
+                    damage_states,
+                )
+                continue
+
+        stage_times = {}
+        try:
+            network = prepare_variant_network(
+                context, wn, pipe_names, leak_areas, stage_times
+            )
+        except Exception as e:
+            print(f"Error in realization {realization_id}: {e}")
+            results[variant_index] = {"realization_id": realization_id, "error": str(e)}
+            wn = None
+            continue
+        wn = network[0]
+
+        warm_start_reference = None
+        if context["warm_start"] and options is not None:
+            if unmitigated_reference is not None:
+                warm_start_reference = ("unmitigated", unmitigated_reference)
+            else:
+                # Solved by an earlier run, from its raw data if it has them
+                warm_start_reference = find_warm_start_reference(
+                    realization_id,
+                    unmitigated_folder,
+                    context["clean_warm_start_folder"],
+                )
+
+        metrics, simulation_results = simulate_wrapper(
+            context["inp_file"],
+            "Earthquake",
+            options,
+            context["leak_start_time"],
+            context["required_pressure"],
             realization_id,
-            wn,
-            FC if simulation_type == "Earthquake" else None,
-            damage_states if simulation_type == "Earthquake" else None,
+            context["total_duration"],
+            context["minimum_pressure"],
             pga_value,
-            mean_t_wsa,
-            todini,
-            pressure,
+            damage_states,
+            variant["output_folder"],
+            context["network_cache_folder"],
+            context["topology_cache_folder"],
+            context["raw_data_format"],
+            context["run_profile"],
+            clean_warm_start_folder=(
+                context["clean_warm_start_folder"] if context["warm_start"] else None
+            ),
+            stop_on_negative_pressure=context["stop_on_negative_pressure"],
+            network=network,
+            warm_start_reference=warm_start_reference,
+            return_simulation_results=True,
         )
+        results[variant_index] = metrics
+        if "error" in metrics:
+            continue
 
-        actual_time = time.time()
-        print(
-            f"Iteration {realization_id}: Done ({format_time(start_time, actual_time)})"
-        )
-        metrics["realization_time"] = format_time(start_time, actual_time)
-        return metrics
-    except Exception as e:
-        print(f"Error in realization {realization_id}: {e}")
-        return {"realization_id": realization_id, "error": str(e)}
+        metrics["stage_times"].update(stage_times)
+        solved_scenarios[scenario] = (metrics, variant["output_folder"])
+        if options is None and context["warm_start"]:
+            unmitigated_reference = get_warm_start_reference(simulation_results)
+
+    return [results[variant_index] for variant_index in variant_indexes]
 
 
 def simulate_network_parallel(
@@ -260,33 +738,514 @@ def simulate_network_parallel(
     total_duration: int,
     minimum_pressure: float,
     output_folder: str,
+    network_cache_folder: str | None = None,
+    topology_cache_folder: str | None = None,
+    max_in_flight_per_worker: int = 2,
+    checkpoint_folder: str | None = None,
+    result_store_folder: str | None = None,
+    raw_data_format: RawDataFormat = "pickle",
+    run_profile: RunProfile = "full",
+    chart_realization_ids: list[int] | None = None,
+    scenario_cache_folder: str | None = None,
+    warm_start_folder: str | None = None,
+    clean_warm_start_folder: str | None = None,
+    shared_prefix: bool = False,
+    stop_on_negative_pressure: bool = False,
+    adaptive_sampling: AdaptiveSamplingOptions | None = None,
+    sampling_weights: list[float] | None = None,
+    catalog_file: str | None = None,
 ) -> pd.DataFrame:
+    """
+    Simulates num_realizations realizations (realization i uses the i-th damage
+    draw) in a process pool. With adaptive_sampling, num_realizations is only the
+    budget: realizations run in batches until the tracked estimators reach their
+    target precision, see AdaptiveSamplingOptions.
+
+    sampling_weights are the likelihood ratios of the damage draws when they
+    come from importance sampling (see sample_earthquake_scenarios). Each result
+    carries its own as sampling_weight, for the estimators and the analysis.
+
+    With catalog_file, the scalars of every realization are also recorded to
+    that SQLite catalog, under the run of output_folder (see catalog_utils).
+    """
     results_list = []
+    profile = RUN_PROFILES[run_profile]
+    hydraulic_options = get_hydraulic_options(
+        total_duration, minimum_pressure, required_pressure
+    )
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = [
-            executor.submit(
-                simulate_wrapper,
-                inp_file,
+    # Arrays of each realization go to the store as they arrive, only the
+    # scalars are kept in memory
+    store = None
+    if result_store_folder is not None:
+        network_index = get_network_index(
+            inp_file, hydraulic_options, network_cache_folder
+        )
+        create_result_store(
+            result_store_folder,
+            num_realizations,
+            network_index["times"],
+            network_index["node_names"],
+            network_index["demand_node_names"],
+        )
+        store = open_result_store(result_store_folder)
+
+    # Running estimates of the experiment, for adaptive sampling
+    estimators = create_estimators()
+
+    # Scalars of each realization for the catalog, recorded in batches
+    catalog = open_catalog(catalog_file) if catalog_file is not None else None
+    catalog_rows = []
+
+    def add_result(result: dict, checkpoint: bool = True):
+        if sampling_weights is not None and "error" not in result:
+            result["sampling_weight"] = sampling_weights[result["realization_id"] - 1]
+        update_estimators(estimators, result)
+        if catalog is not None:
+            catalog_rows.append(
+                get_catalog_row(
+                    output_folder,
+                    simulation_type,
+                    mitigation_leaks_strategy_options,
+                    result,
+                )
+            )
+            if len(catalog_rows) >= CATALOG_BATCH_SIZE:
+                record_realizations(catalog, catalog_rows)
+                catalog_rows.clear()
+        if store is not None:
+            result = write_realization(store, result)
+        # After the store, so the checkpoint only has what is kept in memory
+        if checkpoint and checkpoint_folder is not None:
+            save_checkpoint(checkpoint_folder, result)
+        results_list.append(result)
+
+    completed_realization_ids = set()
+    if checkpoint_folder is not None:
+        for result in load_checkpoints(checkpoint_folder):
+            # Its arrays may not have reached the store before the interruption
+            if store is not None and not store["written"][result["realization_id"] - 1]:
+                continue
+            completed_realization_ids.add(result["realization_id"])
+            add_result(result, checkpoint=False)
+        if completed_realization_ids:
+            print(
+                f"Resuming: {len(completed_realization_ids)} realizations already "
+                "completed"
+            )
+
+    # Read-only data shared by every realization, shipped once to each worker
+    context = {
+        "inp_file": inp_file,
+        "simulation_type": simulation_type,
+        "mitigation_leaks_strategy_options": mitigation_leaks_strategy_options,
+        "leak_start_time": leak_start_time,
+        "required_pressure": required_pressure,
+        "total_duration": total_duration,
+        "minimum_pressure": minimum_pressure,
+        "pga_values_and_damage_states": pga_values_and_damage_states,
+        "output_folder": output_folder,
+        "network_cache_folder": network_cache_folder,
+        "topology_cache_folder": topology_cache_folder,
+        "raw_data_format": raw_data_format,
+        "run_profile": run_profile,
+        "warm_start_folder": warm_start_folder,
+        "clean_warm_start_folder": clean_warm_start_folder,
+        "shared_prefix": shared_prefix,
+        "stop_on_negative_pressure": stop_on_negative_pressure,
+    }
+
+    pending_indexes = [
+        i for i in range(num_realizations) if i + 1 not in completed_realization_ids
+    ]
+
+    # Realizations whose scenario (effective leaks) was already simulated in this
+    # experiment, e.g. by a smaller reinforcement of the same strategy, reuse its
+    # checkpoint instead of being solved again
+    fingerprints = {}
+    use_scenario_cache = (
+        scenario_cache_folder is not None and checkpoint_folder is not None
+    )
+    if use_scenario_cache:
+        network_hash = get_network_hash(inp_file, hydraulic_options)
+        network_index = get_network_index(
+            inp_file, hydraulic_options, network_cache_folder
+        )
+
+    def reuse_scenarios(indexes: list[int]) -> list[int]:
+        """
+        Adds the realizations of indexes whose scenario can be reused and returns
+        the ones left to solve.
+        """
+        if not use_scenario_cache:
+            return indexes
+
+        is_earthquake = simulation_type == "Earthquake"
+        indexes_to_solve = []
+        for i in indexes:
+            pga_value, damage_states = (
+                pga_values_and_damage_states[i] if is_earthquake else (0, None)
+            )
+            fingerprint = get_realization_fingerprint(
+                network_hash,
+                network_index,
                 simulation_type,
-                mitigation_leaks_strategy_options,
                 leak_start_time,
-                required_pressure,
+                damage_states,
+                mitigation_leaks_strategy_options,
+                stop_on_negative_pressure,
+                shared_prefix and is_earthquake,
+            )
+            entry = load_scenario(scenario_cache_folder, fingerprint)
+            # Discarded realizations have no topology nor raw data to share
+            discarded = entry is not None and pd.notna(
+                entry["metrics"].get("invalid_at")
+            )
+            reusable = (
+                entry is not None
+                and (
+                    not profile["topology"]
+                    or discarded
+                    or "bridges" in entry["metrics"]
+                )
+                and (
+                    not profile["raw_data"]
+                    or discarded
+                    or copy_scenario_raw_data(
+                        entry, output_folder, i + 1, raw_data_format
+                    )
+                )
+            )
+            if not reusable:
+                fingerprints[i] = fingerprint
+                indexes_to_solve.append(i)
+                continue
+
+            result = get_reused_scenario_metrics(
+                entry["metrics"],
+                simulation_type,
+                mitigation_leaks_strategy_options,
                 i + 1,
-                total_duration,
-                minimum_pressure,
-                pga_values_and_damage_states[i][0] if simulation_type == "Earthquake" else 0,
-                pga_values_and_damage_states[i][1] if simulation_type == "Earthquake" else 0,
-                output_folder,
+                pga_value,
+                damage_states,
             )
-            for i in range(num_realizations)
+            add_result(result)
+
+        num_reused_scenarios = len(indexes) - len(indexes_to_solve)
+        print(
+            f"Scenarios already simulated: {num_reused_scenarios} of "
+            f"{len(indexes)} solves skipped"
+        )
+        return indexes_to_solve
+
+    # With adaptive sampling the realizations run in order of id, batch by batch,
+    # so every experiment covers the same first damage draws and stays paired
+    # with the others whatever its stopping point
+    if adaptive_sampling is None:
+        batches = [pending_indexes]
+    else:
+        batch_size = adaptive_sampling["batch_size"]
+        batches = [
+            pending_indexes[start : start + batch_size]
+            for start in range(0, len(pending_indexes), batch_size)
         ]
+    max_in_flight = max_workers * max_in_flight_per_worker
+
+    if shared_prefix and simulation_type == "Earthquake" and pending_indexes:
+        # Simulated here once and left in the network cache for the workers
+        get_prefix_snapshot(
+            inp_file, hydraulic_options, leak_start_time, network_cache_folder
+        )
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_simulation_worker,
+        initargs=(hydraulic_options, context),
+    ) as executor:
+        for batch_indexes in batches:
+            if adaptive_sampling is not None and has_converged(
+                estimators, len(results_list), adaptive_sampling
+            ):
+                break
+
+            batch_indexes = reuse_scenarios(batch_indexes)
+            # Sorted by increasing cost so pop() submits the longest realizations
+            # first and the slowest ones don't set the wall-clock time by finishing
+            # last
+            batch_indexes.sort(
+                key=lambda i: estimate_realization_cost(
+                    simulation_type, pga_values_and_damage_states, i
+                ),
+            )
+            in_flight = set()
+            while batch_indexes or in_flight:
+                while batch_indexes and len(in_flight) < max_in_flight:
+                    in_flight.add(
+                        executor.submit(simulate_realization, batch_indexes.pop())
+                    )
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    add_result(result)
+                    realization_index = result["realization_id"] - 1
+                    if "error" not in result and realization_index in fingerprints:
+                        save_scenario(
+                            scenario_cache_folder,
+                            fingerprints[realization_index],
+                            get_checkpoint_filename(
+                                checkpoint_folder, result["realization_id"]
+                            ),
+                            output_folder,
+                            result["realization_id"],
+                            raw_data_format if profile["raw_data"] else None,
+                            result_store_folder,
+                        )
+
+            if adaptive_sampling is not None:
+                print(
+                    f"{len(results_list)} of {num_realizations} realizations: "
+                    f"{format_estimates(estimators, adaptive_sampling['confidence'])}"
+                )
+
+    if adaptive_sampling is not None:
+        if has_converged(estimators, len(results_list), adaptive_sampling):
+            print(f"Target precision reached after {len(results_list)} realizations")
+        else:
+            print(
+                f"Budget of {num_realizations} realizations reached before the "
+                "target precision"
+            )
 
-        # Use `as_completed` to get results as they complete
-        for future in as_completed(futures):
-            result = future.result()
-            results_list.append(result)
+    if store is not None:
+        flush_result_store(store)
+    if catalog is not None:
+        record_realizations(catalog, catalog_rows)
+        catalog.close()
+
+    print_stage_times_summary(results_list, run_profile)
+    print_newton_iterations_summary(results_list)
+
+    # Charts are rendered after the simulation, only for the selected realizations
+    if profile["charts"]:
+        from .charts_utils import render_charts
+
+        render_charts(
+            simulation_type,
+            inp_file,
+            output_folder,
+            results_list,
+            (
+                chart_realization_ids
+                if chart_realization_ids is not None
+                else sorted(result["realization_id"] for result in results_list)
+            ),
+            max_workers,
+            network_cache_folder,
+            result_store_folder,
+            pga_values_and_damage_states,
+        )
 
     # Convert results into a DataFrame
     results_df = pd.DataFrame(results_list)
     return results_df
+
+
+def simulate_network_variants_parallel(
+    inp_file: str,
+    variants: list[ExperimentVariant],
+    leak_start_time: int,
+    required_pressure: int,
+    num_realizations: int,
+    pga_values_and_damage_states: list[(float, pd.Series)],
+    max_workers: int,
+    total_duration: int,
+    minimum_pressure: float,
+    network_cache_folder: str | None = None,
+    topology_cache_folder: str | None = None,
+    max_in_flight_per_worker: int = 2,
+    raw_data_format: RawDataFormat = "pickle",
+    run_profile: RunProfile = "full",
+    chart_realization_ids: list[int] | None = None,
+    warm_start: bool = False,
+    clean_warm_start_folder: str | None = None,
+    shared_prefix: bool = False,
+    stop_on_negative_pressure: bool = False,
+    sampling_weights: list[float] | None = None,
+    catalog_file: str | None = None,
+) -> list[pd.DataFrame]:
+    """
+    Realization-major version of simulate_network_parallel for several earthquake
+    experiments over the same damage draws: each task simulates one realization
+    under every variant, so its damaged network is built once (see
+    simulate_realization_variants). Each variant keeps its checkpoints, result
+    store and charts in its output_folder, as if it had been run on its own, and
+    its results are returned in the order of variants.
+
+    With warm_start the mitigated variants start from the unmitigated one and
+    this from the clean run of clean_warm_start_folder. Adaptive sampling isn't
+    available, every variant runs num_realizations realizations. With
+    catalog_file, each variant is recorded as the run of its output_folder.
+    """
+    profile = RUN_PROFILES[run_profile]
+    hydraulic_options = get_hydraulic_options(
+        total_duration, minimum_pressure, required_pressure
+    )
+    network_index = get_network_index(inp_file, hydraulic_options, network_cache_folder)
+
+    results_lists = [[] for _ in variants]
+    checkpoint_folders = [
+        get_checkpoint_folder(variant["output_folder"]) for variant in variants
+    ]
+    stores = []
+    for variant in variants:
+        result_store_folder = os.path.join(variant["output_folder"], "store")
+        create_result_store(
+            result_store_folder,
+            num_realizations,
+            network_index["times"],
+            network_index["node_names"],
+            network_index["demand_node_names"],
+        )
+        stores.append(open_result_store(result_store_folder))
+
+    catalog = open_catalog(catalog_file) if catalog_file is not None else None
+    catalog_rows = []
+
+    def add_result(variant_index: int, result: dict, checkpoint: bool = True):
+        if sampling_weights is not None and "error" not in result:
+            result["sampling_weight"] = sampling_weights[result["realization_id"] - 1]
+        if catalog is not None:
+            variant = variants[variant_index]
+            catalog_rows.append(
+                get_catalog_row(
+                    variant["output_folder"],
+                    "Earthquake",
+                    variant["mitigation_leaks_strategy_options"],
+                    result,
+                )
+            )
+            if len(catalog_rows) >= CATALOG_BATCH_SIZE:
+                record_realizations(catalog, catalog_rows)
+                catalog_rows.clear()
+        result = write_realization(stores[variant_index], result)
+        # After the store, so the checkpoint only has what is kept in memory
+        if checkpoint:
+            save_checkpoint(checkpoint_folders[variant_index], result)
+        results_lists[variant_index].append(result)
+
+    completed_realization_ids = []
+    for variant_index, checkpoint_folder in enumerate(checkpoint_folders):
+        completed_realization_ids.append(set())
+        for result in load_checkpoints(checkpoint_folder):
+            # Its arrays may not have reached the store before the interruption
+            if not stores[variant_index]["written"][result["realization_id"] - 1]:
+                continue
+            completed_realization_ids[-1].add(result["realization_id"])
+            add_result(variant_index, result, checkpoint=False)
+    num_completed = sum(len(completed) for completed in completed_realization_ids)
+    if num_completed:
+        print(f"Resuming: {num_completed} variant realizations already completed")
+
+    # Variants each realization still lacks
+    pending_variants = {}
+    for i in range(num_realizations):
+        variant_indexes = [
+            variant_index
+            for variant_index, completed in enumerate(completed_realization_ids)
+            if i + 1 not in completed
+        ]
+        if variant_indexes:
+            pending_variants[i] = variant_indexes
+
+    context = {
+        "inp_file": inp_file,
+        "variants": variants,
+        "leak_start_time": leak_start_time,
+        "required_pressure": required_pressure,
+        "total_duration": total_duration,
+        "minimum_pressure": minimum_pressure,
+        "pga_values_and_damage_states": pga_values_and_damage_states,
+        "network_cache_folder": network_cache_folder,
+        "topology_cache_folder": topology_cache_folder,
+        "raw_data_format": raw_data_format,
+        "run_profile": run_profile,
+        "warm_start": warm_start,
+        "clean_warm_start_folder": clean_warm_start_folder,
+        "use_prefix": shared_prefix,
+        "stop_on_negative_pressure": stop_on_negative_pressure,
+    }
+
+    if context["use_prefix"] and pending_variants:
+        # Simulated here once and left in the network cache for the workers
+        get_prefix_snapshot(
+            inp_file, hydraulic_options, leak_start_time, network_cache_folder
+        )
+
+    # Longest realizations first, as in simulate_network_parallel
+    pending_indexes = sorted(
+        pending_variants,
+        key=lambda i: estimate_realization_cost(
+            "Earthquake", pga_values_and_damage_states, i
+        )
+        * len(pending_variants[i]),
+    )
+    max_in_flight = max_workers * max_in_flight_per_worker
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_simulation_worker,
+        initargs=(hydraulic_options, context),
+    ) as executor:
+        in_flight = {}
+        while pending_indexes or in_flight:
+            while pending_indexes and len(in_flight) < max_in_flight:
+                i = pending_indexes.pop()
+                future = executor.submit(
+                    simulate_realization_variants, i, pending_variants[i]
+                )
+                in_flight[future] = pending_variants[i]
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                variant_indexes = in_flight.pop(future)
+                for variant_index, result in zip(variant_indexes, future.result()):
+                    add_result(variant_index, result)
+
+    for store in stores:
+        flush_result_store(store)
+    if catalog is not None:
+        record_realizations(catalog, catalog_rows)
+        catalog.close()
+
+    all_results = [result for results_list in results_lists for result in results_list]
+    num_solved = sum(
+        not result.get("reused_scenario", False) and "error" not in result
+        for result in all_results
+    )
+    print(
+        f"{len(all_results)} variant realizations from {num_solved} hydraulic solves"
+    )
+    print_stage_times_summary(all_results, run_profile)
+    print_newton_iterations_summary(all_results)
+
+    if profile["charts"]:
+        from .charts_utils import render_charts
+
+        for variant, results_list in zip(variants, results_lists):
+            render_charts(
+                "Earthquake",
+                inp_file,
+                variant["output_folder"],
+                results_list,
+                (
+                    chart_realization_ids
+                    if chart_realization_ids is not None
+                    else sorted(result["realization_id"] for result in results_list)
+                ),
+                max_workers,
+                network_cache_folder,
+                os.path.join(variant["output_folder"], "store"),
+                pga_values_and_damage_states,
+            )
+
+    return [pd.DataFrame(results_list) for results_list in results_lists]
@@ -0,0 +1,226 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from wntr.network import WaterNetworkModel
+
+from .types import MetricsIndex
+from .network_utils import get_demand_node_names
+from .archive_utils import load_archive_index, load_archive_variable
+
+# Pumps left out of the Todini input power, as in the original pandas version
+TODINI_EXCLUDED_PUMPS = ["1"]
+
+# Pressures [m.c.a] of the fraction of nodes satisfied at each time (every node of
+# the results, Leak_* included)
+SATISFIED_PRESSURE_THRESHOLDS = {
+    "t_min_satisfied_node_pressure": 5,
+    "t_required_satisfied_node_pressure": 15,
+}
+
+
+def get_metrics_index(
+    wn: WaterNetworkModel,
+    node_names: list[str],
+    link_names: list[str],
+    junction_names: list[str] | None = None,
+    demand_node_names: list[str] | None = None,
+) -> MetricsIndex:
+    """
+    Resolves once the columns each metric needs, so the kernel only does integer
+    indexing. junction_names defaults to the junctions of wn; when the columns
+    come from several realizations it must include all their Leak_* nodes.
+    demand_node_names can come from the network index to skip walking the
+    junction demands again.
+    """
+    if junction_names is None:
+        junction_names = wn.junction_name_list
+    if demand_node_names is None:
+        demand_node_names = get_demand_node_names(wn)
+    node_position = {name: i for i, name in enumerate(node_names)}
+    link_position = {name: i for i, name in enumerate(link_names)}
+
+    def node_positions(names):
+        return np.array([node_position[name] for name in names], dtype=np.intp)
+
+    todini_pumps = [
+        name for name in wn.pump_name_list if name not in TODINI_EXCLUDED_PUMPS
+    ]
+    return {
+        "junctions": node_positions(junction_names),
+        "reservoirs": node_positions(wn.reservoir_name_list),
+        "tanks": node_positions(wn.tank_name_list),
+        "demand_nodes": node_positions(demand_node_names),
+        "todini_pumps": np.array(
+            [link_position[name] for name in todini_pumps], dtype=np.intp
+        ),
+        "todini_pump_start_nodes": node_positions(
+            [wn.get_link(name).start_node_name for name in todini_pumps]
+        ),
+        "todini_pump_end_nodes": node_positions(
+            [wn.get_link(name).end_node_name for name in todini_pumps]
+        ),
+    }
+
+
+def compute_hydraulic_metrics(
+    pressure: np.ndarray,
+    head: np.ndarray,
+    demand: np.ndarray,
+    flowrate: np.ndarray,
+    metrics_index: MetricsIndex,
+    expected_demand: np.ndarray,
+    required_pressure: float,
+) -> dict[str, np.ndarray]:
+    """
+    Computes the pressure, Todini, WSA, demand and tank metrics of one
+    realization, with arrays of shape (times, elements), or of a stacked batch,
+    with shape (realizations, times, elements). expected_demand has shape
+    (times, demand nodes).
+
+    Missing values (elements or times a realization doesn't have) must be NaN:
+    every reduction skips them, so a padded batch gives the same values as each
+    realization on its own.
+    """
+    idx = metrics_index
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        # All-NaN slices (padded elements) are expected, they just give NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        # Times without results (a realization whose solver stopped early)
+        reported = ~np.isnan(pressure).all(axis=-1)
+
+        def per_time(values: np.ndarray) -> np.ndarray:
+            return np.where(reported, values, np.nan)
+
+        # Presión
+        mean_t_pressure = np.nanmean(pressure, axis=-1)
+        junctions_pressure = pressure[..., idx["junctions"]]
+
+        # Todini
+        junctions_demand = demand[..., idx["junctions"]]
+        junctions_head = head[..., idx["junctions"]]
+        elevation = junctions_head - junctions_pressure
+        Pout = np.nansum(junctions_demand * junctions_head, axis=-1)
+        Pexp = np.nansum(junctions_demand * (required_pressure + elevation), axis=-1)
+        Pin_res = np.nansum(
+            -demand[..., idx["reservoirs"]] * head[..., idx["reservoirs"]], axis=-1
+        )
+        pump_headloss = (
+            head[..., idx["todini_pump_end_nodes"]]
+            - head[..., idx["todini_pump_start_nodes"]]
+        )
+        Pin_pump = np.nansum(
+            flowrate[..., idx["todini_pumps"]] * np.abs(pump_headloss), axis=-1
+        )
+        todini = per_time((Pout - Pexp) / (Pin_res + Pin_pump - Pexp))
+
+        # WSA
+        wsa = demand[..., idx["demand_nodes"]] / expected_demand
+        mean_t_wsa = np.nanmean(wsa, axis=-1)
+
+        return {
+            "mean_node_pressure": np.nanmean(pressure, axis=-2),
+            "mean_t_pressure": mean_t_pressure,
+            "mean_system_pressure": np.nanmean(mean_t_pressure, axis=-1),
+            "min_system_pressure": np.nanmin(pressure, axis=(-2, -1)),
+            "min_system_junctions_pressure": np.nanmin(
+                junctions_pressure, axis=(-2, -1)
+            ),
+            "todini": todini,
+            "mean_todini": np.nanmean(todini, axis=-1),
+            "wsa": wsa,
+            "mean_t_wsa": mean_t_wsa,
+            "mean_system_wsa": np.nanmean(mean_t_wsa, axis=-1),
+            "mean_t_flowrate": np.nanmean(flowrate, axis=-1),
+            "mean_t_demand": per_time(np.nansum(junctions_demand, axis=-1)),
+            "mean_t_tank_levels": np.nanmean(head[..., idx["tanks"]], axis=-1),
+        }
+
+
+def get_satisfied_node_pressure(pressure: pd.DataFrame) -> dict[str, pd.Series]:
+    """
+    Fraction of the nodes at or above each of SATISFIED_PRESSURE_THRESHOLDS at
+    every time.
+    """
+    return {
+        metric: (pressure >= threshold).mean(axis=1)
+        for metric, threshold in SATISFIED_PRESSURE_THRESHOLDS.items()
+    }
+
+
+def get_invalid_at(pressure: pd.DataFrame) -> int | None:
+    """
+    First reported time with a negative pressure at any node, the criterion
+    that discards a realization, or None if it has none.
+    """
+    negative_times = pressure.index[(pressure < 0).any(axis=1)]
+    return int(negative_times[0]) if len(negative_times) else None
+
+
+def label_hydraulic_metrics(
+    hydraulic_metrics: dict[str, np.ndarray],
+    times: list[int],
+    node_names: list[str],
+    demand_node_names: list[str],
+) -> dict:
+    """
+    Wraps the kernel output of a single realization in the pandas objects stored
+    in its metrics.
+    """
+    labeled = {}
+    for metric, values in hydraulic_metrics.items():
+        if metric == "wsa":
+            labeled[metric] = pd.DataFrame(
+                values, index=times, columns=demand_node_names
+            )
+        elif metric == "mean_node_pressure":
+            labeled[metric] = pd.Series(values, index=node_names)
+        elif values.ndim == 1:
+            labeled[metric] = pd.Series(values, index=times)
+        else:
+            labeled[metric] = float(values)
+
+    return labeled
+
+
+def compute_archive_metrics(
+    archive_paths: list[str],
+    wn: WaterNetworkModel,
+    expected_demand: pd.DataFrame,
+    required_pressure: float,
+) -> dict[str, np.ndarray]:
+    """
+    Recomputes the hydraulic metrics of a batch of archived realizations in one
+    kernel call. Their Leak_* nodes differ, so every realization is padded with
+    NaN to the union of their nodes and times. expected_demand is indexed by
+    time, with the demand nodes of wn as columns.
+    """
+    indexes = [load_archive_index(path) for path in archive_paths]
+
+    def union(key: str) -> list:
+        return list(dict.fromkeys(name for index in indexes for name in index[key]))
+
+    node_names = union("node_names")
+    link_names = union("link_names")
+    junction_names = union("junction_names")
+    times = sorted(set(union("times")))
+
+    def stack(element: str, variable: str, names: list[str]) -> np.ndarray:
+        return np.stack(
+            [
+                load_archive_variable(path, element, variable)
+                .reindex(index=times, columns=names)
+                .to_numpy(dtype=np.float64)
+                for path in archive_paths
+            ]
+        )
+
+    return compute_hydraulic_metrics(
+        stack("node", "pressure", node_names),
+        stack("node", "head", node_names),
+        stack("node", "demand", node_names),
+        stack("link", "flowrate", link_names),
+        get_metrics_index(wn, node_names, link_names, junction_names),
+        expected_demand.reindex(times).to_numpy(dtype=np.float64),
+        required_pressure,
+    )
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import wntr
+from wntr.network import WaterNetworkModel
+
+from .types import HydraulicOptions, NetworkIndex
+
+# Pickled network templates of this process, keyed by network hash. Each worker
+# fills it once (see init_network_worker) and every realization gets a clone.
+_network_templates: dict[str, bytes] = {}
+
+# Network indexes of this process, keyed by the same hash as the templates
+_network_indexes: dict[str, NetworkIndex] = {}
+
+# Hashes of the INP files read by this process, keyed by (path, mtime), so each
+# file is only read and hashed again when it changes
+_inp_file_hashes: dict[tuple[str, int], object] = {}
+
+
+def get_network_hash(
+    inp_file: str, hydraulic_options: HydraulicOptions | None = None
+) -> str:
+    """
+    Returns a hash of the INP file content plus the hydraulic options applied to
+    the network, so two templates only share a key if they build the same model.
+    """
+    key = (os.path.abspath(inp_file), os.stat(inp_file).st_mtime_ns)
+    if key not in _inp_file_hashes:
+        with open(inp_file, "rb") as f:
+            _inp_file_hashes[key] = hashlib.sha256(f.read())
+
+    # The options go to a copy of the hasher of the content
+    hasher = _inp_file_hashes[key].copy()
+    hasher.update(json.dumps(hydraulic_options, sort_keys=True).encode())
+
+    return hasher.hexdigest()
+
+
+def apply_hydraulic_options(
+    wn: WaterNetworkModel, hydraulic_options: HydraulicOptions
+) -> WaterNetworkModel:
+    wn.options.hydraulic.demand_model = hydraulic_options["demand_model"]
+    wn.options.time.duration = hydraulic_options["duration"]
+    wn.options.hydraulic.minimum_pressure = hydraulic_options["minimum_pressure"]
+    wn.options.hydraulic.required_pressure = hydraulic_options["required_pressure"]
+
+    return wn
+
+
+def load_network_template(
+    inp_file: str,
+    hydraulic_options: HydraulicOptions | None = None,
+    cache_folder: str | None = None,
+) -> bytes:
+    """
+    Returns the pickled, already configured network for the given INP file and
+    hydraulic options. The INP file is parsed at most once per process, and not
+    at all if a pre-parsed copy exists in cache_folder.
+    """
+    network_hash = get_network_hash(inp_file, hydraulic_options)
+    if network_hash in _network_templates:
+        return _network_templates[network_hash]
+
+    cache_filename = None
+    if cache_folder is not None:
+        cache_filename = os.path.join(cache_folder, f"{network_hash}.pickle")
+        if os.path.exists(cache_filename):
+            with open(cache_filename, "rb") as f:
+                template = f.read()
+            _network_templates[network_hash] = template
+            return template
+
+    wn = WaterNetworkModel(inp_file)
+    if hydraulic_options is not None:
+        apply_hydraulic_options(wn, hydraulic_options)
+    template = pickle.dumps(wn, protocol=pickle.HIGHEST_PROTOCOL)
+    _network_templates[network_hash] = template
+
+    if cache_filename is not None:
+        # Write to a temporary file first: several workers may build the same
+        # template at once and a reader must never see a half written file
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(template)
+        os.replace(tmp_filename, cache_filename)
+
+    return template
+
+
+def get_network(
+    inp_file: str,
+    hydraulic_options: HydraulicOptions | None = None,
+    cache_folder: str | None = None,
+) -> WaterNetworkModel:
+    """
+    Returns a fresh copy of the network that can be modified freely (e.g. adding
+    leaks) without affecting the cached template.
+    """
+    template = load_network_template(inp_file, hydraulic_options, cache_folder)
+    return pickle.loads(template)
+
+
+def get_demand_node_names(wn: WaterNetworkModel) -> list[str]:
+    """
+    Junctions with a positive base demand, the ones considered for the WSA.
+    """
+    return [
+        node
+        for node in wn.junction_name_list
+        if wn.get_node(node).demand_timeseries_list[0].base_value > 0
+    ]
+
+
+def get_report_times(wn: WaterNetworkModel) -> list[int]:
+    duration = int(wn.options.time.duration)
+    report_timestep = int(wn.options.time.report_timestep)
+    return list(range(0, duration + 1, report_timestep))
+
+
+def build_network_index(wn: WaterNetworkModel) -> NetworkIndex:
+    node_names = wn.node_name_list
+    node_position = {name: i for i, name in enumerate(node_names)}
+    link_names = wn.link_name_list
+    link_position = {name: i for i, name in enumerate(link_names)}
+    links = [wn.get_link(name) for name in link_names]
+    link_start_nodes = np.array(
+        [node_position[link.start_node_name] for link in links], dtype=np.intp
+    )
+    link_end_nodes = np.array(
+        [node_position[link.end_node_name] for link in links], dtype=np.intp
+    )
+
+    pipe_names = wn.pipe_name_list
+    pipe_links = np.array([link_position[name] for name in pipe_names], dtype=np.intp)
+    junction_names = wn.junction_name_list
+    demand_node_names = get_demand_node_names(wn)
+    demand_node_set = set(demand_node_names)
+
+    return {
+        "node_names": node_names,
+        "node_position": node_position,
+        "link_names": link_names,
+        "link_position": link_position,
+        "link_start_nodes": link_start_nodes,
+        "link_end_nodes": link_end_nodes,
+        "pipe_names": pipe_names,
+        "pipe_position": {name: i for i, name in enumerate(pipe_names)},
+        "pipe_start_nodes": link_start_nodes[pipe_links],
+        "pipe_end_nodes": link_end_nodes[pipe_links],
+        "pipe_diameters": np.array([wn.get_link(name).diameter for name in pipe_names]),
+        "junction_names": junction_names,
+        "demand_node_mask": np.array(
+            [name in demand_node_set for name in junction_names], dtype=bool
+        ),
+        "demand_node_names": demand_node_names,
+        "times": get_report_times(wn),
+        "expected_demand": wntr.metrics.expected_demand(wn)[
+            demand_node_names
+        ].to_numpy(),
+    }
+
+
+def get_network_index(
+    inp_file: str,
+    hydraulic_options: HydraulicOptions | None = None,
+    cache_folder: str | None = None,
+) -> NetworkIndex:
+    """
+    Returns the index of the configured network, built at most once per process
+    and, like the template, kept in cache_folder for the other processes.
+    """
+    network_hash = get_network_hash(inp_file, hydraulic_options)
+    if network_hash in _network_indexes:
+        return _network_indexes[network_hash]
+
+    cache_filename = None
+    if cache_folder is not None:
+        cache_filename = os.path.join(cache_folder, f"{network_hash}.index.pickle")
+        if os.path.exists(cache_filename):
+            with open(cache_filename, "rb") as f:
+                _network_indexes[network_hash] = pickle.load(f)
+            return _network_indexes[network_hash]
+
+    network_index = build_network_index(
+        get_network(inp_file, hydraulic_options, cache_folder)
+    )
+    _network_indexes[network_hash] = network_index
+
+    if cache_filename is not None:
+        tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            pickle.dump(network_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, cache_filename)
+
+    return network_index
+
+
+def init_network_worker(
+    inp_file: str,
+    hydraulic_options: HydraulicOptions | None,
+    cache_folder: str | None,
+):
+    """
+    Process pool initializer. Parses the network and builds its index once when
+    the worker starts.
+    """
+    load_network_template(inp_file, hydraulic_options, cache_folder)
+    get_network_index(inp_file, hydraulic_options, cache_folder)
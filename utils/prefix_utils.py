@@ -0,0 +1,161 @@
+import os
+import pickle
+
+import pandas as pd
+from wntr.network import WaterNetworkModel
+from wntr.sim import WNTRSimulator
+from wntr.sim.results import SimulationResults
+
+from .types import HydraulicOptions
+from .network_utils import get_network, get_network_hash
+
+# Pickled (paused network, prefix results) of this process, keyed by network hash
+# and leak start time
+_prefix_snapshots: dict[tuple[str, int], bytes] = {}
+
+
+def can_share_prefix(wn: WaterNetworkModel, leak_start_time: int) -> bool:
+    """
+    The clean run can only be paused right before the leaks start if they start
+    at a hydraulic (and report) step after t=0.
+    """
+    hydraulic_timestep = int(wn.options.time.hydraulic_timestep)
+    report_timestep = int(wn.options.time.report_timestep)
+    return (
+        0 < leak_start_time <= wn.options.time.duration
+        and leak_start_time % hydraulic_timestep == 0
+        and leak_start_time % report_timestep == 0
+    )
+
+
+def get_prefix_snapshot(
+    inp_file: str,
+    hydraulic_options: HydraulicOptions,
+    leak_start_time: int,
+    cache_folder: str | None = None,
+) -> tuple[WaterNetworkModel, SimulationResults] | None:
+    """
+    Returns a fresh copy of the clean network paused at leak_start_time (tank
+    levels, link status and controls included) and its results before that time,
+    or None if the leak start doesn't allow it. The clean network is simulated at
+    most once per process, and not at all if the snapshot exists in cache_folder.
+
+    Running the returned network continues the simulation from leak_start_time.
+    """
+    network_hash = get_network_hash(inp_file, hydraulic_options)
+    key = (network_hash, leak_start_time)
+    if key in _prefix_snapshots:
+        return pickle.loads(_prefix_snapshots[key])
+
+    wn = get_network(inp_file, hydraulic_options, cache_folder)
+    if not can_share_prefix(wn, leak_start_time):
+        return None
+
+    cache_filename = None
+    if cache_folder is not None:
+        cache_filename = os.path.join(
+            cache_folder, f"{network_hash}.prefix_{leak_start_time}.pickle"
+        )
+        if os.path.exists(cache_filename):
+            with open(cache_filename, "rb") as f:
+                _prefix_snapshots[key] = f.read()
+            return pickle.loads(_prefix_snapshots[key])
+
+    # The simulator stops one step after its duration, so the network is left
+    # with sim_time = leak_start_time and the next run starts by solving it
+    duration = wn.options.time.duration
+    hydraulic_timestep = int(wn.options.time.hydraulic_timestep)
+    wn.options.time.duration = leak_start_time - hydraulic_timestep
+    prefix_results = WNTRSimulator(wn).run_sim()
+    wn.options.time.duration = duration
+
+    snapshot = pickle.dumps((wn, prefix_results), protocol=pickle.HIGHEST_PROTOCOL)
+    _prefix_snapshots[key] = snapshot
+
+    if cache_filename is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(snapshot)
+        os.replace(tmp_filename, cache_filename)
+
+    return pickle.loads(snapshot)
+
+
+def _closed_check_valve(
+    prefix_results: SimulationResults, pipe_name: str, wn: WaterNetworkModel
+) -> pd.Series:
+    # Times a check valve pipe of the clean run is closed by a reverse gradient
+    status = prefix_results.link["status"][pipe_name]
+    return (status == 0) & wn.get_link(pipe_name).check_valve
+
+
+def _get_leak_node_prefix(
+    prefix_results: SimulationResults,
+    variable: str,
+    node_name: str,
+    wn: WaterNetworkModel,
+) -> pd.Series:
+    if variable not in ["head", "pressure"]:
+        # No demand nor leak before the leak start
+        return pd.Series(0.0, index=prefix_results.node[variable].index)
+
+    # inject_leaks splits the pipe in two equal halves (the minor loss too), so
+    # without the leak both lose the same head and the middle is at the mean of
+    # both ends. A closed check valve only closes the second half and the middle
+    # stays at the head of the start node.
+    pipe_name = node_name[len("Leak_") :]
+    head = prefix_results.node["head"]
+    start_head = head[wn.get_link(pipe_name).start_node_name]
+    end_head = head[wn.get_link(f"{pipe_name}_A").end_node_name]
+    leak_head = ((start_head + end_head) / 2).where(
+        ~_closed_check_valve(prefix_results, pipe_name, wn), start_head
+    )
+    if variable == "pressure":
+        return leak_head - wn.get_node(node_name).elevation
+    return leak_head
+
+
+def stitch_prefix_results(
+    prefix_results: SimulationResults,
+    simulation_results: SimulationResults,
+    wn: WaterNetworkModel,
+) -> SimulationResults:
+    """
+    Prepends the clean run results before the leak start to the results of a
+    realization continued from the snapshot, so they cover the whole duration as
+    if it had been simulated from t=0. The Leak_* nodes and *_A pipes, missing
+    from the clean run, take the values of the undamaged pipe they split: before
+    the leak the split network is the clean one, so they are the values a full
+    solve gives (within 1e-4 m, see check_prefix_parity.py), not estimates.
+    """
+    for variable, values in simulation_results.node.items():
+        clean_values = prefix_results.node[variable]
+        prefix = clean_values.reindex(columns=values.columns)
+        for node_name in values.columns.difference(clean_values.columns):
+            prefix[node_name] = _get_leak_node_prefix(
+                prefix_results, variable, node_name, wn
+            )
+        simulation_results.node[variable] = pd.concat([prefix, values])
+
+    split_pipes = [
+        link_name[: -len("_A")]
+        for link_name in simulation_results.link["flowrate"].columns.difference(
+            prefix_results.link["flowrate"].columns
+        )
+    ]
+    for variable, values in simulation_results.link.items():
+        prefix = prefix_results.link[variable].reindex(columns=values.columns)
+        for pipe_name in split_pipes:
+            # The second half carries the same flow, and the first one is left
+            # open (without flow) when a check valve closes the pipe
+            prefix[f"{pipe_name}_A"] = prefix[pipe_name]
+            if variable == "status":
+                prefix[pipe_name] = prefix[pipe_name].mask(
+                    _closed_check_valve(prefix_results, pipe_name, wn), 1
+                )
+        simulation_results.link[variable] = pd.concat(
+            [prefix.astype(values.dtypes), values]
+        )
+
+    return simulation_results
@@ -0,0 +1,176 @@
+import math
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from .types import AdaptiveEstimator, AdaptiveSamplingOptions, SamplingDesign
+from .general_utils import get_pga_distribution
+from .network_utils import get_network
+from .damage_utils import DamageMatrix, get_sampling_seeds, sample_damage_states
+
+
+class RunningMean:
+    """
+    Weighted mean and variance of a sample updated one value at a time (West's
+    weighted version of Welford's algorithm), so the results of a realization
+    can be dropped once added. With importance sampling the weights are the
+    likelihood ratios and the mean is self-normalized.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._weight_sum = 0.0
+        self._squared_weight_sum = 0.0
+        self._m2 = 0.0
+
+    def add(self, value: float, weight: float = 1.0):
+        self.count += 1
+        self._weight_sum += weight
+        self._squared_weight_sum += weight**2
+        delta = value - self.mean
+        self.mean += delta * weight / self._weight_sum
+        self._m2 += weight * delta * (value - self.mean)
+
+    @property
+    def effective_count(self) -> float:
+        """
+        Kish's effective sample size, count for equal weights.
+        """
+        if self._squared_weight_sum == 0:
+            return 0.0
+        return self._weight_sum**2 / self._squared_weight_sum
+
+    @property
+    def variance(self) -> float:
+        effective_count = self.effective_count
+        if effective_count <= 1:
+            return np.nan
+        return self._m2 / self._weight_sum * effective_count / (effective_count - 1)
+
+    def half_width(self, confidence: float) -> float:
+        """
+        Half width of the normal confidence interval of the mean.
+        """
+        if self.count < 2 or self.effective_count <= 1:
+            return np.inf
+        z = norm.ppf(0.5 + confidence / 2)
+        return z * np.sqrt(self.variance / self.effective_count)
+
+
+def get_estimator_samples(result: dict) -> dict[AdaptiveEstimator, float]:
+    """
+    Values a realization adds to each estimator. As in the analysis, realizations
+    with a negative pressure only count towards negative_pressure_fraction.
+    """
+    if "error" in result:
+        return {}
+
+    invalid_at = result.get("invalid_at")
+    negative_pressure = (invalid_at is not None and pd.notna(invalid_at)) or result[
+        "min_system_pressure"
+    ] < 0
+    samples = {"negative_pressure_fraction": float(negative_pressure)}
+    if not negative_pressure:
+        samples["mean_system_wsa"] = float(result["mean_system_wsa"])
+        samples["mean_todini"] = float(
+            result["mean_todini"]
+            if "mean_todini" in result
+            else np.nanmean(result["todini"])
+        )
+
+    return samples
+
+
+def create_estimators() -> dict[AdaptiveEstimator, RunningMean]:
+    return {
+        "mean_system_wsa": RunningMean(),
+        "mean_todini": RunningMean(),
+        "negative_pressure_fraction": RunningMean(),
+    }
+
+
+def update_estimators(estimators: dict[AdaptiveEstimator, RunningMean], result: dict):
+    weight = result.get("sampling_weight", 1.0)
+    for estimator, value in get_estimator_samples(result).items():
+        if not np.isnan(value):
+            estimators[estimator].add(value, weight)
+
+
+def has_converged(
+    estimators: dict[AdaptiveEstimator, RunningMean],
+    num_completed: int,
+    adaptive_sampling: AdaptiveSamplingOptions,
+) -> bool:
+    if num_completed < adaptive_sampling["min_realizations"]:
+        return False
+    return all(
+        estimators[estimator].half_width(adaptive_sampling["confidence"])
+        <= target_half_width
+        for estimator, target_half_width in adaptive_sampling[
+            "target_half_widths"
+        ].items()
+    )
+
+
+def format_estimates(
+    estimators: dict[AdaptiveEstimator, RunningMean], confidence: float
+) -> str:
+    return ", ".join(
+        f"{estimator} = {running_mean.mean:.4f} ± "
+        f"{running_mean.half_width(confidence):.4f} (n={running_mean.count})"
+        for estimator, running_mean in estimators.items()
+    )
+
+
+def sample_pga_uniforms(
+    num_samples: int, pga_design: str, rng: np.random.Generator
+) -> np.ndarray:
+    if pga_design == "lhs":
+        # In one dimension a latin hypercube is a stratified sample: one point per
+        # equal probability stratum, shuffled so any prefix covers the whole range
+        strata = rng.permutation(num_samples)
+        return (strata + rng.random(num_samples)) / num_samples
+    return rng.random(num_samples)
+
+
+def sample_earthquake_scenarios(
+    num_realizations: int,
+    inp_file: str,
+    sampling_design: SamplingDesign,
+    network_cache_folder: str | None = None,
+    seed: int | None = None,
+) -> tuple[DamageMatrix, list[float]]:
+    """
+    Returns the PGA and damage states of each realization, like get_damage_states,
+    and its sampling weight: the likelihood ratio of its PGA under the PGA
+    distribution and the importance sampling proposal (1 without it).
+
+    With antithetic draws realizations 2k and 2k + 1 use mirrored uniforms for
+    their PGA and for every pipe, so their errors tend to cancel out.
+    """
+    pipe_names = get_network(inp_file, cache_folder=network_cache_folder).pipe_name_list
+    seed_sequence = np.random.SeedSequence(seed)
+    pga_seed, _ = get_sampling_seeds(seed_sequence.entropy)
+    antithetic = sampling_design["antithetic"]
+
+    num_draws = math.ceil(num_realizations / 2) if antithetic else num_realizations
+    pga_uniforms = sample_pga_uniforms(
+        num_draws, sampling_design["pga"], np.random.default_rng(pga_seed)
+    )
+    if antithetic:
+        pga_uniforms = np.column_stack([pga_uniforms, 1 - pga_uniforms]).ravel()
+
+    target = get_pga_distribution()
+    proposal = get_pga_distribution(sampling_design["importance_shift"])
+    pga_values = np.round(proposal.ppf(pga_uniforms[:num_realizations]), 7)
+    sampling_weights = [
+        float(weight) for weight in target.pdf(pga_values) / proposal.pdf(pga_values)
+    ]
+
+    # The pipes are drawn as for given PGA values, from the same seed
+    damage_matrix = sample_damage_states(
+        pga_values, pipe_names, seed_sequence.entropy, antithetic
+    )
+    return damage_matrix, sampling_weights
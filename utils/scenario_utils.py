@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from .types import (
+    NetworkIndex,
+    SimulationType,
+    MitigationLeaksStrategyOptions,
+    RawDataFormat,
+)
+from .leaks_utils import get_leak_areas, get_mitigation_reinforced_pipes
+from .checkpoint_utils import write_file_atomically
+from .archive_utils import get_archive_path
+from .store_utils import load_store_realization
+
+
+def get_scenario_fingerprint(
+    network_hash: str,
+    simulation_type: SimulationType,
+    leak_start_time: int,
+    pipe_names: list[str],
+    leak_areas: np.ndarray,
+    stop_on_negative_pressure: bool,
+    shared_prefix: bool,
+) -> str:
+    """
+    Hash of everything the hydraulic solve depends on: the configured network
+    (network_hash covers the INP file and the hydraulic options), when the leaks
+    start, the effective (pipe, leak area) set and the solver settings that change
+    the results (a stopped realization is truncated, the shared prefix stitches
+    the clean run before the leaks). Two realizations with the same fingerprint
+    give the same results, whatever mitigation produced them.
+    """
+    hasher = hashlib.sha256(network_hash.encode())
+    hasher.update(f"\0{simulation_type}\0{leak_start_time}".encode())
+    hasher.update(f"\0{int(stop_on_negative_pressure)}\0{int(shared_prefix)}".encode())
+    for pipe_name, leak_area in sorted(zip(pipe_names, leak_areas)):
+        hasher.update(f"\0{pipe_name}\0{float(leak_area).hex()}".encode())
+
+    return hasher.hexdigest()
+
+
+def get_realization_fingerprint(
+    network_hash: str,
+    network_index: NetworkIndex,
+    simulation_type: SimulationType,
+    leak_start_time: int,
+    damage_states: pd.Series | None,
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None,
+    stop_on_negative_pressure: bool,
+    shared_prefix: bool,
+) -> str:
+    pipe_names, leak_areas = [], np.array([])
+    if simulation_type == "Earthquake":
+        reinforced_pipes = get_mitigation_reinforced_pipes(
+            mitigation_leaks_strategy_options
+        )
+        pipe_names, leak_areas = get_leak_areas(
+            network_index, damage_states, reinforced_pipes
+        )
+
+    return get_scenario_fingerprint(
+        network_hash,
+        simulation_type,
+        leak_start_time,
+        pipe_names,
+        leak_areas,
+        stop_on_negative_pressure,
+        shared_prefix,
+    )
+
+
+def get_raw_data_files(
+    output_folder: str, realization_id: int, raw_data_format: RawDataFormat
+) -> list[str]:
+    simulation_data_folder = os.path.join(output_folder, "simulation_data")
+    if raw_data_format == "archive":
+        return [get_archive_path(simulation_data_folder, realization_id)]
+    return [
+        os.path.join(simulation_data_folder, f"wn_realization_{realization_id}.pickle"),
+        os.path.join(
+            simulation_data_folder, f"simulation_results_{realization_id}.pickle"
+        ),
+    ]
+
+
+def save_scenario(
+    scenario_cache_folder: str,
+    fingerprint: str,
+    checkpoint_filename: str,
+    output_folder: str,
+    realization_id: int,
+    raw_data_format: RawDataFormat | None,
+    result_store_folder: str | None,
+):
+    """
+    Registers a simulated realization as the source of its scenario. Only the
+    location of its checkpoint, its result store (which has its arrays) and its
+    raw data, if saved, is kept.
+    """
+    os.makedirs(scenario_cache_folder, exist_ok=True)
+    filename = os.path.join(scenario_cache_folder, f"{fingerprint}.json")
+    if os.path.exists(filename):
+        return
+
+    entry = {
+        "checkpoint": os.path.abspath(checkpoint_filename),
+        "output_folder": os.path.abspath(output_folder),
+        "realization_id": realization_id,
+        "raw_data_format": raw_data_format,
+        "result_store_folder": (
+            os.path.abspath(result_store_folder)
+            if result_store_folder is not None
+            else None
+        ),
+    }
+    write_file_atomically(filename, json.dumps(entry).encode())
+
+
+def load_scenario(scenario_cache_folder: str, fingerprint: str) -> dict | None:
+    """
+    Returns the metrics of the realization that already simulated this
+    scenario, or None.
+    """
+    filename = os.path.join(scenario_cache_folder, f"{fingerprint}.json")
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as f:
+        entry = json.load(f)
+    if not os.path.exists(entry["checkpoint"]):
+        return None  # Its experiment folder was removed
+    with open(entry["checkpoint"], "rb") as f:
+        entry["metrics"] = pickle.load(f)
+
+    # The checkpoint only has the scalars of realizations with a result store
+    result_store_folder = entry.get("result_store_folder")
+    if result_store_folder is not None:
+        if not os.path.isdir(result_store_folder):
+            return None
+        entry["metrics"].update(
+            load_store_realization(result_store_folder, entry["realization_id"])
+        )
+
+    return entry
+
+
+def copy_scenario_raw_data(
+    entry: dict,
+    output_folder: str,
+    realization_id: int,
+    raw_data_format: RawDataFormat,
+) -> bool:
+    """
+    Gives the reused realization its own raw data files, hard linked when the
+    file system allows it. Returns False if the source didn't save them in
+    this format.
+    """
+    if entry["raw_data_format"] != raw_data_format:
+        return False
+
+    source_files = get_raw_data_files(
+        entry["output_folder"], entry["realization_id"], raw_data_format
+    )
+    target_files = get_raw_data_files(output_folder, realization_id, raw_data_format)
+    if not all(os.path.exists(filename) for filename in source_files):
+        return False
+
+    for source, target in zip(source_files, target_files):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    return True
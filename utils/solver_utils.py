@@ -0,0 +1,263 @@
+import os
+import pickle
+import warnings
+
+import numpy as np
+import pandas as pd
+import wntr
+from wntr.network import WaterNetworkModel
+from wntr.sim import WNTRSimulator
+from wntr.sim.results import SimulationResults
+
+from .archive_utils import get_archive_path, load_archive_index, load_archive_variable
+
+# Clean run references already loaded by this process, keyed by folder
+_clean_references: dict[str, dict | None] = {}
+
+# WarmStartSimulator overrides private methods of WNTRSimulator copied from wntr 1.2
+# (see its hooks). With another wntr version, or without them, it runs as a plain
+# WNTRSimulator instead of patching a solver whose internals may have changed
+WNTR_HOOKS_VERSION = "1.2."
+WNTR_HOOKS_AVAILABLE = wntr.__version__.startswith(WNTR_HOOKS_VERSION) and all(
+    callable(getattr(WNTRSimulator, method, None))
+    for method in ["_setup_sim_options", "_run_postsolve_controls"]
+)
+if not WNTR_HOOKS_AVAILABLE:
+    warnings.warn(
+        f"wntr {wntr.__version__} is not {WNTR_HOOKS_VERSION}x: the warm start, the "
+        "Newton iteration count and stop_on_negative_pressure are disabled"
+    )
+
+
+class WarmStartSimulator(WNTRSimulator):
+    """
+    WNTRSimulator that can seed the Newton solver with the heads and leak rates
+    of a related solution (e.g. the unmitigated run of the same damage state) at
+    the given times, and counts the Newton iterations of the whole run.
+
+    Between seeded times the solver starts, as usual, from the previous step.
+    Flows are left to the solver: seeding the reference flows, with their closed
+    links and near zero values, makes Newton converge slower than from scratch.
+
+    With stop_on_negative_pressure, the run ends right after the first reported
+    time with a negative pressure (stopped_at), the criterion that discards a
+    realization, instead of solving the rest of the duration.
+
+    Without WNTR_HOOKS_AVAILABLE it runs as a plain WNTRSimulator: no seeding
+    (reference is None), no early stop and newton_iterations None.
+    """
+
+    def __init__(
+        self,
+        wn: WaterNetworkModel,
+        reference: dict | None = None,
+        seed_times: set[int] | None = None,
+        stop_on_negative_pressure: bool = False,
+    ):
+        super().__init__(wn)
+        self.reference = reference if WNTR_HOOKS_AVAILABLE else None
+        self.seed_times = seed_times
+        self.stop_on_negative_pressure = stop_on_negative_pressure
+        self.newton_iterations = 0 if WNTR_HOOKS_AVAILABLE else None
+        self.seeded_steps = 0
+        self.stopped_at = None
+        self._duration = None
+
+    def run_sim(self, *args, **kwargs):
+        self._duration = self._wn.options.time.duration
+        try:
+            return super().run_sim(*args, **kwargs)
+        finally:
+            # Stopping early shortens the duration of the network
+            self._wn.options.time.duration = self._duration
+
+    # ==== Hooks into WNTRSimulator internals, as of wntr 1.2.0 (wntr/sim/core.py) ====
+    # _setup_sim_options and _run_postsolve_controls are called by run_sim, which
+    # sets _model and _report_timestep; the hydraulic model keeps its variables
+    # in head and leak_rate. See WNTR_HOOKS_AVAILABLE.
+
+    def _setup_sim_options(self, *args, **kwargs):
+        # Called by run_sim right after the hydraulic model is created
+        super()._setup_sim_options(*args, **kwargs)
+        if not WNTR_HOOKS_AVAILABLE:
+            return
+        model = self._model
+
+        evaluate_jacobian = model.evaluate_jacobian
+
+        def count_iteration(x=None):
+            # NewtonSolver evaluates the jacobian once per iteration
+            self.newton_iterations += 1
+            return evaluate_jacobian(x)
+
+        model.evaluate_jacobian = count_iteration
+
+        if self.reference is None:
+            return
+
+        set_structure = model.set_structure
+        seeded_times = set()
+
+        def seed_and_set_structure():
+            # Called before every solve; only the first trial of a step is seeded
+            sim_time = int(self._wn.sim_time)
+            if (
+                sim_time not in seeded_times
+                and sim_time in self.reference["times"]
+                and (self.seed_times is None or sim_time in self.seed_times)
+            ):
+                seeded_times.add(sim_time)
+                self._seed_model(sim_time)
+                self.seeded_steps += 1
+            set_structure()
+
+        model.set_structure = seed_and_set_structure
+
+    def _run_postsolve_controls(self):
+        # Called after every trial of a step; only the last one gets reported
+        super()._run_postsolve_controls()
+        if not (WNTR_HOOKS_AVAILABLE and self.stop_on_negative_pressure):
+            return
+
+        sim_time = int(self._wn.sim_time)
+        if (
+            isinstance(self._report_timestep, (float, int))
+            and sim_time % self._report_timestep != 0
+        ):
+            return  # Not reported, as in the results the criterion is applied to
+
+        if self._has_negative_pressure():
+            # The simulator saves this step and then stops, past its duration
+            self.stopped_at = sim_time
+            self._wn.options.time.duration = sim_time
+        elif self.stopped_at == sim_time:
+            # A previous trial of this step was negative, this one isn't
+            self.stopped_at = None
+            self._wn.options.time.duration = self._duration
+
+    def _has_negative_pressure(self) -> bool:
+        # Same pressures save_results reports (isolated junctions report 0)
+        for _, junction in self._wn.junctions():
+            if not junction._is_isolated and junction.head < junction.elevation:
+                return True
+        for _, tank in self._wn.tanks():
+            if tank.head < tank.elevation:
+                return True
+        return False
+
+    def _seed_model(self, sim_time: int):
+        reference = self.reference
+        head = reference["head"].loc[sim_time]
+        leak_demand = reference["leak_demand"].loc[sim_time]
+
+        for node_name, var in getattr(self._model, "head", {}).items():
+            value = head.get(node_name)
+            if value is None and node_name.startswith("Leak_"):
+                # Not in a clean reference: the middle of the split pipe
+                pipe_name = node_name[len("Leak_") :]
+                value = (
+                    head.get(self._wn.get_link(pipe_name).start_node_name, np.nan)
+                    + head.get(self._wn.get_link(f"{pipe_name}_A").end_node_name, np.nan)
+                ) / 2
+            if value is not None and not np.isnan(value):
+                var.value = float(value)
+
+        for node_name, var in getattr(self._model, "leak_rate", {}).items():
+            value = leak_demand.get(node_name)
+            if value is not None and not np.isnan(value):
+                var.value = float(value)
+
+
+def get_warm_start_reference(simulation_results: SimulationResults) -> dict:
+    return {
+        "times": set(int(t) for t in simulation_results.node["head"].index),
+        "head": simulation_results.node["head"],
+        "leak_demand": simulation_results.node["leak_demand"],
+    }
+
+
+def load_warm_start_reference(output_folder: str, realization_id: int) -> dict | None:
+    """
+    Loads the heads and leak demands saved as raw data by a realization
+    of another experiment (archive or pickle), or None if it has none.
+    """
+    simulation_data_folder = os.path.join(output_folder, "simulation_data")
+    archive_path = get_archive_path(simulation_data_folder, realization_id)
+    if os.path.exists(archive_path):
+        index = load_archive_index(archive_path)
+        if index["error_code"] is not None:
+            return None  # Partial results, not worth starting from
+        return {
+            "times": set(index["times"]),
+            "head": load_archive_variable(archive_path, "node", "head").astype(
+                np.float64
+            ),
+            "leak_demand": load_archive_variable(
+                archive_path, "node", "leak_demand"
+            ).astype(np.float64),
+        }
+
+    results_filename = os.path.join(
+        simulation_data_folder, f"simulation_results_{realization_id}.pickle"
+    )
+    if os.path.exists(results_filename):
+        with open(results_filename, "rb") as f:
+            simulation_results = pickle.load(f)
+        if simulation_results.error_code is not None:
+            return None
+        return get_warm_start_reference(simulation_results)
+
+    return None
+
+
+def find_warm_start_reference(
+    realization_id: int,
+    warm_start_folder: str | None,
+    clean_warm_start_folder: str | None,
+) -> tuple[str | None, dict | None]:
+    """
+    Returns the best available reference for a realization and its kind: the
+    same realization of warm_start_folder (the unmitigated run of the same damage
+    state) or else the clean run of clean_warm_start_folder.
+    """
+    if warm_start_folder is not None:
+        reference = load_warm_start_reference(warm_start_folder, realization_id)
+        if reference is not None:
+            return "unmitigated", reference
+    if clean_warm_start_folder is not None:
+        # Every realization starts from the same clean run
+        if clean_warm_start_folder not in _clean_references:
+            _clean_references[clean_warm_start_folder] = load_warm_start_reference(
+                clean_warm_start_folder, 1
+            )
+        reference = _clean_references[clean_warm_start_folder]
+        if reference is not None:
+            return "clean", reference
+
+    return None, None
+
+
+def print_newton_iterations_summary(results_list: list[dict]):
+    """
+    Prints the Newton iterations per solved realization by warm start reference,
+    to compare them with the realizations solved from scratch.
+    """
+    iterations = pd.DataFrame(
+        [
+            {
+                "warm_start": result.get("warm_start") or "cold",
+                "newton_iterations": result["newton_iterations"],
+            }
+            for result in results_list
+            if result.get("newton_iterations") is not None
+            and not result.get("reused_scenario")
+        ]
+    )
+    if iterations.empty:
+        return
+
+    summary = iterations.groupby("warm_start")["newton_iterations"].agg(
+        ["count", "mean", "sum"]
+    )
+    print("Newton iterations:")
+    print(summary.round(1).to_string())
@@ -0,0 +1,303 @@
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from .aggregation_utils import PressureHistogram
+from .checkpoint_utils import write_file_atomically
+
+# Axes of every metric kept in the result store, besides the realization axis.
+# Element axes only hold the nodes of the base network: the Leak_* nodes change
+# between realizations (min_system_pressure still accounts for them).
+STORE_METRICS = {
+    # Por tiempo y elemento
+    "pressure": ("times", "node_names"),
+    "wsa": ("times", "demand_node_names"),
+    # Por nodo
+    "mean_node_pressure": ("node_names",),
+    "betweenness_centrality": ("node_names",),
+    "closeness_centrality": ("node_names",),
+    "node_degree": ("node_names",),
+    # Por tiempo
+    "mean_t_pressure": ("times",),
+    "todini": ("times",),
+    "mean_t_wsa": ("times",),
+    "mean_t_flowrate": ("times",),
+    "mean_t_demand": ("times",),
+    "mean_t_leak_demand": ("times",),
+    "mean_t_total_demand": ("times",),
+    "mean_t_tank_levels": ("times",),
+    "t_min_satisfied_node_pressure": ("times",),
+    "t_required_satisfied_node_pressure": ("times",),
+    # Escalares (also kept in the metrics DataFrame)
+    "pga": (),
+    "num_damages": (),
+    "num_major_damages": (),
+    "num_moderate_damages": (),
+    "min_system_pressure": (),
+    "min_system_junctions_pressure": (),
+    "mean_system_pressure": (),
+    "mean_system_wsa": (),
+    "sampling_weight": (),
+}
+
+
+def create_result_store(
+    store_folder: str,
+    num_realizations: int,
+    times: list[int],
+    node_names: list[str],
+    demand_node_names: list[str],
+):
+    """
+    Creates (or keeps, when resuming) a store with one float32 array per metric of
+    shape (realization, *axes). Row i holds realization_id i + 1.
+    """
+    index_filename = os.path.join(store_folder, "index.json")
+    if os.path.exists(index_filename):
+        # A store of an older version only lacks the metrics added since then
+        _create_metric_arrays(store_folder, load_store_index(store_folder))
+        return
+
+    os.makedirs(store_folder, exist_ok=True)
+    index = {
+        "num_realizations": num_realizations,
+        "times": [int(t) for t in times],
+        "node_names": list(node_names),
+        "demand_node_names": list(demand_node_names),
+    }
+    _create_metric_arrays(store_folder, index)
+    written = open_memmap(
+        os.path.join(store_folder, "written.npy"),
+        mode="w+",
+        dtype=np.bool_,
+        shape=(num_realizations,),
+    )
+    written.flush()
+
+    # The index is written last: its presence marks a complete store
+    with open(index_filename, "w") as f:
+        json.dump(index, f)
+
+
+def _create_metric_arrays(store_folder: str, index: dict):
+    for metric, axes in STORE_METRICS.items():
+        filename = os.path.join(store_folder, f"{metric}.npy")
+        if os.path.exists(filename):
+            continue
+        shape = (index["num_realizations"], *(len(index[axis]) for axis in axes))
+        array = open_memmap(filename, mode="w+", dtype=np.float32, shape=shape)
+        array[:] = np.nan
+        array.flush()
+
+
+def load_store_index(store_folder: str) -> dict:
+    with open(os.path.join(store_folder, "index.json")) as f:
+        return json.load(f)
+
+
+def load_pressure_histogram(store_folder: str) -> PressureHistogram | None:
+    """
+    Pressure histogram of the realizations of the store without negative
+    pressures, see PressureHistogram (None for stores from before it).
+    """
+    return _load_pressure_histogram(store_folder)[0]
+
+
+def _load_pressure_histogram(
+    store_folder: str,
+) -> tuple[PressureHistogram | None, np.ndarray | None]:
+    filename = os.path.join(store_folder, "pressure_histogram.npz")
+    if not os.path.exists(filename):
+        return None, None
+    with np.load(filename) as data:
+        histogram = PressureHistogram(list(data["node_names"]), data["edges"])
+        histogram.time_counts = data["time_counts"]
+        histogram.min_counts = data["min_counts"]
+        # Rows already added, so resuming doesn't count them twice
+        return histogram, data["counted"]
+
+
+def _save_pressure_histogram(
+    store_folder: str, histogram: PressureHistogram, counted: np.ndarray
+):
+    data = io.BytesIO()
+    np.savez(
+        data,
+        node_names=np.array(histogram.node_names),
+        edges=histogram.edges,
+        time_counts=histogram.time_counts,
+        min_counts=histogram.min_counts,
+        counted=counted,
+    )
+    write_file_atomically(
+        os.path.join(store_folder, "pressure_histogram.npz"), data.getvalue()
+    )
+
+
+def open_result_store(store_folder: str) -> dict:
+    """
+    Opens every array of the store for writing.
+    """
+    index = load_store_index(store_folder)
+    histogram, counted = _load_pressure_histogram(store_folder)
+    if histogram is None:
+        histogram = PressureHistogram(index["node_names"])
+        counted = np.zeros(index["num_realizations"], dtype=np.bool_)
+    return {
+        "folder": store_folder,
+        "index": index,
+        "pressure_histogram": histogram,
+        "histogram_counted": counted,
+        "arrays": {
+            metric: open_memmap(os.path.join(store_folder, f"{metric}.npy"), mode="r+")
+            for metric in STORE_METRICS
+        },
+        "written": open_memmap(os.path.join(store_folder, "written.npy"), mode="r+"),
+    }
+
+
+def _to_store_values(value, axes: tuple, index: dict) -> np.ndarray:
+    if len(axes) == 0:
+        return np.float32(value)
+    if isinstance(value, dict):
+        value = pd.Series(value)
+    if len(axes) == 1:
+        labels = index[axes[0]]
+        return pd.Series(value).reindex(labels).to_numpy(dtype=np.float32)
+
+    return (
+        pd.DataFrame(value)
+        .reindex(index=index[axes[0]], columns=index[axes[1]])
+        .to_numpy(dtype=np.float32)
+    )
+
+
+def write_realization(store: dict, metrics: dict) -> dict:
+    """
+    Writes the arrays of a realization to the store and returns the metrics
+    without them, so the caller only keeps the scalars in memory.
+    """
+    if "error" in metrics:
+        return metrics
+
+    index = store["index"]
+    row = metrics["realization_id"] - 1
+    for metric, axes in STORE_METRICS.items():
+        if metric in metrics and metrics[metric] is not None:
+            store["arrays"][metric][row] = _to_store_values(
+                metrics[metric], axes, index
+            )
+    store["written"][row] = True
+
+    # Discarded realizations (negative pressures) are left out of the histogram
+    invalid_at = metrics.get("invalid_at")
+    valid = (invalid_at is None or pd.isna(invalid_at)) and not (
+        metrics.get("min_system_pressure", 0) < 0
+    )
+    if valid and "pressure" in metrics and not store["histogram_counted"][row]:
+        weight = metrics.get("sampling_weight", 1.0)
+        store["pressure_histogram"].add(
+            store["arrays"]["pressure"][row], 1.0 if pd.isna(weight) else weight
+        )
+        store["histogram_counted"][row] = True
+
+    return {
+        key: value
+        for key, value in metrics.items()
+        if key not in STORE_METRICS or STORE_METRICS[key] == ()
+    }
+
+
+def flush_result_store(store: dict):
+    for array in store["arrays"].values():
+        array.flush()
+    store["written"].flush()
+    _save_pressure_histogram(
+        store["folder"], store["pressure_histogram"], store["histogram_counted"]
+    )
+
+
+def write_store_metric(store_folder: str, metric: str, values: dict[int, object]):
+    """
+    Writes one metric of some realizations ({realization_id: value}) to an
+    existing store, e.g. to backfill a metric added after the experiment ran.
+    """
+    index = load_store_index(store_folder)
+    array = open_memmap(os.path.join(store_folder, f"{metric}.npy"), mode="r+")
+    for realization_id, value in values.items():
+        array[realization_id - 1] = _to_store_values(
+            value, STORE_METRICS[metric], index
+        )
+    array.flush()
+
+
+def load_store_metric(store_folder: str, metric: str) -> np.ndarray:
+    """
+    Memory-maps one metric of the store read-only, shape (realization, *axes).
+    """
+    return np.load(os.path.join(store_folder, f"{metric}.npy"), mmap_mode="r")
+
+
+def iter_store_realizations(
+    store_folder: str, realization_ids: list[int], metrics: list[str]
+):
+    """
+    Yields (realization_id, {metric: values}) one realization at a time, reading
+    only its rows of the given metrics.
+    """
+    arrays = {metric: load_store_metric(store_folder, metric) for metric in metrics}
+    for realization_id in realization_ids:
+        yield realization_id, {
+            metric: np.asarray(array[realization_id - 1])
+            for metric, array in arrays.items()
+        }
+
+
+def load_store_realization(store_folder: str, realization_id: int) -> dict:
+    """
+    Arrays of a realization of the store (not its scalars), labeled as in the
+    metrics of simulate_wrapper, e.g. to write them again for another
+    realization. Metrics it doesn't have (all NaN) are left out.
+    """
+    index = load_store_index(store_folder)
+    metrics = {}
+    for metric, axes in STORE_METRICS.items():
+        if axes == ():
+            continue
+        values = np.asarray(load_store_metric(store_folder, metric)[realization_id - 1])
+        if np.isnan(values).all():
+            continue
+        if len(axes) == 1:
+            metrics[metric] = pd.Series(values, index=index[axes[0]])
+        else:
+            metrics[metric] = pd.DataFrame(
+                values, index=index[axes[0]], columns=index[axes[1]]
+            )
+    return metrics
+
+
+def get_store_realization_ids(store_folder: str) -> list[int]:
+    written = np.load(os.path.join(store_folder, "written.npy"), mmap_mode="r")
+    return [int(row) + 1 for row in np.flatnonzero(written)]
+
+
+def load_store_frame(
+    store_folder: str, metric: str, realization_ids: list[int] | None = None
+) -> pd.DataFrame:
+    """
+    Returns a metric with one axis as a DataFrame with one column per realization.
+    """
+    index = load_store_index(store_folder)
+    (axis,) = STORE_METRICS[metric]
+    if realization_ids is None:
+        realization_ids = get_store_realization_ids(store_folder)
+
+    values = load_store_metric(store_folder, metric)
+    rows = np.asarray(realization_ids, dtype=int) - 1
+    return pd.DataFrame(
+        values[rows].T, index=index[axis], columns=list(realization_ids)
+    )
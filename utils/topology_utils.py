@@ -0,0 +1,172 @@
+import os
+import pickle
+from collections import OrderedDict
+
+import networkx as nx
+import wntr
+from wntr.network import WaterNetworkModel
+
+# Centralities of the intact networks seen by this process, by network hash. Every
+# realization of a network (whatever its damaged pipes) shares an entry.
+_centralities: OrderedDict[str, dict] = OrderedDict()
+_max_cached_centralities = 32
+
+
+def compute_intact_centralities(G: nx.MultiDiGraph) -> dict:
+    """
+    Betweenness and closeness centrality of the intact network, plus what the
+    leak nodes of its split pipes need: the edge betweenness of each pipe and,
+    for each node, how many nodes reach it (itself included) and the sum of
+    their distances to it.
+
+    The graph has no "length" attribute, so distances are hop counts. Closeness
+    uses the incoming distances, as nx.closeness_centrality.
+    """
+    num_nodes = len(G)
+    reversed_G = G.reverse(copy=False)
+    closeness_centrality = {}
+    reaching_nodes = {}
+    reaching_distance = {}
+    for node in G:
+        distances = nx.single_source_shortest_path_length(reversed_G, node)
+        total_distance = sum(distances.values())
+        reaching_nodes[node] = len(distances)
+        reaching_distance[node] = total_distance
+        # Wasserman and Faust normalization, as nx.closeness_centrality
+        closeness_centrality[node] = (
+            (len(distances) - 1) ** 2 / (total_distance * (num_nodes - 1))
+            if total_distance > 0 and num_nodes > 1
+            else 0.0
+        )
+
+    return {
+        "betweenness_centrality": nx.betweenness_centrality(
+            G, normalized=True, weight="length"
+        ),
+        "closeness_centrality": closeness_centrality,
+        "pipe_betweenness": {
+            link_name: value
+            for (_, _, link_name), value in nx.edge_betweenness_centrality(
+                G, normalized=True, weight="length"
+            ).items()
+        },
+        "reaching_nodes": reaching_nodes,
+        "reaching_distance": reaching_distance,
+    }
+
+
+def get_intact_centralities(
+    G: nx.MultiDiGraph, network_hash: str, cache_folder: str | None = None
+) -> dict:
+    """
+    Returns compute_intact_centralities of the intact network G, reusing a
+    previous computation for the same network when available (in memory or in
+    cache_folder, which can be shared by all the workers of an experiment).
+    """
+    if network_hash in _centralities:
+        _centralities.move_to_end(network_hash)
+        return _centralities[network_hash]
+
+    cache_filename = None
+    centralities = None
+    if cache_folder is not None:
+        cache_filename = os.path.join(cache_folder, f"{network_hash}.pickle")
+        if os.path.exists(cache_filename):
+            with open(cache_filename, "rb") as f:
+                centralities = pickle.load(f)
+
+    if centralities is None:
+        centralities = compute_intact_centralities(G)
+        if cache_filename is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+            tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+            with open(tmp_filename, "wb") as f:
+                pickle.dump(centralities, f)
+            os.replace(tmp_filename, cache_filename)
+
+    _centralities[network_hash] = centralities
+    if len(_centralities) > _max_cached_centralities:
+        _centralities.popitem(last=False)
+
+    return centralities
+
+
+def get_intact_graph(wn: WaterNetworkModel, split_pipes: list[str]) -> nx.MultiDiGraph:
+    """
+    Graph of wn before its split_pipes were split: each Leak_{pipe} node and its
+    {pipe}_A half are dropped and {pipe} goes back to the end node of the half.
+    """
+    G = wn.to_graph()
+    for pipe_name in split_pipes:
+        leak_node_name = f"Leak_{pipe_name}"
+        half = wn.get_link(f"{pipe_name}_A")
+        G.remove_node(leak_node_name)
+        G.add_edge(
+            wn.get_link(pipe_name).start_node_name,
+            half.end_node_name,
+            key=pipe_name,
+        )
+    return G
+
+
+def get_centralities(
+    wn: WaterNetworkModel,
+    network_hash: str,
+    split_pipes: list[str],
+    cache_folder: str | None = None,
+) -> dict:
+    """
+    Betweenness and closeness centrality of every node of wn, with the leak node
+    of each split pipe in the middle of its pipe rather than an extra hop. The
+    distances between the nodes of the network are then those of the intact
+    network, whose centralities are cached under network_hash alone, and only
+    the leak nodes are computed per realization:
+
+    - betweenness: the share of shortest paths through its pipe (the pipe's edge
+      betweenness in the intact network).
+    - closeness: from the nodes reaching the start node of its pipe, half a pipe
+      farther away.
+    """
+    intact = get_intact_centralities(
+        get_intact_graph(wn, split_pipes) if split_pipes else wn.to_graph(),
+        network_hash,
+        cache_folder,
+    )
+    betweenness_centrality = dict(intact["betweenness_centrality"])
+    closeness_centrality = dict(intact["closeness_centrality"])
+
+    num_nodes = len(closeness_centrality)
+    for pipe_name in split_pipes:
+        start_node_name = wn.get_link(pipe_name).start_node_name
+        reaching_nodes = intact["reaching_nodes"][start_node_name]
+        total_distance = (
+            intact["reaching_distance"][start_node_name] + reaching_nodes / 2
+        )
+        leak_node_name = f"Leak_{pipe_name}"
+        betweenness_centrality[leak_node_name] = intact["pipe_betweenness"][pipe_name]
+        closeness_centrality[leak_node_name] = reaching_nodes**2 / (
+            total_distance * num_nodes
+        )
+
+    return {
+        "betweenness_centrality": betweenness_centrality,
+        "closeness_centrality": closeness_centrality,
+    }
+
+
+def get_topology_metrics(
+    wn: WaterNetworkModel,
+    network_hash: str,
+    split_pipes: list[str],
+    cache_folder: str | None = None,
+) -> dict:
+    G = wn.to_graph()
+    centralities = get_centralities(wn, network_hash, split_pipes, cache_folder)
+
+    return {
+        "betweenness_centrality": centralities["betweenness_centrality"],
+        "closeness_centrality": centralities["closeness_centrality"],
+        # Degree and bridges are linear in the graph size, not worth caching
+        "node_degree": dict(G.degree()),
+        "bridges": list(wntr.metrics.bridges(G)),
+    }
@@ -1,8 +1,17 @@
-from typing import TypedDict, Literal
+from typing import Callable, TypedDict, Literal
+
+import numpy as np
+import pandas as pd
 
 
 SimulationType = Literal["Clean", "Earthquake"]
 
+# What simulate_wrapper does besides hydraulics and metrics (see RUN_PROFILES)
+RunProfile = Literal["metrics_only", "full", "debug"]
+
+# How simulate_wrapper saves each realization's network and SimulationResults
+RawDataFormat = Literal["pickle", "archive"]
+
 
 class NetworkPriorityNodes(TypedDict):
     betweenness: list[str]
@@ -15,3 +24,123 @@ class MitigationLeaksStrategyOptions(TypedDict):
     priority_nodes: NetworkPriorityNodes
     mitigation_strategy: Literal["betweenness", "closeness", "pressure", "node_degree"]
     reinforcement_percent: int
+
+
+class ExperimentVariant(TypedDict):
+    """
+    An earthquake experiment run realization by realization together with the
+    others of the same damage draws (see simulate_network_variants_parallel).
+    Its checkpoints and result store are kept in output_folder.
+    """
+
+    output_folder: str
+    # None for the unmitigated earthquake
+    mitigation_leaks_strategy_options: MitigationLeaksStrategyOptions | None
+
+
+# (element, variable) of a SimulationResults, e.g. ("node", "leak_demand")
+ResultsVariable = tuple[Literal["node", "link"], str]
+
+
+class BackfillMetric(TypedDict):
+    """
+    A metric added to the realizations of an existing experiment from their raw
+    data (see backfill_utils.backfill_experiment). compute must be a module-level
+    function, since it runs in a process pool.
+    """
+
+    # Columns compute returns, realizations that already have all of them are skipped
+    columns: list[str]
+    # Only these variables are read from the raw data
+    variables: list[ResultsVariable]
+    # compute({variable: DataFrame (time, element)}, junction_names) -> {column: value}
+    compute: Callable[[dict[ResultsVariable, pd.DataFrame], list[str]], dict]
+
+
+class HydraulicOptions(TypedDict):
+    demand_model: Literal["DD", "PDD"]
+    duration: int
+    minimum_pressure: float
+    required_pressure: float
+
+
+# Realization-level estimators tracked by adaptive sampling (see sampling_utils)
+AdaptiveEstimator = Literal[
+    "mean_system_wsa", "mean_todini", "negative_pressure_fraction"
+]
+
+
+class AdaptiveSamplingOptions(TypedDict):
+    """
+    Realizations run in batches of batch_size until every estimator of
+    target_half_widths has a confidence interval at least that narrow (after
+    min_realizations) or num_realizations, the budget, is reached.
+    """
+
+    batch_size: int
+    min_realizations: int
+    confidence: float  # e.g. 0.95
+    target_half_widths: dict[AdaptiveEstimator, float]
+
+
+class SamplingDesign(TypedDict):
+    """
+    How the PGA and damage states of the earthquake realizations are drawn (see
+    sampling_utils.sample_earthquake_scenarios).
+    """
+
+    # "lhs": one PGA per equal probability stratum, in random order
+    pga: Literal["independent", "lhs"]
+    # Pairs of realizations with mirrored uniforms (u and 1 - u)
+    antithetic: bool
+    # Mean shift of the PGA proposal in standard deviations (0 for none), the
+    # realizations carry a likelihood ratio as sampling_weight
+    importance_shift: float
+
+
+class RunProfileOptions(TypedDict):
+    charts: bool  # Rendered after the simulation, see render_charts
+    raw_data: bool
+    topology: bool
+    verbose: bool
+    convergence_error: bool
+
+
+class MetricsIndex(TypedDict):
+    """
+    Integer positions of each group of elements in the node/link columns of the
+    simulation results (see metrics_utils.get_metrics_index).
+    """
+
+    junctions: np.ndarray
+    reservoirs: np.ndarray
+    tanks: np.ndarray
+    demand_nodes: np.ndarray
+    todini_pumps: np.ndarray
+    todini_pump_start_nodes: np.ndarray
+    todini_pump_end_nodes: np.ndarray
+
+
+class NetworkIndex(TypedDict):
+    """
+    Everything about a base network that realizations only read, built once per
+    INP file and hydraulic options (see network_utils.get_network_index).
+    Positions refer to node_names / link_names.
+    """
+
+    node_names: list[str]
+    node_position: dict[str, int]
+    link_names: list[str]
+    link_position: dict[str, int]
+    link_start_nodes: np.ndarray
+    link_end_nodes: np.ndarray
+    pipe_names: list[str]
+    pipe_position: dict[str, int]
+    pipe_start_nodes: np.ndarray
+    pipe_end_nodes: np.ndarray
+    pipe_diameters: np.ndarray
+    junction_names: list[str]
+    demand_node_mask: np.ndarray  # Over junction_names
+    demand_node_names: list[str]
+    times: list[int]
+    expected_demand: np.ndarray  # (times, demand nodes)